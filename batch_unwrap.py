@@ -0,0 +1,275 @@
+"""
+Unwraps many Super Hexagon videos with a pool of worker processes.
+
+The jobs are read from a JSON manifest, which is a list of jobs where each job
+is either the path of a video or an object with the path and the options of
+"unwrap_video" for that video:
+
+    [
+        "vid/match1.mp4",
+        {"video": "vid/match2.mp4", "out": "frames/final", "stride": 2,
+         "ranges": "0-5000,9000-", "crop": "clip", "repeat_threshold": 1.0}
+    ]
+
+The longest jobs (by the number of frames they select) are started first, so
+that a long video does not start last and keep a single worker busy after the
+others are done.  Each worker process starts once and runs job after job, so
+the interpreter, SimpleCV and OpenGL are only loaded once per worker.
+
+Ctrl-C (or SIGTERM to the workers) lets each worker finish its current frame
+and save its progress, so the batch can be continued with --resume.
+"""
+
+import sys
+import os
+import argparse
+import json
+import time
+import traceback
+import multiprocessing
+import Queue
+
+# Custom "Super Hexagon" parsing library
+from code.source import open_source, FrameSelection, parse_ranges
+from code.checkpoint import ProgressManifest
+from code.metrics import Metrics
+from unwrap_video import unwrap_video
+
+# the options of "unwrap_video" that a job can set
+JOB_OPTIONS = ('start_frame', 'stop_frame', 'ranges', 'stride', 'crop',
+    'repeat_threshold', 'use_sidecar', 'resume', 'codec', 'color', 'raw_size',
+    'raw_format', 'parse_draft')
+
+def load_jobs(manifest_path, out_root, options=None):
+    """
+    Read the jobs of a manifest file as a list of dicts with the "video" path,
+    the "out" directory and the "options" of "unwrap_video".
+
+    out_root = directory to put the frames of jobs without an "out" directory
+               in (in a subdirectory named after the video)
+    options  = default options of every job
+    """
+    with open(manifest_path) as f:
+        entries = json.load(f)
+    jobs = []
+    for entry in entries:
+        if isinstance(entry, basestring):
+            entry = {"video": entry}
+        entry = dict(entry)
+        video = entry.pop("video")
+        out = entry.pop("out", None)
+        if not out:
+            name = os.path.splitext(os.path.basename(video))[0]
+            out = os.path.join(out_root, name)
+        job_options = dict(options or {})
+        for key, value in entry.iteritems():
+            if key not in JOB_OPTIONS:
+                raise ValueError('unknown option "%s" of job "%s"' % (key, video))
+            if key == 'ranges' and isinstance(value, basestring):
+                value = parse_ranges(value)
+            job_options[key] = value
+        jobs.append({"video": video, "out": out, "options": job_options})
+    return jobs
+
+def estimate_frames(job):
+    """
+    Get the number of frames that the given job will process, or None if the
+    length of its video is unknown.
+    """
+    options = job["options"]
+    total = open_source(job["video"], options.get('raw_size'), options.get('raw_format')).frame_count()
+    if total is None:
+        return None
+    ranges = options.get('ranges') or [(options.get('start_frame', 0), options.get('stop_frame', -1))]
+    return FrameSelection(ranges, options.get('stride', 1)).count(total)
+
+def schedule_jobs(jobs):
+    """
+    Sort the jobs longest first.  Jobs of unknown length come first, since
+    starting a long job late delays the whole batch more than starting a
+    short job early.
+    """
+    def key(job):
+        frames = job["frames"]
+        return (frames is not None, -(frames or 0))
+    return sorted(jobs, key=key)
+
+def run_job(job, hooks=(), unwrapper=None):
+    """
+    Unwrap the video of the given job.  Returns a report of the job with its
+    throughput, or the error that stopped it.
+
+    hooks     = metrics hooks to call with the record of each frame
+    unwrapper = Unwrapper object to reuse
+    """
+    report = {
+        "video": job["video"],
+        "out": job["out"],
+        "estimated_frames": job.get("frames"),
+        "worker": os.getpid(),
+        "frames": 0,
+        "elapsed": 0.0,
+        "fps": 0.0,
+        "parse_failures": 0,
+        "complete": False,
+        "error": None,
+    }
+    metrics = Metrics(hooks)
+    try:
+        unwrap_video(job["video"], dump_dir=job["out"], metrics=metrics,
+            unwrapper=unwrapper, print_log=False, **job["options"])
+    except Exception:
+        report["error"] = traceback.format_exc()
+    summary = metrics.summary()
+    report["frames"] = summary["frames"]
+    report["elapsed"] = summary["elapsed"]
+    report["fps"] = summary["fps"]
+    report["parse_failures"] = summary["failures"]
+    manifest = ProgressManifest.load(job["out"])
+    report["complete"] = bool(manifest and manifest.complete and not report["error"])
+    return report
+
+def worker_main(jobs, reports, stopped):
+    """
+    Run jobs from the jobs queue until its end (None) or until the batch is
+    stopped, putting their reports in the reports queue.  (One Unwrapper is
+    reused for every job of this worker, so its shader is compiled once.)
+    """
+    from code.unwrap import Unwrapper
+    try:
+        unwrapper = Unwrapper()
+        while not stopped.is_set():
+            job = jobs.get()
+            if job is None:
+                break
+            report = run_job(job, unwrapper=unwrapper)
+            reports.put(report)
+            if not report["complete"] and not report["error"]:
+                # The job was interrupted by a signal.
+                break
+    except KeyboardInterrupt:
+        pass
+
+def run_batch(jobs, workers, log=None):
+    """
+    Run the given jobs (with their estimated "frames") on the given number of
+    worker processes.  Returns the list of job reports.
+    """
+    workers = min(workers, len(jobs))
+    queue = multiprocessing.Queue()
+    for job in schedule_jobs(jobs):
+        queue.put(job)
+    for n in xrange(workers):
+        queue.put(None)
+    reports = multiprocessing.Queue()
+    stopped = multiprocessing.Event()
+
+    processes = []
+    for n in xrange(workers):
+        process = multiprocessing.Process(target=worker_main, args=(queue, reports, stopped))
+        process.start()
+        processes.append(process)
+
+    results = []
+    def collect():
+        try:
+            report = reports.get(timeout=0.5)
+        except Queue.Empty:
+            return
+        results.append(report)
+        if log:
+            log(report)
+
+    try:
+        while len(results) < len(jobs) and any(p.is_alive() for p in processes):
+            collect()
+    except KeyboardInterrupt:
+        # The workers got the signal too, and are saving their progress.
+        stopped.set()
+        while any(p.is_alive() for p in processes):
+            collect()
+
+    # Collect the reports that were put right before the workers stopped.
+    while True:
+        try:
+            results.append(reports.get(timeout=0.1))
+        except Queue.Empty:
+            break
+
+    for process in processes:
+        process.join()
+    return results
+
+def get_default_workers():
+    """
+    Get the default number of workers: one per core, leaving a core for the
+    video decoders' own threads and the rest of the system.
+    """
+    return max(1, multiprocessing.cpu_count() - 1)
+
+def print_report(jobs, results):
+    """Print a table of the job reports."""
+    print '%-40s %9s %9s %8s %8s  %s' % ('video', 'frames', 'seconds', 'fps', 'failed', 'status')
+    done = set()
+    for r in results:
+        done.add(r["video"])
+        if r["error"]:
+            status = 'error: ' + r["error"].strip().splitlines()[-1]
+        elif r["complete"]:
+            status = 'done'
+        else:
+            status = 'interrupted'
+        print '%-40s %9d %9.1f %8.1f %8d  %s' % (
+            r["video"][-40:], r["frames"], r["elapsed"], r["fps"], r["parse_failures"], status)
+    for job in jobs:
+        if job["video"] not in done:
+            print '%-40s %9s %9s %8s %8s  %s' % (job["video"][-40:], '', '', '', '', 'not started')
+
+if __name__ == "__main__":
+
+    # Create argument parser
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('manifest', help='path to the JSON list of jobs')
+    parser.add_argument('--out', metavar='DIR', default='frames', help='directory for the frames of jobs without an "out" directory\n(default "frames")')
+    parser.add_argument('--workers', metavar='N', type=int, default=get_default_workers(), help='number of worker processes (default %d)' % get_default_workers())
+    parser.add_argument('--resume', action='store_true', help='continue the interrupted dumps of the jobs')
+    parser.add_argument('--report', metavar='FILE', help='write the job reports to this file as JSON')
+    args = parser.parse_args()
+
+    options = {}
+    if args.resume:
+        options['resume'] = True
+    jobs = load_jobs(args.manifest, args.out, options)
+
+    # Probe the length of each video for the scheduling.
+    for job in jobs:
+        job["frames"] = estimate_frames(job)
+
+    def log(report):
+        status = 'failed' if report["error"] else 'finished'
+        print '%s %s (%d frames, %.1f fps)' % (status, report["video"], report["frames"], report["fps"])
+        sys.stdout.flush()
+
+    start = time.time()
+    results = run_batch(jobs, args.workers, log)
+    elapsed = time.time() - start
+
+    print
+    print_report(jobs, results)
+    frames = sum(r["frames"] for r in results)
+    print '%d frames in %.1f seconds (%.1f fps over %d workers)' % (
+        frames, elapsed, frames / elapsed if elapsed > 0 else 0.0, args.workers)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({
+                "workers": args.workers,
+                "elapsed": elapsed,
+                "frames": frames,
+                "jobs": results,
+            }, f, indent=2, sort_keys=True)
+
+    if any(r["error"] or not r["complete"] for r in results) or len(results) < len(jobs):
+        sys.exit(1)
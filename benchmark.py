@@ -0,0 +1,253 @@
+"""
+Times each stage of the unwrap pipeline separately over a fixed corpus of
+Super Hexagon frames, so that performance can be compared between versions.
+
+The corpus is made of the included screenshots, variations of them (resized,
+rotated and inverted), and generated frames at common capture resolutions.
+"""
+
+import sys
+import os
+import argparse
+import json
+import platform
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+
+# SimpleCV image processing and computer vision library
+import SimpleCV as scv
+
+# Custom "Super Hexagon" parsing library
+from code.parse import parse_frame
+from code.simplify_polygon import simplify_polygon_by_angle
+from code.synthetic import generate_frames
+from code.unwrap import Unwrapper, PolygonProjector, OffscreenTarget
+from pyglet.gl import glFinish
+
+# the stages of the pipeline in the order they are run
+STAGES = ['decode', 'parse', 'simplify', 'projector', 'upload', 'draw', 'readback', 'encode']
+
+# stages that are also timed on their own for the breakdown, but run as part
+# of another stage (so they are not counted again in the total)
+SUBSTAGES = {'simplify': 'parse'}
+
+# screenshots that the corpus is made from
+CORPUS_IMAGES = ['code/test.jpg', 'img/test.jpg']
+
+# sizes of the generated frames in the corpus (720p, 1080p and 4K)
+SYNTHETIC_SIZES = [(1280,720), (1920,1080), (3840,2160)]
+
+def make_corpus(corpus_dir, synthetic_count=2):
+    """
+    Write the synthetic frames of the corpus into the given directory.
+    Returns a list of (name, path) of every frame in the corpus.
+
+    synthetic_count = number of generated frames of each size
+    """
+    corpus = []
+    for i, path in enumerate(CORPUS_IMAGES):
+        corpus.append((path, path))
+        img = scv.Image(path)
+        variants = [
+            ('720p',     img.resize(1280,720)),
+            ('1080p',    img.resize(1920,1080)),
+            ('rotated',  img.rotate(15)),
+            ('inverted', img.invert()),
+        ]
+        for name, variant in variants:
+            name = '%s (%s)' % (path, name)
+            variant_path = os.path.join(corpus_dir, 'frame%d_%d.jpg' % (i, len(corpus)))
+            variant.save(variant_path)
+            corpus.append((name, variant_path))
+    for w,h in SYNTHETIC_SIZES:
+        for i, (img, frame) in enumerate(generate_frames(w, h, synthetic_count)):
+            name = 'synthetic %dx%d #%d' % (w, h, i)
+            path = os.path.join(corpus_dir, 'synthetic%dx%d_%d.jpg' % (w, h, i))
+            scv.Image(img, cv2image=True).save(path)
+            corpus.append((name, path))
+    return corpus
+
+def get_percentile(times, p):
+    """Get the p-th percentile (0 to 100) of a list of times."""
+    return float(np.percentile(times, p)) if times else 0.0
+
+class StageTimes:
+    """
+    Collects the running times of each stage of the pipeline.
+    """
+    def __init__(self):
+        self.times = dict((stage, []) for stage in STAGES)
+        self.timer = timeit.default_timer
+
+    def measure(self, stage, func, *args):
+        """Call the given function and add its running time to the given stage."""
+        start = self.timer()
+        result = func(*args)
+        self.times[stage].append(self.timer() - start)
+        return result
+
+    def summarize(self):
+        """
+        Get the count, mean, percentiles (in milliseconds) and frames per
+        second of each stage that was measured.
+        """
+        summary = {}
+        for stage in STAGES:
+            times = self.times[stage]
+            if not times:
+                continue
+            mean = sum(times) / len(times)
+            summary[stage] = {
+                "count": len(times),
+                "mean_ms": mean * 1000,
+                "p50_ms": get_percentile(times, 50) * 1000,
+                "p95_ms": get_percentile(times, 95) * 1000,
+                "p99_ms": get_percentile(times, 99) * 1000,
+                "fps": 1.0 / mean if mean > 0 else 0.0,
+            }
+        return summary
+
+def run_benchmark(corpus, repeat=10, use_gl=True, tmp_dir='.'):
+    """
+    Run every frame of the corpus through the pipeline the given number of
+    times, measuring each stage.  Returns the StageTimes and the number of
+    frames that failed to parse.
+    """
+    times = StageTimes()
+    failures = 0
+
+    unwrapper = None
+    targets = {}
+    if use_gl:
+        unwrapper = Unwrapper()
+
+    def upload(img, frame):
+        unwrapper.update(img, frame)
+        glFinish()
+
+    def draw():
+        unwrapper.draw()
+        glFinish()
+
+    def encode(out, path):
+        scv.Image(out, cv2image=True).save(path)
+
+    encode_path = os.path.join(tmp_dir, 'encoded.jpg')
+
+    for n in xrange(repeat):
+        for name, path in corpus:
+            img = times.measure('decode', scv.Image, path)
+            frame = times.measure('parse', parse_frame, img, True)
+            if not frame:
+                failures += 1
+                continue
+            # (already run by "parse_frame", timed again for the breakdown)
+            times.measure('simplify', simplify_polygon_by_angle, frame.center_blob.hull())
+            times.measure('projector', PolygonProjector, frame.center_point, frame.center_vertices)
+
+            if use_gl:
+                # Render into an offscreen target the size of the original,
+                # as "unwrap_video" does with its window.
+                size = img.size()
+                if size not in targets:
+                    targets[size] = OffscreenTarget(*size)
+                target = targets[size]
+                target.bind((1,1))
+                times.measure('upload', upload, img.getNumpyCv2(), frame)
+                times.measure('draw', draw)
+                out = times.measure('readback', unwrapper.read_image)
+                target.unbind()
+            else:
+                out = img.getNumpyCv2()
+
+            times.measure('encode', encode, out, encode_path)
+
+    for target in targets.values():
+        target.delete()
+
+    return times, failures
+
+def print_summary(summary):
+    """
+    Print a table of the stage summaries, and the total mean time of a frame
+    (without the substages, which are part of another stage).
+    """
+    print '%-18s %7s %9s %9s %9s %9s %9s' % ('stage', 'count', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'fps')
+    total = 0.0
+    for stage in STAGES:
+        if stage in summary:
+            s = summary[stage]
+            name = stage
+            if stage in SUBSTAGES:
+                name = '  %s (in %s)' % (stage, SUBSTAGES[stage])
+            else:
+                total += s["mean_ms"]
+            print '%-18s %7d %9.2f %9.2f %9.2f %9.2f %9.1f' % (
+                name, s["count"], s["mean_ms"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s["fps"])
+    print '%-18s %7s %9.2f' % ('total', '', total)
+
+def compare_results(old, new, tolerance):
+    """
+    Print the change in median time of each stage between two results, and
+    return the stages whose median time grew by more than the tolerance ratio.
+    """
+    regressions = []
+    print '%-10s %9s %9s %7s' % ('stage', 'old p50', 'new p50', 'ratio')
+    for stage in STAGES:
+        if stage in old["stages"] and stage in new["stages"]:
+            old_p50 = old["stages"][stage]["p50_ms"]
+            new_p50 = new["stages"][stage]["p50_ms"]
+            ratio = new_p50 / old_p50 if old_p50 > 0 else 1.0
+            flag = ''
+            if ratio > tolerance:
+                regressions.append(stage)
+                flag = '  REGRESSION'
+            print '%-10s %9.2f %9.2f %7.2f%s' % (stage, old_p50, new_p50, ratio, flag)
+    return regressions
+
+if __name__ == "__main__":
+
+    # Create argument parser
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeat', metavar='N', type=int, default=10, help='number of passes over the corpus (default 10)')
+    parser.add_argument('--synthetic', metavar='N', type=int, default=2, help='number of generated frames of each size (default 2)')
+    parser.add_argument('--no-gl', action='store_true', help='skip the OpenGL stages (upload, draw, readback)')
+    parser.add_argument('--json', metavar='FILE', help='write the results to this file as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results to a previous JSON file')
+    parser.add_argument('--tolerance', metavar='R', type=float, default=1.2, help='max ratio of new/old median time before a stage is\na regression (default 1.2)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        corpus = make_corpus(tmp_dir, args.synthetic)
+        times, failures = run_benchmark(corpus, args.repeat, not args.no_gl, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": [name for name, path in corpus],
+        "repeat": args.repeat,
+        "failures": failures,
+        "stages": times.summarize(),
+    }
+
+    print_summary(results["stages"])
+    print '%d of %d frames failed to parse' % (failures, len(corpus) * args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print
+        if compare_results(old, results, args.tolerance):
+            sys.exit(1)
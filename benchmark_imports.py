@@ -0,0 +1,94 @@
+"""
+Times the cold start of the modules and scripts (in fresh interpreters), to
+check that the light ones do not load SimpleCV or pyglet.
+
+Each command is run a number of times and its median wall time is reported,
+along with whether SimpleCV or pyglet were loaded by it.
+"""
+
+import sys
+import argparse
+import json
+import subprocess
+import timeit
+
+# (name, python arguments) of each cold start that is measured
+COMMANDS = [
+    ('python',                  ['-c', 'pass']),
+    ('import code.geometry',    ['-c', 'import code.geometry']),
+    ('import code.parse',       ['-c', 'import code.parse']),
+    ('import code.sidecar',     ['-c', 'import code.sidecar']),
+    ('import code.unwrap',      ['-c', 'import code.unwrap']),
+    ('unwrap_video.py --help',  ['unwrap_video.py', '--help']),
+    ('batch_unwrap.py --help',  ['batch_unwrap.py', '--help']),
+    ('batch worker spawn',      ['-c', 'import batch_unwrap']),
+    ('unwrap_daemon.py client', ['unwrap_daemon.py', '--help']),
+    ('unwrap_live.py --help',   ['unwrap_live.py', '--help']),
+]
+
+# Run before each command, to print which heavy libraries it loaded at exit.
+REPORT_HEAVY = """
+import sys, atexit
+def report_heavy():
+    heavy = [m for m in ('SimpleCV', 'pyglet') if m in sys.modules]
+    sys.stderr.write('\\nHEAVY %s\\n' % (','.join(heavy) or '-'))
+atexit.register(report_heavy)
+"""
+
+def time_command(args, repeat):
+    """
+    Run python with the given arguments the given number of times.  Returns
+    the median wall time in seconds, and the heavy libraries it loaded (or
+    None if it failed).
+    """
+    if args[0] == '-c':
+        code = REPORT_HEAVY + args[1]
+    else:
+        code = REPORT_HEAVY + 'sys.argv = %r\nexecfile(sys.argv[0], {"__name__": "__main__"})\n' % (args,)
+
+    times = []
+    heavy = None
+    for n in xrange(repeat):
+        start = timeit.default_timer()
+        process = subprocess.Popen([sys.executable, '-c', code],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        times.append(timeit.default_timer() - start)
+        for line in err.splitlines():
+            if line.startswith('HEAVY'):
+                heavy = line[len('HEAVY'):].strip()
+        if process.returncode != 0:
+            return None, None
+    times.sort()
+    return times[len(times)/2], heavy
+
+if __name__ == "__main__":
+
+    # Create argument parser
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeat', metavar='N', type=int, default=5, help='number of runs of each command (default 5)')
+    parser.add_argument('--json', metavar='FILE', help='write the results to this file as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results to a previous JSON file\n(e.g. from an older checkout)')
+    args = parser.parse_args()
+
+    old = {}
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+
+    results = {}
+    print '%-26s %9s %9s  %s' % ('command', 'ms', 'old ms', 'loads')
+    for name, command in COMMANDS:
+        seconds, heavy = time_command(command, args.repeat)
+        if seconds is None:
+            print '%-26s %9s %9s  %s' % (name, 'failed', '', '')
+            continue
+        results[name] = {"ms": seconds * 1000, "loads": heavy}
+        old_ms = '%9.1f' % old[name]["ms"] if name in old else ''
+        print '%-26s %9.1f %9s  %s' % (name, seconds * 1000, old_ms, heavy)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
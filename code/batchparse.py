@@ -0,0 +1,538 @@
+"""
+Parses chunks of frames at once, as a (T,H,W,3) stack of BGR arrays, for
+offline jobs where the per-frame overhead of "parse_frame" (a SimpleCV image
+and several intermediate images per step) dominates.
+
+The steps of "parse_frame" are done as whole-array operations over the chunk:
+
+    grayscale       weighted sum of the channels
+    threshold       Otsu's threshold of each frame, from histograms of all
+                    the frames computed at once (of a sample of the pixels)
+    polarity        the center of the screen is made the bright side
+    erosion         min over each pixel's 3x3 neighborhood (closing gaps in
+                    the outline of the center polygon, like "erode")
+
+Only the region around the center that can hold the center polygon is
+thresholded and eroded.  The center region is then found by casting rays out
+from the center of every frame (also at once), to the first pixel outside
+the region.  Only the last step is per frame: the convex hull of the ray end
+points, simplified like "parse_frame" does.
+
+The results are arrays of the vertices and success flags of each frame (see
+"parse_chunk"), or ParsedFrame objects (see "parse_frames").
+
+Frames that were already converted to 8-bit grayscale (see "colormode.py") are
+parsed without the grayscale step, one at a time with "parse_luma".  JPEG files
+are parsed from a decode at 1/2, 1/4 or 1/8 of their size with "parse_jpeg".
+
+    Measure the throughput on one core against the per-frame path:
+    > python batchparse.py --benchmark --size 1280x720 --chunk 64
+
+    Measure the accuracy on synthetic frames:
+    > python batchparse.py --accuracy
+
+    Measure the speed and vertex error of parsing reduced JPEG decodes (of
+    synthetic frames, or of a dump):
+    > python batchparse.py --draft
+    > python batchparse.py --draft "../frames/orig%04d.jpg"
+
+See unit tests at the end of this file.
+"""
+
+import math
+import timeit
+
+import numpy as np
+
+from parse import ParsedFrame, NO_CENTER_BLOB
+from source import read_jpeg_luma, DRAFT_REDUCTIONS
+from simplify_polygon import simplify_polygon_by_angle
+
+# default number of frames parsed at once
+CHUNK_SIZE = 64
+
+# number of rays cast from the center of each frame
+RAY_COUNT = 180
+
+# The thresholds are found from every HISTOGRAM_STEP-th pixel of each row and
+# column, which gives nearly the same threshold as all of them.
+HISTOGRAM_STEP = 4
+
+# max number of vertices of a center polygon (see the unwrap shader)
+MAX_VERTICES = 13
+
+# The vertices are found about this many pixels inside the outline of the
+# center polygon (the erosion, and the last pixel inside along each ray).
+# Pixels of reduced images are bigger, so their vertices are moved out by the
+# difference to match the ones found at full size.
+EDGE_INSET = 2.0
+
+# The center polygon must fit in this fraction of the frame height (the
+# "size" limit of the center blob in "parse_frame").
+MAX_SIZE = 0.6667
+
+def get_gray(frames):
+    """
+    Get the (T,H,W) uint8 grayscale of a stack of BGR frames (with the
+    weights of OpenCV's conversion).
+    """
+    b = frames[...,0].astype(np.uint16) * 29
+    b += frames[...,1].astype(np.uint16) * 150
+    b += frames[...,2].astype(np.uint16) * 77
+    return (b >> 8).astype(np.uint8)
+
+def get_otsu_thresholds(gray):
+    """
+    Get Otsu's threshold of each frame of a (T,H,W) grayscale stack.
+    """
+    t = gray.shape[0]
+    sample = gray.reshape(t, -1).astype(np.int64)
+    sample += (np.arange(t) * 256)[:,None]
+    hist = np.bincount(sample.ravel(), minlength=t*256).reshape(t, 256).astype(np.float64)
+
+    levels = np.arange(256, dtype=np.float64)
+    w0 = np.cumsum(hist, axis=1)
+    w1 = w0[:,-1:] - w0
+    sum0 = np.cumsum(hist * levels, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu0 = sum0 / w0
+        mu1 = (sum0[:,-1:] - sum0) / w1
+        between = w0 * w1 * (mu0 - mu1)**2
+    between[~np.isfinite(between)] = 0
+    return np.argmax(between, axis=1)
+
+def erode(mask):
+    """
+    Erode the True regions of a (T,H,W) mask by one pixel (min over the 3x3
+    neighborhood of each pixel, with the border counting as False).
+    """
+    out = np.zeros_like(mask)
+    core = mask[:, 1:-1, 1:-1].copy()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                core &= mask[:, 1+dy:mask.shape[1]-1+dy, 1+dx:mask.shape[2]-1+dx]
+    out[:, 1:-1, 1:-1] = core
+    return out
+
+def get_ray_samples(radius, rays=RAY_COUNT):
+    """
+    Get the (rays, radius) arrays of the x and y offsets of the pixels along
+    each ray from the center, one pixel apart.
+    """
+    angles = np.arange(rays) * (math.pi*2 / rays)
+    r = np.arange(radius)
+    x = np.rint(np.cos(angles)[:,None] * r).astype(np.int32)
+    y = np.rint(np.sin(angles)[:,None] * r).astype(np.int32)
+    return x, y
+
+def convex_hull(points):
+    """
+    Get the convex hull of a sequence of (x,y) points, in counterclockwise
+    order (Andrew's monotone chain).
+    """
+    points = sorted(set(points))
+    if len(points) < 3:
+        return points
+    def cross(o, a, b):
+        return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
+    lower = []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    upper = []
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    return lower[:-1] + upper[:-1]
+
+def parse_chunk(frames, rays=RAY_COUNT):
+    """
+    Parse a (T,H,W,3) stack of BGR frames, or a (T,H,W) stack of grayscale
+    frames.  Returns:
+
+        vertices = (T,MAX_VERTICES,2) float32 array of the vertices of the
+                   center polygon of each frame (NaN after the last one)
+        counts   = (T,) array of the number of vertices of each frame
+        ok       = (T,) bool array of the frames that were parsed
+
+    (The center point of every frame is the middle of the image, as in
+    "parse_frame".)
+    """
+    t, h, w = frames.shape[:3]
+    midx, midy = w/2, h/2
+    to_gray = get_gray if frames.ndim == 4 else (lambda gray: gray)
+
+    # Only look at the square around the center that can hold the polygon.
+    radius = int(h * MAX_SIZE / 2) + 2
+    x0, x1 = max(0, midx-radius), min(w, midx+radius+1)
+    y0, y1 = max(0, midy-radius), min(h, midy+radius+1)
+
+    # Threshold every frame with its own threshold, and make the center of
+    # the screen the bright side (True) of each.
+    thresholds = get_otsu_thresholds(to_gray(frames[:, ::HISTOGRAM_STEP, ::HISTOGRAM_STEP]))
+    gray = to_gray(frames[:, y0:y1, x0:x1])
+    bright = gray > thresholds[:,None,None]
+    center_bright = bright[:, midy-y0, midx-x0]
+    mask = erode(bright == center_bright[:,None,None])
+
+    # Cast rays from the center of every frame to the first pixel outside
+    # the center region.  A ray that never leaves it means the region is not
+    # enclosed (no center polygon).
+    dx, dy = get_ray_samples(radius - 1, rays)
+    inside = mask[:, (midy-y0) + dy, (midx-x0) + dx]
+    first_out = np.argmin(inside, axis=2)
+    escaped = inside.all(axis=2).any(axis=1)
+    ok = ~escaped & mask[:, midy-y0, midx-x0]
+
+    # Take the last pixel inside the region along each ray.
+    end = np.maximum(first_out - 1, 0)
+    ray_index = np.arange(rays)
+    end_x = midx + dx[ray_index, end]
+    end_y = midy + dy[ray_index, end]
+
+    vertices = np.full((t, MAX_VERTICES, 2), np.nan, np.float32)
+    counts = np.zeros(t, np.int32)
+    for k in np.nonzero(ok)[0]:
+        hull = convex_hull(zip(end_x[k].tolist(), end_y[k].tolist()))
+        if len(hull) < 3:
+            ok[k] = False
+            continue
+        polygon = simplify_polygon_by_angle(hull)
+        if not 3 <= len(polygon) <= MAX_VERTICES:
+            ok[k] = False
+            continue
+        vertices[k, :len(polygon)] = polygon
+        counts[k] = len(polygon)
+    return vertices, counts, ok
+
+def get_parsed_frames(vertices, counts, ok, size):
+    """
+    Get the results of "parse_chunk" as a list of ParsedFrame objects (or
+    None for the frames that were not parsed).
+
+    size = (width,height) of the frames
+    """
+    w,h = size
+    return [ParsedFrame((w/2, h/2), vertices[k, :counts[k]]) if ok[k] else None
+        for k in xrange(len(ok))]
+
+def parse_luma(luma, scale=1.0, report=None):
+    """
+    Parse a single (height,width) grayscale frame.  Returns a ParsedFrame
+    object, or None (like "parse_frame_scaled").
+
+    scale  = fraction of the resolution to parse at (every Nth pixel of each
+             row and column is kept, so it is rounded to 1/N)
+    report = optional dict that receives the reason parsing failed
+    """
+    h, w = luma.shape
+    step = max(1, int(round(1.0 / scale)))
+    small = luma[::step, ::step]
+    vertices, counts, ok = parse_chunk(small[None])
+    if not ok[0]:
+        if report is not None:
+            report["failure"] = NO_CENTER_BLOB
+        return None
+    sh, sw = small.shape
+    frame = ParsedFrame((sw/2, sh/2), vertices[0, :counts[0]])
+    if step > 1:
+        frame = frame.scaled(float(w)/sw, float(h)/sh, (w/2, h/2))
+    return frame
+
+def parse_jpeg(path, reduction=4, scale=1.0, report=None):
+    """
+    Parse a JPEG file from a decode of its luminance at 1/reduction of its
+    size (see "source.read_jpeg_luma"), with the features scaled back to the
+    full size.  Returns a ParsedFrame object, or None.
+
+    scale  = fraction of the reduced size to parse at (see "parse_luma")
+    report = optional dict that receives the reason parsing failed
+    """
+    luma, (w, h) = read_jpeg_luma(path, reduction)
+    frame = parse_luma(luma, scale, report)
+    lh, lw = luma.shape
+    if not frame or (lw, lh) == (w, h):
+        return frame
+
+    # Map the pixel centers of the reduced image to the full image.
+    sx, sy = float(w)/lw, float(h)/lh
+    vertices = (frame.center_vertices + 0.5) * np.float32((sx, sy)) - 0.5
+
+    # Move each vertex out from the center by the larger inset.
+    center = np.float32((w/2, h/2))
+    offsets = vertices - center
+    lengths = np.sqrt((offsets**2).sum(axis=1))[:,None]
+    inset = EDGE_INSET * ((sx + sy) / 2 - 1)
+    vertices += offsets / np.maximum(lengths, 1) * inset
+    return ParsedFrame((w/2, h/2), vertices)
+
+def iter_chunks(frames, size=CHUNK_SIZE):
+    """
+    Group a stream of (index, BGR array) frames into (indices, stack) chunks
+    of the given size (the last one may be smaller).
+    """
+    indices = []
+    images = []
+    for i, img in frames:
+        indices.append(i)
+        images.append(img)
+        if len(images) == size:
+            yield indices, np.array(images)
+            indices, images = [], []
+    if images:
+        yield indices, np.array(images)
+
+def parse_frames(frames, size=CHUNK_SIZE):
+    """
+    Parse a stream of (index, BGR array) frames chunk by chunk.  Iterates
+    over (index, ParsedFrame or None).
+    """
+    for indices, stack in iter_chunks(frames, size):
+        h, w = stack.shape[1:3]
+        parsed = get_parsed_frames(*parse_chunk(stack) + ((w,h),))
+        for i, frame in zip(indices, parsed):
+            yield i, frame
+
+######################################################################
+# Benchmark against the per-frame path.
+
+def benchmark(frames, chunk):
+    """
+    Time parsing the given list of BGR arrays in chunks, one frame at a time
+    with the same parser, and with "parse_frame" if SimpleCV is available.
+    Returns the frames per second of each on this core.
+    """
+    results = {}
+    stack = np.array(frames)
+
+    start = timeit.default_timer()
+    for k in xrange(0, len(frames), chunk):
+        parse_chunk(stack[k:k+chunk])
+    results["chunked"] = len(frames) / (timeit.default_timer() - start)
+
+    start = timeit.default_timer()
+    for k in xrange(len(frames)):
+        parse_chunk(stack[k:k+1])
+    results["single"] = len(frames) / (timeit.default_timer() - start)
+
+    try:
+        import SimpleCV as scv
+    except ImportError:
+        return results
+    from parse import parse_frame
+    images = [scv.Image(img, cv2image=True) for img in frames]
+    start = timeit.default_timer()
+    for img in images:
+        parse_frame(img)
+    results["parse_frame"] = len(frames) / (timeit.default_timer() - start)
+    return results
+
+def write_jpeg_frames(directory, frames, quality=90):
+    """
+    Write the images of a stream of (image, SyntheticFrame) pairs as JPEG
+    files (named like the dumps of "unwrap_video").  Returns a list of
+    (path, SyntheticFrame) pairs.
+    """
+    from PIL import Image
+    files = []
+    for i, (img, frame) in enumerate(frames):
+        path = '%s/orig%04d.jpg' % (directory, i)
+        Image.fromarray(img[...,::-1]).save(path, quality=quality)
+        files.append((path, frame))
+    return files
+
+def benchmark_draft(files):
+    """
+    Time decoding and parsing the given JPEG files at full size in color (as
+    the frame loop decodes them), and from luminance decodes at each of the
+    DRAFT_REDUCTIONS.  The vertices are compared to the given SyntheticFrame
+    of each file, or to the ones parsed at full size.
+
+    files = list of (path, SyntheticFrame or None) pairs
+
+    Returns a dict of the results of each decode: milliseconds per frame,
+    failures, and the mean and max vertex error in full-size pixels.
+    """
+    from PIL import Image
+    from synthetic import get_vertex_error
+
+    def parse_full(path):
+        img = np.asarray(Image.open(path).convert('RGB'))
+        return parse_luma(get_gray(img[...,::-1]))
+
+    decodes = [('full', parse_full)]
+    for reduction in DRAFT_REDUCTIONS:
+        decodes.append(('1/%d' % reduction, lambda path, r=reduction: parse_jpeg(path, r)))
+
+    results = {}
+    reference = {}
+    for name, parse in decodes:
+        errors = []
+        failures = 0
+        elapsed = 0.0
+        for path, truth in files:
+            start = timeit.default_timer()
+            frame = parse(path)
+            elapsed += timeit.default_timer() - start
+            if name == 'full':
+                reference[path] = frame
+            if truth is not None:
+                expected = truth.get_vertices()
+            elif reference[path]:
+                expected = reference[path].center_vertices
+            else:
+                continue
+            if not frame:
+                failures += 1
+                continue
+            errors.append(get_vertex_error(expected, frame.center_vertices))
+        results[name] = {
+            "ms": elapsed / len(files) * 1000,
+            "failures": failures,
+            "mean_error": float(np.mean(errors)) if errors else None,
+            "max_error": float(np.max(errors)) if errors else None,
+        }
+    return results
+
+######################################################################
+
+import unittest
+
+from synthetic import SyntheticFrame, render_frame, generate_frames, measure_accuracy, get_vertex_error
+
+class TestBatchParse(unittest.TestCase):
+
+    def test_otsu(self):
+        """Assert that the threshold splits two levels of each frame."""
+        gray = np.zeros((2,10,10), np.uint8)
+        gray[0] = 40
+        gray[0,:5] = 200
+        gray[1] = 10
+        gray[1,:3] = 90
+        thresholds = get_otsu_thresholds(gray)
+        self.assertTrue(40 <= thresholds[0] < 200)
+        self.assertTrue(10 <= thresholds[1] < 90)
+
+    def test_erode(self):
+        mask = np.zeros((1,7,7), bool)
+        mask[0,1:6,1:6] = True
+        eroded = erode(mask)
+        self.assertEqual(eroded.sum(), 9)
+        self.assertTrue(eroded[0,2:5,2:5].all())
+
+    def test_hull(self):
+        points = [(0,0), (2,0), (1,1), (2,2), (0,2), (1,0)]
+        self.assertEqual(convex_hull(points), [(0,0), (2,0), (2,2), (0,2)])
+
+    def test_synthetic(self):
+        """Assert that synthetic frames are parsed accurately, both polarities."""
+        result = measure_accuracy(
+            lambda img: get_parsed_frames(*parse_chunk(img[None]) + ((320,240),))[0],
+            generate_frames(320, 240, 40, noise=0.3))
+        self.assertEqual(result["failures"], 0)
+        self.assertTrue(result["mean_error"] < 3.0)
+        self.assertTrue(result["wrong_count"] <= 2)
+
+    def test_chunks(self):
+        """Assert that chunked results match the ones of single frames."""
+        frames = [(i, img) for i, (img, frame) in enumerate(generate_frames(320, 240, 10))]
+        chunked = list(parse_frames(frames, size=4))
+        self.assertEqual([i for i, f in chunked], range(10))
+        for (i, img), (j, frame) in zip(frames, chunked):
+            vertices, counts, ok = parse_chunk(img[None])
+            self.assertTrue(ok[0])
+            self.assertTrue(np.allclose(vertices[0, :counts[0]], frame.center_vertices))
+
+    def test_luma(self):
+        """Assert that grayscale frames are parsed like their BGR frames."""
+        img = next(generate_frames(320, 240, 1))[0]
+        frame = parse_luma(get_gray(img))
+        vertices, counts, ok = parse_chunk(img[None])
+        self.assertTrue(np.allclose(vertices[0, :counts[0]], frame.center_vertices))
+        half = parse_luma(get_gray(img), scale=0.5)
+        self.assertEqual(half.center_point, (160, 120))
+        self.assertEqual(len(half.center_vertices), counts[0])
+
+        report = {}
+        self.assertEqual(parse_luma(np.zeros((120,160), np.uint8), report=report), None)
+        self.assertEqual(report["failure"], NO_CENTER_BLOB)
+
+    def test_jpeg(self):
+        """Assert that reduced JPEG decodes are parsed at the full scale."""
+        import tempfile
+        import shutil
+        try:
+            import PIL
+        except ImportError:
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            files = write_jpeg_frames(directory, generate_frames(320, 240, 3))
+            for path, truth in files:
+                frame = parse_jpeg(path, 2)
+                self.assertEqual(frame.center_point, (160, 120))
+                self.assertTrue(get_vertex_error(truth.get_vertices(), frame.center_vertices) < 4.0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_no_center(self):
+        """Assert that a frame without an enclosed center is not parsed."""
+        img = np.zeros((1,120,160,3), np.uint8)
+        vertices, counts, ok = parse_chunk(img)
+        self.assertFalse(ok[0])
+        self.assertEqual(counts[0], 0)
+
+if __name__ == "__main__":
+
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--benchmark', action='store_true', help='measure the throughput against the per-frame path')
+    parser.add_argument('--accuracy', action='store_true', help='measure the vertex error on synthetic frames')
+    parser.add_argument('--draft', metavar='IMAGES', nargs='?', const='', help='measure parsing reduced JPEG decodes of these images\n(a directory or pattern, default: synthetic frames)')
+    parser.add_argument('--size', metavar='WxH', default='1280x720', help='size of the synthetic frames (default 1280x720)')
+    parser.add_argument('--count', metavar='N', type=int, default=128, help='number of frames (default 128)')
+    parser.add_argument('--chunk', metavar='N', type=int, default=CHUNK_SIZE, help='frames per chunk (default %d)' % CHUNK_SIZE)
+    args = parser.parse_args()
+
+    w,h = map(int, args.size.split('x'))
+    if args.benchmark:
+        frames = [img for img, frame in generate_frames(w, h, args.count)]
+        results = benchmark(frames, args.chunk)
+        print '%-12s %9s' % ('path', 'fps/core')
+        for path in ('parse_frame', 'single', 'chunked'):
+            if path in results:
+                print '%-12s %9.1f' % (path, results[path])
+    elif args.draft is not None:
+        import tempfile
+        import shutil
+        from source import list_image_sequence
+        directory = None
+        if args.draft:
+            files = [(path, None) for path in list_image_sequence(args.draft)[:args.count]]
+        else:
+            directory = tempfile.mkdtemp()
+            files = write_jpeg_frames(directory, generate_frames(w, h, args.count))
+        try:
+            results = benchmark_draft(files)
+        finally:
+            if directory:
+                shutil.rmtree(directory)
+        print '%-8s %9s %9s %11s %10s' % ('decode', 'ms/frame', 'failures', 'mean error', 'max error')
+        for name in ['full'] + ['1/%d' % r for r in DRAFT_REDUCTIONS]:
+            r = results[name]
+            print '%-8s %9.2f %9d %11s %10s' % (name, r["ms"], r["failures"],
+                '%.2f' % r["mean_error"] if r["mean_error"] is not None else '-',
+                '%.2f' % r["max_error"] if r["max_error"] is not None else '-')
+    elif args.accuracy:
+        frames = list(generate_frames(w, h, args.count))
+        result = measure_accuracy(lambda img: get_parsed_frames(*parse_chunk(img[None]) + ((w,h),))[0], frames)
+        print json.dumps(result, indent=2)
+    else:
+        # Run the unit tests.
+        unittest.main(argv=[__file__])
@@ -0,0 +1,333 @@
+"""
+Keeps track of the progress of a long dump of unwrapped frames, so that an
+interrupted dump can be resumed instead of started over.
+
+The progress is kept in a small manifest file in the dump directory, which is
+replaced atomically (written to a temporary file and renamed) so that it is
+never left half written, even when the process is killed while saving it.
+
+When resuming, the frames after the last one recorded in the manifest are
+checked by their files' sizes and headers (JPEG markers, or the size recorded
+in the header of palette coded frames) instead of being decoded or rendered
+again, to find the first missing or incomplete frame.
+
+See unit tests at the end of this file.
+"""
+
+import os
+import re
+import json
+import time
+import signal
+
+from codec import HEADER_SIZE, get_encoded_size
+
+MANIFEST_NAME = 'progress.json'
+MANIFEST_VERSION = 1
+
+# the files dumped for each frame
+DUMP_PREFIXES = ('orig', 'unwrap')
+
+# JPEG files start with the SOI marker and end with the EOI marker.
+JPEG_START = '\xff\xd8'
+JPEG_END = '\xff\xd9'
+
+def get_dump_path(dump_dir, prefix, i, ext='jpg'):
+    """Get the path of the given dumped file of the i-th frame."""
+    return "%s/%s%04d.%s" % (dump_dir, prefix, i, ext)
+
+def write_json_atomic(path, data):
+    """
+    Write the data as JSON to the given path, replacing the previous file
+    only once the new one is completely written.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def is_complete_jpeg(path):
+    """
+    Determines if the file at the given path is a complete JPEG image, by
+    checking only its size and its first and last two bytes.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(2) != JPEG_START:
+                return False
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == JPEG_END
+    except (IOError, OSError):
+        # (also raised when seeking before the start of a tiny file)
+        return False
+
+def is_complete_palette(path):
+    """
+    Determines if the file at the given path is a complete palette coded
+    frame (see "codec.py"), by comparing its size to the one in its header.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        return len(header) == HEADER_SIZE and get_encoded_size(header) == os.path.getsize(path)
+    except (IOError, OSError):
+        return False
+
+# the check of a complete file for each extension of the dumped files
+COMPLETE_CHECKS = {
+    'jpg': is_complete_jpeg,
+    'shxp': is_complete_palette,
+}
+
+def is_frame_dumped(dump_dir, i, ext='jpg'):
+    """Determines if every file of the i-th frame was completely dumped."""
+    is_complete = COMPLETE_CHECKS[ext]
+    for prefix in DUMP_PREFIXES:
+        if not is_complete(get_dump_path(dump_dir, prefix, i, ext)):
+            return False
+    return True
+
+def get_last_dumped_frame(dump_dir, ext='jpg'):
+    """
+    Get the highest frame index of the files in the dump directory (complete
+    or not), or -1 if there are none.
+    """
+    pattern = re.compile(r'^(%s)(\d+)\.%s$' % ('|'.join(DUMP_PREFIXES), re.escape(ext)))
+    last = -1
+    for name in os.listdir(dump_dir):
+        match = pattern.match(name)
+        if match:
+            last = max(last, int(match.group(2)))
+    return last
+
+def find_resume_frame(dump_dir, indices, ext='jpg', count=None, last=None):
+    """
+    Get the first of the given frame indices whose files are missing or
+    incomplete, or None if all of them were dumped.
+
+    count = number of frames in the video, if known (the indices of an
+            open-ended selection never end, so they are only searched up to
+            the end of the video)
+    last  = highest index of a dumped frame (see "get_last_dumped_frame"), if
+            known, so that the search ends at the first index after it
+            without checking files that cannot be there
+    """
+    for i in indices:
+        if count is not None and i >= count:
+            break
+        if last is not None and i > last:
+            return i
+        if not is_frame_dumped(dump_dir, i, ext):
+            return i
+    return None
+
+class ProgressManifest:
+    """
+    The progress of a dump: the options it was started with, the frames that
+    are done and their crop rectangles.
+    """
+
+    def __init__(self, dump_dir, video_key, options, flush_interval=2.0):
+        """
+        dump_dir       = directory the frames are dumped in
+        video_key      = hash of the video content (see "get_video_key")
+        options        = dict of the options that affect the dumped frames
+                         (a dump can only be resumed with the same options)
+        flush_interval = min number of seconds between automatic saves
+        """
+        self.path = os.path.join(dump_dir, MANIFEST_NAME)
+        self.video_key = video_key
+        self.options = options
+        self.flush_interval = flush_interval
+
+        # index of the last dumped frame (-1 if none)
+        self.last_frame = -1
+
+        # crop rectangles of the dumped frames by index
+        self.crops = {}
+
+        # whether every selected frame was dumped
+        self.complete = False
+
+        # height of the clip's crop (see "get_clip_extent")
+        self.clip_extent = None
+
+        self.last_flush = time.time()
+
+    @staticmethod
+    def load(dump_dir):
+        """Load the manifest of the given dump directory, or None if missing."""
+        path = os.path.join(dump_dir, MANIFEST_NAME)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+        manifest = ProgressManifest(dump_dir, data["video_key"], data["options"])
+        manifest.last_frame = data["last_frame"]
+        manifest.crops = dict((int(k), v) for k,v in data["crops"].iteritems())
+        manifest.complete = data["complete"]
+        manifest.clip_extent = data["clip_extent"]
+        return manifest
+
+    def matches(self, video_key, options):
+        """Determines if the manifest belongs to the same video and options."""
+        # (compare through JSON since tuples are loaded as lists)
+        return (self.video_key == video_key and
+            json.loads(json.dumps(options)) == self.options)
+
+    def mark_done(self, i, crop=None):
+        """
+        Record that the files of the i-th frame were dumped, and save the
+        manifest if it was not saved recently.
+        """
+        self.last_frame = max(self.last_frame, i)
+        if crop:
+            self.crops[i] = crop
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def resume_at(self, i):
+        """
+        Record that the frames before the i-th one are done, and forget the
+        crops of the others (which are dumped again).
+        """
+        for k in [k for k in self.crops if k >= i]:
+            del self.crops[k]
+        self.last_frame = i - 1
+        self.complete = False
+
+    def flush(self):
+        """Save the manifest."""
+        write_json_atomic(self.path, {
+            "version": MANIFEST_VERSION,
+            "video_key": self.video_key,
+            "options": self.options,
+            "last_frame": self.last_frame,
+            "crops": dict((str(k),v) for k,v in self.crops.iteritems()),
+            "complete": self.complete,
+            "clip_extent": self.clip_extent,
+        })
+        self.last_flush = time.time()
+
+class StopSignals:
+    """
+    Catches SIGINT and SIGTERM while active, so that the current frame can be
+    finished and the progress saved before stopping.  A second signal stops
+    immediately.
+
+        with StopSignals() as stop:
+            while not stop.requested:
+                ...
+    """
+
+    def __init__(self, signums=(signal.SIGINT, signal.SIGTERM)):
+        self.signums = signums
+        self.previous = {}
+
+        # the signal that requested the stop, or None
+        self.requested = None
+
+    def handle(self, signum, frame):
+        if self.requested:
+            raise KeyboardInterrupt()
+        self.requested = signum
+
+    def __enter__(self):
+        for signum in self.signums:
+            try:
+                self.previous[signum] = signal.signal(signum, self.handle)
+            except ValueError:
+                # Signals can only be caught in the main thread.
+                pass
+        return self
+
+    def __exit__(self, *exc_info):
+        for signum, handler in self.previous.iteritems():
+            signal.signal(signum, handler)
+        self.previous = {}
+
+######################################################################
+
+import unittest
+import tempfile
+import itertools
+import shutil
+
+import numpy as np
+from codec import encode_frame
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def dump(self, i, data=JPEG_START + 'image' + JPEG_END):
+        for prefix in DUMP_PREFIXES:
+            with open(get_dump_path(self.dir, prefix, i), 'wb') as f:
+                f.write(data)
+
+    def test_resume_frame(self):
+        """Assert that resuming starts at the first missing or truncated frame."""
+        for i in xrange(5):
+            self.dump(i)
+        self.dump(5, JPEG_START + 'truncat')
+        self.assertEqual(find_resume_frame(self.dir, xrange(10)), 5)
+        self.assertEqual(find_resume_frame(self.dir, xrange(0,10,2)), 6)
+        self.assertEqual(find_resume_frame(self.dir, xrange(3)), None)
+
+    def test_resume_open_ended(self):
+        """Assert that endless indices are only searched up to the frame count."""
+        for i in xrange(5):
+            self.dump(i)
+        self.assertEqual(find_resume_frame(self.dir, itertools.count(), count=5), None)
+        self.assertEqual(find_resume_frame(self.dir, itertools.count(), count=8), 5)
+        last = get_last_dumped_frame(self.dir)
+        self.assertEqual(last, 4)
+        self.assertEqual(find_resume_frame(self.dir, itertools.count(), last=last), 5)
+        self.assertEqual(get_last_dumped_frame(self.dir, 'shxp'), -1)
+
+    def test_resume_palette(self):
+        """Assert that truncated palette coded frames are found."""
+        data = encode_frame(np.zeros((4,4,3), np.uint8))
+        for i, frame_data in enumerate([data, data, data[:-1]]):
+            for prefix in DUMP_PREFIXES:
+                with open(get_dump_path(self.dir, prefix, i, 'shxp'), 'wb') as f:
+                    f.write(frame_data)
+        self.assertEqual(find_resume_frame(self.dir, xrange(10), 'shxp'), 2)
+
+    def test_manifest(self):
+        """Assert that the manifest is saved and loaded unchanged."""
+        options = {"ranges": [(0,-1)], "stride": 2}
+        manifest = ProgressManifest(self.dir, 'key', options)
+        manifest.mark_done(0, (0,10,20,30))
+        manifest.mark_done(2)
+        manifest.flush()
+        self.assertFalse(os.path.exists(manifest.path + '.tmp'))
+
+        loaded = ProgressManifest.load(self.dir)
+        self.assertEqual(loaded.last_frame, 2)
+        self.assertEqual(loaded.crops, {0: [0,10,20,30]})
+        self.assertTrue(loaded.matches('key', options))
+        self.assertFalse(loaded.matches('key', {"ranges": [(0,-1)], "stride": 3}))
+
+        loaded.resume_at(0)
+        self.assertEqual((loaded.last_frame, loaded.crops), (-1, {}))
+        self.assertEqual(ProgressManifest.load(tempfile.gettempdir() + '/missing'), None)
+
+    def test_stop_signals(self):
+        """Assert that a signal is recorded instead of stopping the process."""
+        with StopSignals((signal.SIGUSR1,)) as stop:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertEqual(stop.requested, signal.SIGUSR1)
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), signal.SIG_DFL)
+
+if __name__ == "__main__":
+    unittest.main()
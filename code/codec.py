@@ -0,0 +1,463 @@
+"""
+A lossless frame codec for Super Hexagon's flat colors: the palette index of
+each pixel in a palette of the exact colors of the frame is run-length encoded
+along its rows or columns, so that frames of few colors (such as rendered or
+synthetic frames) are small, and the hard edges of the walls are never blurred
+like they are by JPEG.  Frames of more colors than a palette can hold (such as
+decoded video) are stored as zlib-compressed differences of adjacent pixels
+(like PNG), which is much larger than JPEG for them, unless the encoder is
+allowed to quantize them to a small palette instead ("lossy").
+
+A stream of frames can also be delta coded: pixels that keep the color of the
+previous frame are marked with a reserved index, so that still areas become
+long runs.
+
+Everything is vectorized with NumPy, so a frame is encoded and decoded in a
+few passes over its pixels.
+
+Encoded frame layout (little endian):
+
+    header   (see HEADER_FORMAT)
+    palette  uint8  [colors][3]       (BGR)
+    values   uint8  [runs]            (palette index, or SAME for delta)
+    lengths  uint16 [runs]            (pixels in each run)
+
+or, for frames with the PIXELS flag:
+
+    header   (see HEADER_FORMAT, with no colors, and the size of the
+              compressed pixels instead of the runs)
+    pixels   zlib compressed uint8 [height][width][3]
+                                      (BGR differences to the pixel on the
+                                       left, modulo 256)
+
+    Compare the size and speed to JPEG and PNG (requires OpenCV):
+    > python codec.py --benchmark ../vid/trailer.mp4
+
+See unit tests at the end of this file.
+"""
+
+import struct
+import timeit
+import zlib
+
+import numpy as np
+
+MAGIC = 'SHXP'
+FORMAT_VERSION = 2
+
+# magic, version, flags, width, height, palette colors, runs
+HEADER_FORMAT = '<4sBBHHHI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# flags
+COLUMNS = 1     # runs go down the columns instead of along the rows
+DELTA = 2       # coded against the previous frame
+PIXELS = 4      # compressed pixels (too many colors for a palette)
+
+# palette index of a pixel with the same color as in the previous frame
+SAME = 255
+MAX_COLORS = 255
+
+# longest run stored in one length
+MAX_RUN = 0xffff
+
+# bits kept of each color channel when choosing the palette
+PALETTE_BITS = 5
+
+# refinements of the palette of a frame with more colors than it can hold
+PALETTE_ITERATIONS = 4
+
+# zlib level of the frames that are stored as pixels (higher levels take about
+# twice as long for a tenth smaller frames)
+ZLIB_LEVEL = 1
+
+def pack_colors(img, bits=8):
+    """Pack the top bits of each BGR pixel into one integer per pixel."""
+    img = img.reshape(-1,3)
+    shift = 8 - bits
+    b = (img[:,0] >> shift).astype(np.uint32)
+    g = (img[:,1] >> shift).astype(np.uint32)
+    r = (img[:,2] >> shift).astype(np.uint32)
+    return (b << (2*bits)) | (g << bits) | r
+
+def get_palette(img, colors=16):
+    """
+    Choose a palette of at most the given number of colors for an image, and
+    map each pixel to its nearest palette color.
+
+    Returns (palette, indices) where:
+        palette = (n,3) uint8 array of BGR colors
+        indices = flat uint8 array of the palette index of each pixel
+    """
+    bits = PALETTE_BITS
+    bins = pack_colors(img, bits)
+    counts = np.bincount(bins, minlength=1 << (3*bits))
+    used = np.flatnonzero(counts)
+    weights = counts[used]
+
+    # exact mean color of each used bin
+    flat = img.reshape(-1,3)
+    means = np.column_stack([np.bincount(bins, flat[:,c], minlength=len(counts))[used] for c in xrange(3)])
+    means /= weights[:,None]
+
+    if len(used) <= colors:
+        # Every bin gets its own color (lossless if each bin holds one color).
+        assignment = np.arange(len(used))
+        palette = means
+    else:
+        # Start from the most common bins that are not too close to a more
+        # common one, then refine the palette like k-means.
+        order = np.argsort(weights)[::-1]
+        chosen = []
+        min_dist = (2 << (8 - bits))**2
+        for k in order:
+            if all(((means[k] - means[j])**2).sum() >= min_dist for j in chosen):
+                chosen.append(k)
+                if len(chosen) == colors:
+                    break
+        palette = means[chosen]
+        for n in xrange(PALETTE_ITERATIONS):
+            dist = ((means[:,None,:] - palette[None,:,:])**2).sum(axis=2)
+            assignment = dist.argmin(axis=1)
+            for c in xrange(3):
+                sums = np.bincount(assignment, means[:,c] * weights, len(palette))
+                total = np.bincount(assignment, weights, len(palette))
+                palette[:,c] = np.where(total > 0, sums / np.maximum(total, 1), palette[:,c])
+        dist = ((means[:,None,:] - palette[None,:,:])**2).sum(axis=2)
+        assignment = dist.argmin(axis=1)
+
+    # Map every bin to its palette color.
+    lut = np.zeros(len(counts), np.uint8)
+    lut[used] = assignment
+    return np.round(palette).astype(np.uint8), lut[bins]
+
+def get_exact_palette(img, colors=MAX_COLORS):
+    """
+    Get the palette of the exact colors of an image, like "get_palette", or
+    None if the image has more than the given number of colors.
+    """
+    # (Images of too many colors are mostly rejected from their color bins,
+    # which are cheaper to count than the exact colors.)
+    bins = pack_colors(img, PALETTE_BITS)
+    if np.count_nonzero(np.bincount(bins, minlength=1 << (3*PALETTE_BITS))) > colors:
+        return None
+    values, indices = np.unique(pack_colors(img), return_inverse=True)
+    if len(values) > colors:
+        return None
+    palette = np.column_stack((values >> 16, values >> 8, values)) & 0xff
+    return palette.astype(np.uint8), indices.astype(np.uint8)
+
+def encode_runs(flat):
+    """Run-length encode a flat array into (values, lengths) arrays."""
+    n = len(flat)
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.concatenate((starts, [n])))
+    values = flat[starts]
+
+    # Split the runs that are too long for one length.
+    pieces = (lengths + MAX_RUN - 1) // MAX_RUN
+    if (pieces > 1).any():
+        values = np.repeat(values, pieces)
+        ends = np.cumsum(pieces) - 1
+        split = np.full(len(values), MAX_RUN, np.int64)
+        split[ends] = lengths - MAX_RUN * (pieces - 1)
+        lengths = split
+    return values.astype(np.uint8), lengths.astype('<u2')
+
+def count_runs(indices):
+    """Count the runs of a 2D array of indices along its rows."""
+    flat = indices.ravel()
+    return 1 + np.count_nonzero(flat[1:] != flat[:-1])
+
+class FrameEncoder:
+    """
+    Encodes a stream of frames, delta coding each one against the previous
+    one (as decoded, so that errors do not build up).
+    """
+
+    def __init__(self, colors=16, delta=True, axis=None, lossy=False):
+        """
+        colors = max number of colors in the palette of each lossy frame (up
+                 to 255, while lossless frames use up to MAX_COLORS exact
+                 colors)
+        delta  = code each frame against the previous one
+        axis   = 'rows' or 'columns' to run along, or None to pick the one
+                 with fewer runs for each frame
+        lossy  = map the colors of every frame to a palette of the given
+                 number of colors, instead of storing the frames of more
+                 colors than MAX_COLORS as compressed pixels
+        """
+        self.colors = min(colors, MAX_COLORS)
+        self.delta = delta
+        self.axis = axis
+        self.lossy = lossy
+        self.previous = None
+
+    def encode(self, img):
+        """Encode a (height,width,3) BGR array into a string."""
+        h,w = img.shape[:2]
+        if self.lossy:
+            palette, indices = get_palette(img, self.colors)
+        else:
+            exact = get_exact_palette(img)
+            if exact is None:
+                return self.encode_pixels(img)
+            palette, indices = exact
+        decoded = palette[indices].reshape(h,w,3)
+        indices = indices.reshape(h,w)
+
+        flags = 0
+        if self.delta and self.previous is not None and self.previous.shape == decoded.shape:
+            same = (decoded == self.previous).all(axis=2)
+            indices = np.where(same, SAME, indices).astype(np.uint8)
+            flags |= DELTA
+        if self.delta:
+            self.previous = decoded
+
+        columns = self.axis == 'columns'
+        if self.axis is None:
+            columns = count_runs(indices.T) < count_runs(indices)
+        if columns:
+            indices = indices.T
+            flags |= COLUMNS
+
+        values, lengths = encode_runs(np.ascontiguousarray(indices).ravel())
+        header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, flags, w, h, len(palette), len(values))
+        return header + palette.tostring() + values.tostring() + lengths.tostring()
+
+    def encode_pixels(self, img):
+        """Encode a frame of too many colors for a palette as pixels."""
+        h,w = img.shape[:2]
+        if self.delta:
+            self.previous = img.copy()
+        diff = img.copy()
+        diff[:,1:] -= img[:,:-1]
+        data = zlib.compress(diff.tostring(), ZLIB_LEVEL)
+        header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, PIXELS, w, h, 0, len(data))
+        return header + data
+
+class FrameDecoder:
+    """
+    Decodes a stream of frames made by a FrameEncoder.
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def decode(self, data):
+        """Decode a string into a (height,width,3) BGR array."""
+        magic, version, flags, w, h, colors, runs = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        if magic != MAGIC or not 1 <= version <= FORMAT_VERSION:
+            raise ValueError('not a frame of codec version %d' % FORMAT_VERSION)
+        offset = HEADER_SIZE
+        if flags & PIXELS:
+            diff = np.frombuffer(zlib.decompress(data[offset:offset+runs]), np.uint8)
+            img = np.cumsum(diff.reshape(h,w,3), axis=1, dtype=np.uint8)
+            self.previous = img
+            return img
+        palette = np.frombuffer(data, np.uint8, colors*3, offset).reshape(-1,3)
+        offset += colors*3
+        values = np.frombuffer(data, np.uint8, runs, offset)
+        offset += runs
+        lengths = np.frombuffer(data, '<u2', runs, offset)
+
+        indices = np.repeat(values, lengths)
+        if flags & COLUMNS:
+            indices = indices.reshape(w,h).T
+        else:
+            indices = indices.reshape(h,w)
+
+        if flags & DELTA:
+            same = indices == SAME
+            img = palette[np.where(same, 0, indices)]
+            img[same] = self.previous[same]
+        else:
+            img = palette[indices]
+        self.previous = img
+        return img
+
+def get_encoded_size(header):
+    """
+    Get the size of an encoded frame from its header, so that a truncated
+    frame file can be detected without decoding it.
+    """
+    magic, version, flags, w, h, colors, runs = struct.unpack(HEADER_FORMAT, header[:HEADER_SIZE])
+    if magic != MAGIC:
+        return None
+    if flags & PIXELS:
+        return HEADER_SIZE + runs
+    return HEADER_SIZE + colors*3 + runs*3
+
+def encode_frame(img, colors=16, lossy=False):
+    """Encode a single frame (without delta coding)."""
+    return FrameEncoder(colors, delta=False, lossy=lossy).encode(img)
+
+def decode_frame(data):
+    """Decode a single frame (without delta coding)."""
+    return FrameDecoder().decode(data)
+
+######################################################################
+# Benchmark against JPEG and PNG.
+
+def read_benchmark_frames(paths, count):
+    """
+    Read up to the given number of frames from the given video or image
+    files, or generate synthetic frames if none are given.
+    """
+    import cv2
+    frames = []
+    for path in paths:
+        if path.lower().endswith(('.jpg', '.jpeg', '.png')):
+            frames.append(cv2.imread(path))
+            continue
+        video = cv2.VideoCapture(path)
+        while len(frames) < count:
+            ok, img = video.read()
+            if not ok:
+                break
+            frames.append(img)
+    if not frames:
+        from synthetic import generate_frames
+        frames = [img for img, frame in generate_frames(1280, 720, count)]
+    return frames[:count]
+
+def benchmark(frames, colors=16):
+    """
+    Compare the mean size, encode and decode times and error of the codec
+    (with and without delta coding, and quantized to the palette) to JPEG and
+    PNG on the given frames.
+    """
+    import cv2
+    timer = timeit.default_timer
+
+    def measure(encode, decode):
+        size = encode_time = decode_time = error = 0.0
+        for img in frames:
+            start = timer()
+            data = encode(img)
+            encode_time += timer() - start
+            start = timer()
+            out = decode(data)
+            decode_time += timer() - start
+            size += len(data)
+            error += np.abs(out.astype(np.int16) - img).mean()
+        n = len(frames)
+        return {
+            "kb": size / n / 1024,
+            "encode_ms": encode_time / n * 1000,
+            "decode_ms": decode_time / n * 1000,
+            "mean_error": error / n,
+        }
+
+    results = {}
+    results["jpeg"] = measure(
+        lambda img: cv2.imencode('.jpg', img)[1].tostring(),
+        lambda data: cv2.imdecode(np.frombuffer(data, np.uint8), 1))
+    results["png"] = measure(
+        lambda img: cv2.imencode('.png', img)[1].tostring(),
+        lambda data: cv2.imdecode(np.frombuffer(data, np.uint8), 1))
+    results["palette"] = measure(lambda img: encode_frame(img, colors), decode_frame)
+    encoder = FrameEncoder(colors)
+    decoder = FrameDecoder()
+    results["palette+delta"] = measure(encoder.encode, decoder.decode)
+    results["palette-lossy"] = measure(lambda img: encode_frame(img, colors, lossy=True), decode_frame)
+    return results
+
+######################################################################
+
+import unittest
+
+def make_frame(shift=0):
+    """A frame of a few flat colors with straight edges."""
+    img = np.zeros((60,80,3), np.uint8)
+    img[:] = (40,20,10)
+    img[10+shift:30+shift, :] = (200,180,20)
+    img[:, 50:55] = (255,255,255)
+    return img
+
+class TestCodec(unittest.TestCase):
+
+    def test_lossless(self):
+        """Assert that frames of few colors are decoded exactly."""
+        img = make_frame()
+        for axis in ('rows', 'columns', None):
+            data = FrameEncoder(delta=False, axis=axis).encode(img)
+            self.assertTrue((decode_frame(data) == img).all())
+            self.assertEqual(get_encoded_size(data), len(data))
+
+    def test_delta(self):
+        """Assert that delta coded frames decode exactly and shrink."""
+        encoder = FrameEncoder()
+        decoder = FrameDecoder()
+        first = encoder.encode(make_frame(0))
+        second = encoder.encode(make_frame(1))
+        self.assertTrue((decoder.decode(first) == make_frame(0)).all())
+        self.assertTrue((decoder.decode(second) == make_frame(1)).all())
+        self.assertLess(len(second), len(encode_frame(make_frame(1))))
+
+    def test_long_runs(self):
+        """Assert that runs longer than one length can hold are split."""
+        img = np.zeros((400,400,3), np.uint8)
+        data = encode_frame(img)
+        self.assertTrue((decode_frame(data) == img).all())
+
+    def test_quantize(self):
+        """Assert that a noisy frame is mapped to its nearest flat colors."""
+        img = make_frame().astype(np.int16)
+        noise = np.random.RandomState(0).randint(-3, 4, img.shape)
+        noisy = np.clip(img + noise, 0, 255).astype(np.uint8)
+        out = decode_frame(encode_frame(noisy, colors=3, lossy=True))
+        self.assertLess(np.abs(out.astype(np.int16) - img).max(), 8)
+
+    def test_exact_palette(self):
+        """Assert that frames of up to MAX_COLORS colors are run-length coded."""
+        img = np.zeros((60,80,3), np.uint8)
+        img[:,:,0] = np.arange(80)
+        img[:,:,1] = np.arange(80) * 3
+        data = encode_frame(img)
+        header = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+        self.assertEqual(header[2] & PIXELS, 0)
+        self.assertEqual(header[5], 80)
+        self.assertTrue((decode_frame(data) == img).all())
+
+    def test_pixels(self):
+        """Assert that frames of too many colors are compressed without loss."""
+        noisy = np.random.RandomState(0).randint(0, 256, (60,80,3)).astype(np.uint8)
+        data = encode_frame(noisy)
+        self.assertTrue((decode_frame(data) == noisy).all())
+        self.assertEqual(get_encoded_size(data), len(data))
+
+        gradient = np.zeros((60,80,3), np.uint8)
+        gradient[:] = np.arange(80)[:,None] * 3
+        gradient[:,:,1] = np.arange(60)[:,None] * 4
+        data = encode_frame(gradient)
+        self.assertTrue((decode_frame(data) == gradient).all())
+        self.assertLess(len(data), gradient.nbytes / 10)
+
+        encoder = FrameEncoder()
+        decoder = FrameDecoder()
+        for img in (make_frame(0), noisy, make_frame(1)):
+            self.assertTrue((decoder.decode(encoder.encode(img)) == img).all())
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('files', nargs='*', help='videos or images to benchmark with\n(default: synthetic frames)')
+    parser.add_argument('--benchmark', action='store_true', help='compare the size and speed to JPEG and PNG')
+    parser.add_argument('--count', metavar='N', type=int, default=60, help='number of frames (default 60)')
+    parser.add_argument('--colors', metavar='N', type=int, default=16, help='max colors per frame (default 16)')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        frames = read_benchmark_frames(args.files, args.count)
+        results = benchmark(frames, args.colors)
+        print '%-14s %9s %10s %10s %10s' % ('codec', 'KB', 'encode ms', 'decode ms', 'mean error')
+        for name in ('jpeg', 'png', 'palette', 'palette+delta', 'palette-lossy'):
+            r = results[name]
+            print '%-14s %9.1f %10.2f %10.2f %10.2f' % (name, r["kb"], r["encode_ms"], r["decode_ms"], r["mean_error"])
+    else:
+        # Run the unit tests.
+        unittest.main(argv=[__file__])
@@ -0,0 +1,195 @@
+"""
+Converts decoded frames to 8 bits per pixel right after decoding, so that
+parsing, texture upload and readback move a third of the bytes of BGR frames.
+
+Parsing only needs the luminance of a frame, and the game draws flat colors, so
+a frame is also well described by a palette and the palette index of each
+pixel.  The color modes are:
+
+    rgb       = BGR everywhere (the original path)
+    lossless  = luminance for parsing, BGR kept only for the unwrapped output
+    gray      = luminance for parsing, unwrapping and output
+    palette   = palette indices for unwrapping (the unwrap shader looks up
+                the colors), and their luminance for parsing
+
+The palette of a stream is kept while its colors fit it, and chosen again
+(see "codec.get_palette") once too many pixels have colors that were not seen
+when it was chosen, e.g. when the game rotates its hues.
+
+See unit tests at the end of this file.
+"""
+
+import numpy as np
+
+from batchparse import get_gray
+from codec import get_palette, pack_colors, PALETTE_BITS
+
+COLOR_MODES = ('rgb', 'lossless', 'gray', 'palette')
+
+# default number of palette colors (the flat colors of the game, and enough
+# shades between them for their anti-aliased and compressed edges)
+PALETTE_COLORS = 64
+
+# palette entries uploaded for the unwrap shader (one per 8-bit index)
+PALETTE_SIZE = 256
+
+# Every Nth pixel is checked for colors that do not fit the palette.
+CHECK_STEP = 16
+
+# number of color bins whose nearest palette color is found at once
+LUT_CHUNK = 4096
+
+def get_nearest_lut(palette, bits=PALETTE_BITS):
+    """
+    Get the index of the nearest palette color of every packed color bin
+    (see "codec.pack_colors").
+    """
+    bins = np.arange(1 << (3*bits))
+    mask = (1 << bits) - 1
+    shift = 8 - bits
+    half = 1 << shift >> 1
+    centers = np.column_stack((
+        ((bins >> (2*bits)) & mask) << shift,
+        ((bins >> bits) & mask) << shift,
+        (bins & mask) << shift)).astype(np.float32) + half
+    colors = palette.astype(np.float32)
+    lut = np.empty(len(bins), np.uint8)
+    for start in xrange(0, len(bins), LUT_CHUNK):
+        block = centers[start:start+LUT_CHUNK]
+        dist = ((block[:,None,:] - colors[None,:,:])**2).sum(axis=2)
+        lut[start:start+LUT_CHUNK] = dist.argmin(axis=1)
+    return lut
+
+class PaletteMapper:
+    """
+    Maps the frames of a stream to the indices of a shared palette.
+    """
+
+    def __init__(self, colors=PALETTE_COLORS, refit=0.01):
+        """
+        colors = max number of colors in the palette (up to 256)
+        refit  = fraction of pixels whose colors were not seen when the
+                 palette was chosen before it is chosen again
+        """
+        self.colors = min(colors, PALETTE_SIZE)
+        self.refit = refit
+
+        # (PALETTE_SIZE,3) BGR colors, and the luminance of each
+        self.palette = None
+        self.luma = None
+
+        # palette index of each color bin, and the bins seen when fitting
+        self.lut = None
+        self.seen = None
+
+        # number of times the palette was chosen
+        self.fits = 0
+
+    def fit(self, img, bins):
+        """Choose the palette for the given BGR image (and its color bins)."""
+        colors, indices = get_palette(img, self.colors)
+        self.palette = np.zeros((PALETTE_SIZE,3), np.uint8)
+        self.palette[:len(colors)] = colors
+        self.luma = get_gray(self.palette)
+        self.lut = get_nearest_lut(colors)
+        self.seen = np.bincount(bins, minlength=len(self.lut)) > 0
+        self.fits += 1
+
+    def map(self, img):
+        """
+        Get the (height,width) uint8 palette indices of a BGR image, choosing
+        the palette again if the image does not fit it.
+        """
+        h, w = img.shape[:2]
+        bins = pack_colors(img, PALETTE_BITS)
+        if self.lut is None or 1.0 - self.seen[bins[::CHECK_STEP]].mean() > self.refit:
+            self.fit(img, bins)
+        return self.lut[bins].reshape(h, w)
+
+class FrameConverter:
+    """
+    Converts decoded BGR frames for one of the COLOR_MODES.
+    """
+
+    def __init__(self, mode, colors=PALETTE_COLORS):
+        if mode not in COLOR_MODES:
+            raise ValueError('unknown color mode "%s"' % mode)
+        self.mode = mode
+        self.mapper = PaletteMapper(colors) if mode == 'palette' else None
+
+    def convert(self, img):
+        """
+        Convert a decoded (height,width,3) BGR array.  Returns a tuple of:
+
+            luma    = (height,width) uint8 grayscale to parse (None in 'rgb'
+                      mode, which parses the decoded image)
+            texture = array to upload for unwrapping: the BGR image, its
+                      luminance, or its palette indices
+            palette = (PALETTE_SIZE,3) BGR colors of the indices ('palette'
+                      mode only, else None)
+        """
+        if self.mode == 'rgb':
+            return None, img, None
+        if self.mode == 'palette':
+            indices = self.mapper.map(img)
+            return self.mapper.luma[indices], indices, self.mapper.palette
+        luma = get_gray(img)
+        if self.mode == 'lossless':
+            return luma, img, None
+        return luma, luma, None
+
+######################################################################
+
+import unittest
+
+def make_frame(color=(200,180,20)):
+    """A frame of a few flat colors."""
+    img = np.zeros((60,80,3), np.uint8)
+    img[:] = (40,20,10)
+    img[10:30, :] = color
+    img[:, 50:55] = (255,255,255)
+    return img
+
+class TestColorMode(unittest.TestCase):
+
+    def test_palette(self):
+        """Assert that frames of few colors are mapped without loss."""
+        mapper = PaletteMapper()
+        img = make_frame()
+        indices = mapper.map(img)
+        self.assertEqual(indices.shape, (60,80))
+        self.assertTrue((mapper.palette[indices] == img).all())
+        self.assertEqual(mapper.luma[indices].tolist(), get_gray(img).tolist())
+
+    def test_refit(self):
+        """Assert that the palette is only chosen again for new colors."""
+        mapper = PaletteMapper()
+        mapper.map(make_frame())
+        mapper.map(make_frame())
+        self.assertEqual(mapper.fits, 1)
+        img = make_frame((20,180,200))
+        indices = mapper.map(img)
+        self.assertEqual(mapper.fits, 2)
+        self.assertTrue((mapper.palette[indices] == img).all())
+
+    def test_nearest(self):
+        """Assert that colors that were not seen map to the nearest color."""
+        mapper = PaletteMapper(refit=1.0)
+        mapper.map(make_frame())
+        img = np.full((2,2,3), 250, np.uint8)
+        self.assertEqual(mapper.palette[mapper.map(img)[0,0]].tolist(), [255,255,255])
+
+    def test_modes(self):
+        img = make_frame()
+        for mode in COLOR_MODES:
+            luma, texture, palette = FrameConverter(mode).convert(img)
+            if mode == 'rgb':
+                self.assertTrue(luma is None)
+            else:
+                self.assertEqual(luma.shape, (60,80))
+            self.assertEqual(texture.ndim, 3 if mode in ('rgb', 'lossless') else 2)
+            self.assertEqual(palette is None, mode != 'palette')
+        self.assertRaises(ValueError, FrameConverter, 'cmyk')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Detects repeated frames in a video (e.g. pauses, menus, or frames duplicated
+by frame-rate conversion), so their parsed features and unwrapped images can
+be reused instead of being computed again.
+
+See unit tests at the end of this file.
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+def get_fingerprint(img, step=8):
+    """
+    Get a cheap fingerprint of an image array by taking every step-th pixel
+    of its rows and columns, and summing its color channels.
+    """
+    thumb = img[::step, ::step]
+    if thumb.ndim == 3:
+        return thumb.sum(axis=2, dtype=np.int16)
+    return thumb.astype(np.int16)
+
+class RepeatDetector:
+    """
+    This compares each frame to the last frame that was not a repeat (the one
+    whose results would be reused), so that slow changes cannot slip through
+    as a long chain of small differences.
+    """
+
+    def __init__(self, threshold=1.0, step=8):
+        """
+        threshold = max mean difference (per pixel, per channel, 0 to 255) of a
+                    frame that is considered a repeat
+        step      = distance between the sampled pixels of the fingerprints
+        """
+        self.threshold = threshold
+        self.step = step
+        self.reference = None
+
+    def is_repeat(self, img):
+        """
+        Determines if the given image array repeats the reference frame.  If it
+        does not, it becomes the new reference frame.
+        """
+        fingerprint = get_fingerprint(img, self.step)
+        reference = self.reference
+        if reference is not None and reference.shape == fingerprint.shape:
+            channels = img.shape[2] if img.ndim == 3 else 1
+            diff = np.abs(fingerprint - reference).mean() / channels
+            if diff <= self.threshold:
+                return True
+        self.reference = fingerprint
+        return False
+
+    def reset(self):
+        """Forget the reference frame (e.g. after skipping frames)."""
+        self.reference = None
+
+def link_file(src, dst):
+    """
+    Make dst refer to the same file as src (a hard link), or copy it if the
+    filesystem does not support links.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+######################################################################
+
+import unittest
+
+class TestRepeatDetector(unittest.TestCase):
+
+    def setUp(self):
+        self.img = np.random.RandomState(0).randint(0, 256, (120,160,3)).astype(np.uint8)
+
+    def test_identical(self):
+        """Assert that an identical frame is a repeat."""
+        detector = RepeatDetector()
+        self.assertFalse(detector.is_repeat(self.img))
+        self.assertTrue(detector.is_repeat(self.img.copy()))
+
+    def test_changed(self):
+        """Assert that a frame with a changed region is not a repeat."""
+        detector = RepeatDetector()
+        detector.is_repeat(self.img)
+        img = self.img.copy()
+        img[:60] = 255 - img[:60]
+        self.assertFalse(detector.is_repeat(img))
+
+    def test_drift(self):
+        """
+        Assert that many small changes are caught once they add up, since
+        frames are compared to the last frame that was not a repeat.
+        """
+        detector = RepeatDetector(threshold=2.0)
+        img = self.img.astype(np.int16)
+        repeats = []
+        for i in xrange(10):
+            repeats.append(detector.is_repeat(np.clip(img + i, 0, 255).astype(np.uint8)))
+        self.assertIn(False, repeats[1:])
+
+if __name__ == "__main__":
+    unittest.main()
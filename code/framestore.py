@@ -0,0 +1,327 @@
+"""
+A single memory-mapped file of raw frames, as an alternative to dumping two
+JPEG files per frame.  Frames are stored uncompressed at a fixed size, so
+they are written and read in place without encoding or decoding, and a reader
+gets NumPy views of the file instead of copies.
+
+File layout:
+
+    header   (HEADER_SIZE bytes, see HEADER_FORMAT)
+    records  [capacity]
+
+    record:
+        status    uint8                       (EMPTY, DONE or FAILED)
+        index     int64                       (index of the frame in the video)
+        timestamp float64                     (time the frame was stored)
+        crop      int32 [4]                   (x,y,width,height of the valid
+                                               rows, or zeros for all)
+        pixels    uint8 [images][height][width][channels]
+                                              (BGR images whose first row is
+                                               the top, e.g. "orig" and "unwrap")
+
+Records are appended in processing order, and the file grows in place (by
+doubling its capacity) when it is full.  The count in the header is saved
+every few seconds while appending, and an interrupted store is repaired by
+"rewind", which finds its committed records from their status.
+
+    Pipe the unwrapped frames of a store into FFmpeg without decoding them:
+    > python framestore.py frames.store --raw unwrap | \\
+        ffmpeg -f rawvideo -pix_fmt bgr24 -s WxH -r 30 -i - unwrap.mp4
+
+See unit tests at the end of this file.
+"""
+
+import os
+import sys
+import struct
+import time
+
+import numpy as np
+
+MAGIC = 'SHXFRAME'
+FORMAT_VERSION = 1
+
+# magic, format version, capacity, count, width, height, channels, image names
+HEADER_FORMAT = '<8sIIIIII200s'
+HEADER_SIZE = 4096
+
+# size of the fields before the pixels of each record
+RECORD_HEADER_SIZE = 64
+
+# status of each record
+EMPTY = 0
+DONE = 1
+FAILED = 2
+
+def get_record_dtype(width, height, channels, images):
+    """Get the NumPy type of a record of the given frame size."""
+    return np.dtype({
+        'names':   ['status', 'index', 'timestamp', 'crop', 'pixels'],
+        'formats': [np.uint8, '<i8', '<f8', ('<i4', 4), (np.uint8, (images, height, width, channels))],
+        'offsets': [0, 8, 16, 24, RECORD_HEADER_SIZE],
+        'itemsize': RECORD_HEADER_SIZE + images * height * width * channels,
+    })
+
+class FrameStore:
+    """
+    The frames stored in a frame store file, opened for reading or appending.
+    """
+
+    def __init__(self, path, mode='r', flush_interval=2.0):
+        """
+        Open an existing frame store file.  (Use "create" to make a new one.)
+
+        path           = path of the file
+        mode           = 'r' to read, or 'r+' to read and append
+        flush_interval = min number of seconds between saves of the count in
+                         the header while committing frames
+        """
+        self.path = path
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        with open(path, 'rb') as f:
+            data = f.read(struct.calcsize(HEADER_FORMAT))
+        if len(data) != struct.calcsize(HEADER_FORMAT):
+            raise ValueError('"%s" is not a frame store' % path)
+        magic, version, capacity, count, width, height, channels, names = struct.unpack(HEADER_FORMAT, data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('"%s" is not a frame store of version %d' % (path, FORMAT_VERSION))
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.names = names.rstrip('\0').split(',')
+        self.count = count
+        self.dtype = get_record_dtype(width, height, channels, len(self.names))
+        self.index_map = None
+        self.map(capacity)
+
+    @staticmethod
+    def create(path, width, height, names=('orig', 'unwrap'), capacity=1024, channels=3):
+        """
+        Create an empty frame store file with room for the given number of
+        frames, and open it for appending.
+
+        names = names of the images of each frame
+        """
+        tmp_path = path + '.tmp'
+        size = HEADER_SIZE + capacity * get_record_dtype(width, height, channels, len(names)).itemsize
+        with open(tmp_path, 'wb') as f:
+            header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, capacity, 0, width, height, channels, ','.join(names))
+            f.write(header.ljust(HEADER_SIZE, '\0'))
+            f.truncate(size)
+        os.rename(tmp_path, path)
+        return FrameStore(path, 'r+')
+
+    def map(self, capacity):
+        """Memory-map the records of the file."""
+        self.capacity = capacity
+        self.records = np.memmap(self.path, self.dtype, self.mode, HEADER_SIZE, (capacity,))
+
+    def write_header(self):
+        """Write the capacity and count to the header of the file."""
+        with open(self.path, 'r+b') as f:
+            f.seek(struct.calcsize('<8sI'))
+            f.write(struct.pack('<II', self.capacity, self.count))
+        self.last_flush = time.time()
+
+    def grow(self, min_capacity):
+        """
+        Make room for at least the given number of frames by extending the
+        file.  (Views of the old mapping stay valid, but are not updated.)
+        """
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        self.records.flush()
+        with open(self.path, 'r+b') as f:
+            f.truncate(HEADER_SIZE + capacity * self.dtype.itemsize)
+        self.map(capacity)
+        self.write_header()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, index, crop=None, timestamp=None):
+        """
+        Add a record for the frame of the given index, and return its record
+        number.  Its images are filled in place (see "image") and it must be
+        committed with "commit" once done.
+        """
+        k = self.count
+        if k >= self.capacity:
+            self.grow(k+1)
+        record = self.records[k]
+        record['status'] = EMPTY
+        record['index'] = index
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+        record['crop'] = crop or (0,0,0,0)
+        self.count += 1
+        if self.index_map is not None:
+            self.index_map[index] = k
+        return k
+
+    def set_crop(self, k, crop):
+        """Set the crop rectangle of the k-th record."""
+        self.records['crop'][k] = crop or (0,0,0,0)
+
+    def commit(self, k, status=DONE):
+        """Mark the k-th record as completely written."""
+        # (status is written last so a partially written frame stays EMPTY)
+        self.records['status'][k] = status
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.write_header()
+
+    def image(self, k, name, cropped=False):
+        """
+        Get a view of the named image of the k-th record (to read or write in
+        place), optionally cropped to the record's valid rows.
+        """
+        img = self.records['pixels'][k, self.names.index(name)]
+        if cropped:
+            x,y,w,h = self.records['crop'][k]
+            if w and h:
+                img = img[y:y+h, x:x+w]
+        return img
+
+    def find(self, index):
+        """Get the record number of the frame of the given index, or None."""
+        if self.index_map is None:
+            indices = self.records['index'][:self.count]
+            self.index_map = dict((int(i), k) for k,i in enumerate(indices))
+        return self.index_map.get(index)
+
+    def frames(self, name, cropped=False):
+        """
+        Iterate over (index, status, image view) of every committed frame.
+        """
+        status = self.records['status']
+        for k in xrange(self.count):
+            if status[k] != EMPTY:
+                yield int(self.records['index'][k]), int(status[k]), self.image(k, name, cropped)
+
+    def last_index(self):
+        """Get the index of the last committed frame, or -1 if none."""
+        status = self.records['status'][:self.count]
+        done = np.nonzero(status != EMPTY)[0]
+        if not len(done):
+            return -1
+        return int(self.records['index'][done[-1]])
+
+    def rewind(self):
+        """
+        Drop the records after the last committed one (e.g. left by an
+        interrupted run), so that appending continues after it.  (Every record
+        is checked, since the count in the header of a killed run may miss
+        the last frames.)
+        """
+        status = self.records['status']
+        done = np.nonzero(status != EMPTY)[0]
+        self.count = int(done[-1]) + 1 if len(done) else 0
+        self.index_map = None
+
+    def flush(self):
+        """Write any changes to disk."""
+        if self.mode != 'r':
+            self.records.flush()
+            self.write_header()
+
+    def close(self):
+        """Write any changes to disk and unmap the file."""
+        self.flush()
+        self.records = None
+
+def write_raw(store, name, f, cropped=False):
+    """Write the named images of every frame to a file object, uncompressed."""
+    for index, status, img in store.frames(name, cropped):
+        f.write(np.ascontiguousarray(img).data)
+
+######################################################################
+
+import unittest
+import tempfile
+import shutil
+
+class TestFrameStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'frames.store')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        """Assert that frames are read back in place, past a growth."""
+        store = FrameStore.create(self.path, 4, 3, capacity=2)
+        for i in xrange(5):
+            k = store.append(i*10, crop=(0,1,4,2))
+            store.image(k, 'orig')[:] = i
+            store.image(k, 'unwrap')[:] = 100 + i
+            store.commit(k, FAILED if i == 3 else DONE)
+        store.append(50)
+        store.close()
+
+        store = FrameStore(self.path, 'r+')
+        store.rewind()
+        self.assertEqual(len(store), 5)
+        store.close()
+
+        store = FrameStore(self.path)
+        self.assertEqual(len(store), 5)
+        self.assertTrue(store.capacity >= 6)
+        frames = list(store.frames('unwrap', cropped=True))
+        self.assertEqual([i for i,s,img in frames], [0,10,20,30,40])
+        self.assertEqual(frames[3][1], FAILED)
+        self.assertEqual(frames[2][2].shape, (2,4,3))
+        self.assertTrue((frames[2][2] == 102).all())
+        self.assertTrue(np.shares_memory(frames[2][2], store.records))
+        self.assertEqual(store.find(40), 4)
+        self.assertEqual(store.last_index(), 40)
+
+    def test_killed(self):
+        """Assert that frames committed after the last saved count are kept."""
+        store = FrameStore.create(self.path, 4, 3, capacity=8)
+        for i in xrange(3):
+            store.commit(store.append(i))
+        store.records.flush()
+        store.records = None
+
+        store = FrameStore(self.path, 'r+')
+        self.assertEqual(len(store), 0)
+        store.rewind()
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.last_index(), 2)
+        store.close()
+
+        store = FrameStore(self.path, 'r+', flush_interval=0)
+        store.commit(store.append(3))
+        self.assertEqual(len(FrameStore(self.path)), 4)
+        store.close()
+
+    def test_not_a_store(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 10)
+        self.assertRaises(ValueError, FrameStore, self.path)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('store', nargs='?', help='path of a frame store file')
+    parser.add_argument('--raw', metavar='NAME', help='write the named images of every frame to stdout')
+    parser.add_argument('--cropped', action='store_true', help='only write the valid rows of each image\n(only if every frame has the same crop)')
+    args = parser.parse_args()
+
+    if not args.store:
+        # Run the unit tests.
+        unittest.main(argv=[__file__])
+    else:
+        store = FrameStore(args.store)
+        if args.raw:
+            write_raw(store, args.raw, sys.stdout, args.cropped)
+        else:
+            print '%d frames of %dx%d (%s), last frame %d' % (
+                len(store), store.width, store.height, ', '.join(store.names), store.last_index())
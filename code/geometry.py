@@ -0,0 +1,231 @@
+"""
+The geometry of unwrapping a Super Hexagon frame: the distance from the center
+to the edge of the center polygon at any angle (see "unwrap.py" for the
+picture), and which part of the unwrapped image falls inside the original.
+
+This only needs the standard library, so tools and worker processes that only
+need the projection math do not have to load SimpleCV or pyglet.
+
+See unit tests at the end of this file.
+"""
+
+import math
+
+def dist(p0,p1):
+    """Distance between two 2D points."""
+    x0,y0 = p0
+    x1,y1 = p1
+    dx = x0-x1
+    dy = y0-y1
+    return math.sqrt(dx*dx + dy*dy)
+
+class Vertex:
+    """A vertex of a polygon, containing calculated properties of that vertex."""
+    def __init__(self,point,center):
+        self.point = point
+        self.center = center
+        self.radius = dist(point,center)
+        self.rel = (point[0]-center[0], point[1]-center[1])
+        self.angle = math.atan2(self.rel[1], self.rel[0])
+    
+    def copy(self):
+        return Vertex(self.point, self.center)
+
+class TriangleProjector:
+    """
+    Given two Vertex objects sharing a center point, this class determines the
+    distance from that center point to the line segment of those two vertices
+    along the direction of a given angle.
+
+    To illustrate:
+
+        vertex1   = V1
+        vertex2   = V2
+        center    = C
+        intersect = X
+
+                V1 .............X........... V2
+                      ..........|........
+                           .....|....
+                               .|.
+                                C
+
+    After computing the distance from C to X, we can compute the distance
+    from the center to any point on V1->V2 given some angle:
+
+          R(ANGLE) = |CX| / cos(ANGLE - angle(CX))
+
+    """
+
+    def __init__(self, vertex1, vertex2):
+
+        # define angle bounds for this projector
+        self.start_angle = vertex1.angle
+        self.end_angle = vertex2.angle
+
+        # short-hand names for each point
+        point1 = vertex1.point
+        point_center = vertex1.center
+        point2 = vertex2.point
+
+        # define the 2nd vertex and the center point relative to the 1st vertex
+        rel_center = (point_center[0]-point1[0], point_center[1]-point1[1]) 
+        rel_point2 = (point2[0]-point1[0], point2[1]-point1[1])
+
+        # distance between the two vertices
+        den = dist(rel_point2, (0,0))
+
+        # Rotate the center point such that the 1st and 2nd vertex will be
+        # horizontal from each other.
+        x = (rel_center[0]*rel_point2[0] + rel_center[1]*rel_point2[1]) / den
+        y = (rel_center[1]*rel_point2[0] - rel_center[0]*rel_point2[1]) / den
+
+        # On the line segment between the vertices, find the closest point
+        # to the center point.
+        # (This is just the x-component of our rotated center point, so we pick
+        # the point that is 'x' distance along the line between vertex 1 and
+        # 2.)
+        intersect = (
+                int(point1[0] + x * rel_point2[0]/den),
+                int(point1[1] + x * rel_point2[1]/den))
+
+        # The angle to the mid point.
+        self.center_angle = math.atan2(intersect[1]-point_center[1], intersect[0]-point_center[0])
+
+        # Distance from the center point to the mid point on the line segment.
+        self.center_dist = dist(intersect, point_center)
+    
+    def is_angle_inside(self, angle):
+        """
+        Determines if the given angle is inside the range covered by our
+        triangle.
+        """
+        return self.start_angle <= angle and angle <= self.end_angle
+
+    def angle_to_radius(self, angle):
+        """
+        Returns the distance to the line segment created by our two vertices
+        at the given angle.
+        """
+        return self.center_dist / math.cos(abs(angle-self.center_angle))
+
+class PolygonProjector:
+    """
+    Given a list of points along a concave polygon, this class creates a list
+    of TriangleProjector objects so that we can compute the distance between
+    the center and the edge of the polygon given some angle.
+    """
+    def __init__(self, center, points):
+
+        vertices = [Vertex(v, center) for v in points]
+        vertices.sort(key=lambda v: v.angle)
+
+        # Make angle wrap from -pi to pi easier to deal with by copying each
+        # endpoint vertex to the opposite side of the list with a lower or higher
+        # but equivalent angle.
+        v0 = vertices[0].copy()
+        v0.angle += math.pi*2
+        v1 = vertices[-1].copy()
+        v1.angle -= math.pi*2
+        vertices.insert(0,v1)
+        vertices.append(v0)
+
+        self.projectors = [TriangleProjector(vertices[i],vertices[i+1]) for i in xrange(len(vertices)-1)]
+        self.vertices = vertices
+    
+    def angle_to_radius(self, angle):
+        """
+        Get the distance from the center of this polygon to its edge at the
+        given angle.
+        """
+        for p in self.projectors:
+            if p.is_angle_inside(angle):
+                return p.angle_to_radius(angle)
+
+# The unwrapped image spans from the center out to this many polygon radii.
+# (must match the "max_radius" scale in the fragment shader)
+MAX_RADIUS_SCALE = 11.0
+
+def ray_exit_distance(origin, angle, size):
+    """
+    Distance from the origin to the edge of an image of the given size, along
+    the ray at the given angle.
+    """
+    x,y = origin
+    w,h = size
+    dx,dy = math.cos(angle), math.sin(angle)
+    length = float('inf')
+    if dx > 0: length = min(length, (w-x)/dx)
+    if dx < 0: length = min(length, -x/dx)
+    if dy > 0: length = min(length, (h-y)/dy)
+    if dy < 0: length = min(length, -y/dy)
+    return length
+
+def get_valid_extent(projector, region_size, samples=720):
+    """
+    Returns the fraction (0 to 1) of the unwrapped image's height that
+    contains pixels sampled from inside the original image.  Every row above
+    this fraction would only be filled with black by the fragment shader.
+
+    projector   = PolygonProjector of the parsed frame
+    region_size = (width,height) of the original image
+    samples     = number of evenly spaced angles to check
+    """
+    w,h = region_size
+    origin = (w/2.0, h/2.0)
+
+    # The extent peaks at the angles of the image corners and polygon
+    # vertices, so check those in addition to the evenly spaced angles.
+    angles = [i*math.pi*2/samples - math.pi for i in xrange(samples)]
+    angles += [math.atan2(y-origin[1], x-origin[0]) for x in (0,w) for y in (0,h)]
+    angles += [v.angle for v in projector.vertices if -math.pi <= v.angle <= math.pi]
+
+    extent = 0.0
+    for angle in angles:
+        poly_radius = projector.angle_to_radius(angle)
+        if not poly_radius or poly_radius <= 0:
+            continue
+        max_radius = poly_radius * MAX_RADIUS_SCALE
+        extent = max(extent, ray_exit_distance(origin, angle, region_size) / max_radius)
+        if extent >= 1.0:
+            return 1.0
+    return extent
+
+def get_crop_rect(extent, width, height):
+    """
+    Returns the (x,y,width,height) rectangle of an unwrapped image (with its
+    origin at the top-left) that holds all of its valid rows.  Pasting the
+    cropped image at (x,y) on a black canvas of the given size reconstructs
+    the full unwrapped image.
+    """
+    rows = max(1, min(height, int(math.ceil(extent * height))))
+    return (0, height-rows, width, rows)
+
+######################################################################
+
+import unittest
+
+class TestGeometry(unittest.TestCase):
+
+    def test_square_radius(self):
+        """Assert the radius of a square at its edge centers and corners."""
+        center = (50,50)
+        projector = PolygonProjector(center, [(40,40), (60,40), (60,60), (40,60)])
+        self.assertAlmostEqual(projector.angle_to_radius(0), 10)
+        self.assertAlmostEqual(projector.angle_to_radius(math.pi/2), 10)
+        self.assertAlmostEqual(projector.angle_to_radius(math.pi/4), 10*math.sqrt(2))
+        self.assertAlmostEqual(projector.angle_to_radius(-math.pi+0.001), 10, 2)
+
+    def test_valid_extent(self):
+        """Assert that the rows past the corners of the image are cropped."""
+        projector = PolygonProjector((50,50), [(40,40), (60,40), (60,60), (40,60)])
+
+        # The corners are at most 50*sqrt(2) away, which is a fraction of the
+        # 11 radii of the unwrapped image.
+        extent = get_valid_extent(projector, (100,100))
+        self.assertAlmostEqual(extent, 50*math.sqrt(2) / (10*math.sqrt(2)*MAX_RADIUS_SCALE), 2)
+        self.assertEqual(get_crop_rect(0.5, 100, 80), (0,40,100,40))
+        self.assertEqual(get_crop_rect(0.0, 100, 80), (0,79,100,1))
+
+if __name__ == "__main__":
+    unittest.main()
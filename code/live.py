@@ -0,0 +1,311 @@
+"""
+Reads live frames as raw BGR pixels from a pipe (e.g. stdin or a named pipe
+fed by an FFmpeg screen capture), for unwrapping gameplay as it happens.
+
+A live source runs at its own pace, so frames are never queued: a reader
+thread keeps only the newest frame, and a frame older than its deadline when
+the renderer gets to it is dropped instead of being shown late.  The latency
+of each shown frame is measured from the moment its last byte was read until
+it was drawn.
+
+    Capture the screen with FFmpeg and unwrap it live:
+    > ffmpeg -f x11grab -s 1280x720 -r 60 -i :0.0 -f rawvideo -pix_fmt bgr24 - | \\
+        python unwrap_live.py --size 1280x720
+
+    Replay a video at its real-time rate into a named pipe, to test without
+    the game:
+    > mkfifo live.raw
+    > python live.py --replay ../vid/trailer.mp4 --fps 30 > live.raw &
+    > python ../unwrap_live.py live.raw --size 1280x720
+
+See unit tests at the end of this file.
+"""
+
+import sys
+import threading
+import time
+import timeit
+
+import numpy as np
+
+from metrics import Reservoir
+
+timer = timeit.default_timer
+
+# default max age (in seconds) of a frame when it starts being processed
+DEFAULT_DEADLINE = 0.050
+
+class RawFrameReader:
+    """
+    Reads whole frames of raw pixels from a file object.
+    """
+
+    def __init__(self, f, width, height, channels=3):
+        """
+        f        = file object of the pipe (opened in binary mode)
+        width    = width of the frames
+        height   = height of the frames
+        channels = bytes per pixel (3 for FFmpeg's "bgr24")
+        """
+        self.f = f
+        self.shape = (height, width, channels)
+        self.frame_size = width * height * channels
+
+    def read(self, out=None):
+        """
+        Read the next frame into the given array (or a new one), and return
+        it.  Returns None at the end of the stream or on a partial frame.
+        """
+        if out is None:
+            out = np.empty(self.shape, np.uint8)
+        view = memoryview(out.reshape(-1).view(np.uint8))
+        filled = 0
+        while filled < self.frame_size:
+            n = self.f.readinto(view[filled:])
+            if not n:
+                return None
+            filled += n
+        return out
+
+class LatestFrame:
+    """
+    A thread that reads frames from a RawFrameReader as fast as they come and
+    keeps only the newest one, so that a slow renderer always gets the latest
+    frame instead of working through a backlog.
+
+    Frames that are replaced before being taken are counted as "overwritten".
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.cond = threading.Condition()
+        self.frame = None
+        self.count = 0
+        self.overwritten = 0
+        self.finished = False
+
+        # buffers for the frame being read, the newest frame and the taken
+        # one, so the reader never writes into a frame in use
+        self.spare = [np.empty(reader.shape, np.uint8) for n in xrange(3)]
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        """Read frames until the end of the stream (run by the thread)."""
+        try:
+            while True:
+                with self.cond:
+                    buf = self.spare.pop()
+                img = self.reader.read(buf)
+                if img is None:
+                    break
+                arrival = timer()
+                with self.cond:
+                    if self.frame is not None:
+                        self.overwritten += 1
+                        self.spare.append(self.frame[2])
+                    self.frame = (self.count, arrival, img)
+                    self.count += 1
+                    self.cond.notify()
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify()
+
+    def take(self, timeout=None):
+        """
+        Take the newest frame as (index, arrival time, array), waiting up to
+        the given number of seconds for one.  Returns None if no frame came in
+        time or the stream ended.  The array is valid until "give_back".
+        """
+        with self.cond:
+            if self.frame is None and not self.finished:
+                self.cond.wait(timeout)
+            frame = self.frame
+            self.frame = None
+            return frame
+
+    def give_back(self, frame):
+        """Return the array of a taken frame, so the reader can reuse it."""
+        with self.cond:
+            self.spare.append(frame[2])
+
+    def is_done(self):
+        """Determines if the stream ended and every frame was taken."""
+        with self.cond:
+            return self.finished and self.frame is None
+
+class LiveStats:
+    """
+    The shown, blank (processed before anything could be drawn), overwritten
+    and late (dropped) frames of a live source, and the end-to-end latency of
+    the shown ones (sampled for the percentiles, since a live source can run
+    indefinitely).
+    """
+
+    def __init__(self):
+        self.shown = 0
+        self.blank = 0
+        self.late = 0
+        self.latencies = Reservoir()
+
+    def add_latency(self, seconds):
+        """Count a shown frame, drawn the given number of seconds after it came."""
+        self.shown += 1
+        self.latencies.add(seconds * 1000)
+
+    def summary(self, overwritten=0):
+        """Get the frame counts and the latency percentiles in milliseconds."""
+        return {
+            "shown": self.shown,
+            "blank": self.blank,
+            "late": self.late,
+            "overwritten": overwritten,
+            "p50_ms": self.latencies.percentile(50),
+            "p95_ms": self.latencies.percentile(95),
+            "p99_ms": self.latencies.percentile(99),
+            "max_ms": self.latencies.max,
+        }
+
+def format_stats(summary):
+    """Format a summary from "LiveStats.summary" as a readable line."""
+    return ('%d frames shown, %d blank, %d overwritten, %d late; latency p50 '
+        '%.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms') % (summary["shown"],
+        summary["blank"], summary["overwritten"], summary["late"],
+        summary["p50_ms"], summary["p95_ms"], summary["p99_ms"], summary["max_ms"])
+
+def take_fresh_frame(latest, stats, deadline=DEFAULT_DEADLINE, timeout=0.0):
+    """
+    Take the newest frame that is not older than the deadline, dropping late
+    ones.  Returns (index, arrival time, array), or None if there is no fresh
+    frame yet.
+    """
+    while True:
+        frame = latest.take(timeout)
+        if frame is None:
+            return None
+        if deadline and timer() - frame[1] > deadline:
+            stats.late += 1
+            latest.give_back(frame)
+            continue
+        return frame
+
+def replay_frames(frames, f, fps, clock=time):
+    """
+    Write (index, array) frames to a file object as raw pixels, paced at the
+    given rate like a live capture.  A frame that is due while the previous one
+    is still being written is skipped, as a capture would.  Returns the number
+    of frames written.
+    """
+    start = clock.time()
+    written = 0
+    for i, img in frames:
+        due = start + i / float(fps)
+        now = clock.time()
+        if now > due + 1.0 / fps:
+            continue
+        if due > now:
+            clock.sleep(due - now)
+        f.write(np.ascontiguousarray(img).data)
+        written += 1
+    f.flush()
+    return written
+
+def read_video_arrays(video_path):
+    """
+    Iterate over (index, BGR array) of every frame of a video file (or image
+    sequence, see "source.open_source").
+    """
+    from source import open_source, FrameSelection
+    for i, img in open_source(video_path).frames(FrameSelection()):
+        yield i, img.getNumpyCv2()
+
+######################################################################
+
+import unittest
+import io
+import os
+
+class TestLive(unittest.TestCase):
+
+    def make_frames(self, count, shape=(4,6,3)):
+        return [(i, np.full(shape, i, np.uint8)) for i in xrange(count)]
+
+    def test_reader(self):
+        data = ''.join(img.tostring() for i, img in self.make_frames(3))
+        reader = RawFrameReader(io.BytesIO(data + 'x'), 6, 4)
+        frames = [reader.read() for n in xrange(3)]
+        self.assertEqual([int(img[0,0,0]) for img in frames], [0,1,2])
+        self.assertEqual(reader.read(), None)
+
+    def test_newest_only(self):
+        """Assert that a slow renderer only gets the newest frame."""
+        data = ''.join(img.tostring() for i, img in self.make_frames(5))
+        latest = LatestFrame(RawFrameReader(io.BytesIO(data), 6, 4)).start()
+        latest.thread.join()
+        i, arrival, img = latest.take()
+        self.assertEqual(i, 4)
+        self.assertTrue((img == 4).all())
+        self.assertEqual(latest.overwritten, 4)
+        self.assertTrue(latest.is_done())
+
+    def test_late(self):
+        """Assert that frames older than the deadline are dropped."""
+        data = self.make_frames(1)[0][1].tostring()
+        latest = LatestFrame(RawFrameReader(io.BytesIO(data), 6, 4)).start()
+        latest.thread.join()
+        stats = LiveStats()
+        time.sleep(0.02)
+        self.assertEqual(take_fresh_frame(latest, stats, deadline=0.01), None)
+        self.assertEqual(stats.late, 1)
+
+    def test_replay(self):
+        """Assert that replayed frames come through a pipe at the given rate."""
+        r, w = os.pipe()
+        frames = self.make_frames(6)
+        def produce():
+            with os.fdopen(w, 'wb') as f:
+                replay_frames(frames, f, fps=100)
+        start = timer()
+        producer = threading.Thread(target=produce)
+        producer.start()
+        with os.fdopen(r, 'rb') as f:
+            latest = LatestFrame(RawFrameReader(f, 6, 4)).start()
+            stats = LiveStats()
+            received = []
+            while not latest.is_done():
+                frame = take_fresh_frame(latest, stats, deadline=1.0, timeout=0.1)
+                if frame:
+                    received.append(int(frame[2][0,0,0]))
+                    stats.add_latency(timer() - frame[1])
+                    latest.give_back(frame)
+        producer.join()
+        self.assertTrue(timer() - start >= 0.05)
+        self.assertEqual(received[-1], 5)
+        self.assertEqual(stats.shown + latest.overwritten, 6)
+        self.assertTrue(stats.summary(latest.overwritten)["p99_ms"] < 1000)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--replay', metavar='VIDEO', help='write the frames of a video to stdout as raw BGR pixels\nat real-time rate')
+    parser.add_argument('--fps', metavar='N', type=float, default=30.0, help='frame rate of the replay (default 30)')
+    args = parser.parse_args()
+
+    if args.replay:
+        try:
+            replay_frames(read_video_arrays(args.replay), sys.stdout, args.fps)
+        except IOError:
+            # The reader closed the pipe.
+            pass
+    else:
+        # Run the unit tests.
+        unittest.main(argv=[__file__])
@@ -0,0 +1,440 @@
+"""
+Collects per-frame metrics of the unwrap pipeline (time spent in each stage,
+parse failures, cache hits, queue depths, ...) and passes them to pluggable
+hooks, such as the JSON lines and binary log writers below.
+
+Also includes a sampling profiler that shows where the time goes without the
+overhead of a tracing profiler.
+
+See unit tests at the end of this file.
+"""
+
+import sys
+import json
+import random
+import struct
+import threading
+import timeit
+from collections import defaultdict
+
+import numpy as np
+
+timer = timeit.default_timer
+
+# number of values kept for the percentiles of a stream of values
+RESERVOIR_SIZE = 4096
+
+def get_percentile(times, p):
+    """Get the p-th percentile (0 to 100) of a list of times."""
+    return float(np.percentile(times, p)) if len(times) else 0.0
+
+class Reservoir:
+    """
+    The count, mean and max of a stream of values, and a fixed-size random
+    sample of them (reservoir sampling) for their percentiles, so that the
+    memory stays bounded however long the stream runs.
+    """
+
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.size = size
+        self.samples = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.random = random.Random(0)
+
+    def add(self, value):
+        """Add a value to the stream."""
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            # Keep each of the values so far with the same probability.
+            k = self.random.randint(0, self.count - 1)
+            if k < self.size:
+                self.samples[k] = value
+
+    def mean(self):
+        """Get the mean of every value (not only the sampled ones)."""
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Get the p-th percentile (0 to 100), estimated from the sample."""
+        return get_percentile(self.samples, p)
+
+class Metrics:
+    """
+    This records a dict of metrics for each frame, and calls every hook with
+    it once the frame is done.  A record looks like:
+
+        {
+            "frame": 120,                           (frame index)
+            "time": 1.52,                           (seconds since start)
+            "total_ms": 21.3,                       (time spent on the frame)
+            "stages": {"decode": 2.1, ...},         (milliseconds per stage)
+            ...                                     (fields given to "set")
+        }
+
+    The fields set by "unwrap_video" are "parsed" (bool), "failure" (reason
+    string), "vertices" (count), "cache_hit" (bool), "repeat" (bool) and
+    "reused" (bool, the previous parse result was reused to save time).
+    """
+
+    def __init__(self, hooks=()):
+        """
+        hooks = functions(record) to call with the record of each frame
+                (a hook's "close" method is called by "close", if it has one)
+        """
+        self.hooks = list(hooks)
+        self.start_time = timer()
+        self.record = None
+        self.frame_start = None
+        self.gauges = {}
+
+        # totals for the summary
+        self.frames = 0
+        self.failures = 0
+        self.failure_reasons = defaultdict(int)
+        self.stage_times = defaultdict(Reservoir)
+
+    def add_hook(self, hook):
+        """Add a function(record) to call with the record of each frame."""
+        self.hooks.append(hook)
+
+    def begin_frame(self, index):
+        """Start the record of the frame with the given index."""
+        self.frame_start = timer()
+        self.record = {"frame": index, "stages": {}}
+
+    def measure(self, stage, func, *args):
+        """
+        Call the given function and add its running time to the given stage of
+        the current frame.  Returns the result of the function.
+        """
+        start = timer()
+        try:
+            return func(*args)
+        finally:
+            if self.record is not None:
+                ms = (timer() - start) * 1000
+                stages = self.record["stages"]
+                stages[stage] = stages.get(stage, 0.0) + ms
+
+    def set(self, **fields):
+        """Set fields of the current frame's record."""
+        if self.record is not None:
+            self.record.update(fields)
+
+    def set_gauge(self, name, value):
+        """
+        Set a value (e.g. a queue depth) that is included in the record of
+        every following frame until it is changed.
+        """
+        self.gauges[name] = value
+
+    def end_frame(self):
+        """Finish the record of the current frame and pass it to the hooks."""
+        record = self.record
+        if record is None:
+            return
+        self.record = None
+        now = timer()
+        record["time"] = now - self.start_time
+        record["total_ms"] = (now - self.frame_start) * 1000
+        record.update(self.gauges)
+
+        self.frames += 1
+        if record.get("failure"):
+            self.failures += 1
+            self.failure_reasons[record["failure"]] += 1
+        for stage, ms in record["stages"].iteritems():
+            self.stage_times[stage].add(ms)
+        self.stage_times["total"].add(record["total_ms"])
+
+        for hook in self.hooks:
+            hook(record)
+
+    def summary(self):
+        """
+        Get the throughput, failure rate and latency percentiles (in
+        milliseconds) of each stage over all frames so far.  (The percentiles
+        are estimated from a sample of RESERVOIR_SIZE frames on long runs.)
+        """
+        elapsed = timer() - self.start_time
+        stages = {}
+        for stage, times in self.stage_times.iteritems():
+            stages[stage] = {
+                "mean_ms": times.mean(),
+                "p50_ms": times.percentile(50),
+                "p95_ms": times.percentile(95),
+                "p99_ms": times.percentile(99),
+            }
+        return {
+            "frames": self.frames,
+            "elapsed": elapsed,
+            "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+            "failures": self.failures,
+            "failure_rate": float(self.failures) / self.frames if self.frames else 0.0,
+            "failure_reasons": dict(self.failure_reasons),
+            "stages": stages,
+        }
+
+    def close(self):
+        """Close every hook that can be closed."""
+        for hook in self.hooks:
+            if hasattr(hook, 'close'):
+                hook.close()
+
+def format_summary(summary):
+    """Format a summary from "Metrics.summary" as a readable table."""
+    lines = ['%d frames in %.1f s (%.1f fps), %d failed (%.1f%%)' % (
+        summary["frames"], summary["elapsed"], summary["fps"],
+        summary["failures"], summary["failure_rate"]*100)]
+    for reason, count in sorted(summary["failure_reasons"].iteritems()):
+        lines.append('    %d failed: %s' % (count, reason))
+    lines.append('%-12s %9s %9s %9s %9s' % ('stage', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    stages = summary["stages"]
+    for stage in sorted(stages, key=lambda s: (s == 'total', s)):
+        s = stages[stage]
+        lines.append('%-12s %9.2f %9.2f %9.2f %9.2f' % (stage, s["mean_ms"], s["p50_ms"], s["p95_ms"], s["p99_ms"]))
+    return '\n'.join(lines)
+
+class JsonLinesLog:
+    """A metrics hook that writes each frame's record as a line of JSON."""
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def __call__(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def close(self):
+        self.file.close()
+
+class BinaryLog:
+    """
+    A metrics hook that writes each frame's record as a fixed-size binary
+    record, for long runs where JSON would be too large.  Only the given
+    stages and the standard fields are kept.  (see "read_binary_log")
+
+    File layout:
+
+        "SHXMETRICS"  (magic)
+        uint32        (length of the JSON header)
+        JSON header   ({"stages": [...], "reasons": [...]})
+        records       (see "get_record_dtype")
+
+    Failure reasons are stored as an index into the "reasons" list of the
+    header, which is rewritten with all reasons when the log is closed.
+    """
+    MAGIC = 'SHXMETRICS'
+
+    # space reserved for the header so it can be rewritten in place
+    HEADER_SIZE = 4096
+
+    def __init__(self, path, stages):
+        self.file = open(path, 'wb')
+        self.stages = list(stages)
+        self.reasons = ['']
+        self.dtype = get_record_dtype(self.stages)
+        self.write_header()
+
+    def write_header(self):
+        header = json.dumps({"stages": self.stages, "reasons": self.reasons})
+        data = self.MAGIC + struct.pack('<I', len(header)) + header
+        if len(data) > self.HEADER_SIZE:
+            raise ValueError('too many failure reasons for the binary log header')
+        self.file.seek(0)
+        self.file.write(data.ljust(self.HEADER_SIZE, '\0'))
+        self.file.seek(0, 2)
+
+    def __call__(self, record):
+        reason = record.get("failure") or ''
+        if reason not in self.reasons:
+            self.reasons.append(reason)
+        row = np.zeros(1, self.dtype)
+        row["frame"] = record["frame"]
+        row["time"] = record["time"]
+        row["total_ms"] = record["total_ms"]
+        row["parsed"] = record.get("parsed", False)
+        row["cache_hit"] = record.get("cache_hit", False)
+        row["repeat"] = record.get("repeat", False)
+        row["vertices"] = record.get("vertices", 0)
+        row["failure"] = self.reasons.index(reason)
+        row["queue_depth"] = record.get("queue_depth", 0)
+        for stage in self.stages:
+            row[stage] = record["stages"].get(stage, 0.0)
+        self.file.write(row.tostring())
+
+    def close(self):
+        self.write_header()
+        self.file.close()
+
+def get_record_dtype(stages):
+    """Get the NumPy dtype of a binary log record with the given stages."""
+    return np.dtype([
+        ('frame', '<i4'),
+        ('time', '<f8'),
+        ('total_ms', '<f4'),
+        ('parsed', 'u1'),
+        ('cache_hit', 'u1'),
+        ('repeat', 'u1'),
+        ('vertices', 'u1'),
+        ('failure', '<u2'),
+        ('queue_depth', '<u2'),
+    ] + [(stage, '<f4') for stage in stages])
+
+def read_binary_log(path):
+    """
+    Read a log written by BinaryLog.  Returns (records, reasons) where records
+    is a NumPy structured array and reasons is the list of failure reasons
+    indexed by its "failure" field.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(BinaryLog.MAGIC):
+        raise ValueError('not a binary metrics log: %s' % path)
+    offset = len(BinaryLog.MAGIC)
+    length, = struct.unpack('<I', data[offset:offset+4])
+    header = json.loads(data[offset+4:offset+4+length])
+    dtype = get_record_dtype(header["stages"])
+    body = data[BinaryLog.HEADER_SIZE:]
+    count = len(body) / dtype.itemsize
+    records = np.frombuffer(body[:count*dtype.itemsize], dtype)
+    return records, header["reasons"]
+
+class SamplingProfiler:
+    """
+    This samples the call stack of a thread at a fixed interval from a
+    background thread, counting how often each function is running (self)
+    or on the stack (cumulative).  Unlike a tracing profiler, this does not
+    slow down the sampled code.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        """
+        interval  = seconds between samples
+        thread_id = id of the thread to sample (defaults to the calling thread)
+        """
+        self.interval = interval
+        self.thread_id = thread_id or threading.current_thread().ident
+        self.samples = 0
+        self.self_counts = defaultdict(int)
+        self.cumulative_counts = defaultdict(int)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='SamplingProfiler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.self_counts[get_frame_location(frame)] += 1
+            seen = set()
+            while frame is not None:
+                location = get_frame_location(frame)
+                if location not in seen:
+                    seen.add(location)
+                    self.cumulative_counts[location] += 1
+                frame = frame.f_back
+
+    def report(self, limit=20):
+        """Format the functions with the most samples as a readable table."""
+        lines = ['%d samples every %.1f ms' % (self.samples, self.interval*1000)]
+        for title, counts in (('self', self.self_counts), ('cumulative', self.cumulative_counts)):
+            lines.append('%8s  %s' % (title, 'function'))
+            top = sorted(counts.iteritems(), key=lambda item: -item[1])[:limit]
+            for location, count in top:
+                lines.append('%7.1f%%  %s' % (100.0*count/max(1,self.samples), location))
+        return '\n'.join(lines)
+
+def get_frame_location(frame):
+    """Get a readable "function (file:line)" name of a stack frame's function."""
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+
+######################################################################
+
+import unittest
+import tempfile
+import os
+import time
+
+class TestMetrics(unittest.TestCase):
+
+    def make_metrics(self, *hooks):
+        metrics = Metrics(hooks)
+        for i in xrange(10):
+            metrics.begin_frame(i)
+            metrics.measure('parse', lambda: None)
+            if i % 5 == 0:
+                metrics.set(parsed=False, failure='no blobs')
+            else:
+                metrics.set(parsed=True, vertices=6, cache_hit=(i % 2 == 0))
+            metrics.end_frame()
+        metrics.close()
+        return metrics
+
+    def test_summary(self):
+        """Assert the totals of the summary."""
+        summary = self.make_metrics().summary()
+        self.assertEqual(summary["frames"], 10)
+        self.assertEqual(summary["failures"], 2)
+        self.assertEqual(summary["failure_reasons"], {'no blobs': 2})
+        self.assertIn('parse', summary["stages"])
+        self.assertIn('total', summary["stages"])
+
+    def test_reservoir(self):
+        """Assert that a long stream keeps a bounded sample of its values."""
+        reservoir = Reservoir(size=1000)
+        for i in xrange(100000):
+            reservoir.add(i % 100)
+        self.assertEqual(len(reservoir.samples), 1000)
+        self.assertEqual(reservoir.count, 100000)
+        self.assertAlmostEqual(reservoir.mean(), 49.5)
+        self.assertEqual(reservoir.max, 99)
+        self.assertTrue(40 <= reservoir.percentile(50) <= 60)
+        self.assertTrue(reservoir.percentile(99) >= 95)
+
+    def test_binary_log(self):
+        """Assert that a binary log reads back the records that were written."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            records = []
+            self.make_metrics(BinaryLog(path, ['parse', 'draw']), records.append)
+            rows, reasons = read_binary_log(path)
+            self.assertEqual(len(rows), 10)
+            self.assertEqual(list(rows["frame"]), range(10))
+            self.assertEqual(reasons[rows["failure"][0]], 'no blobs')
+            self.assertEqual(reasons[rows["failure"][1]], '')
+            self.assertEqual(rows["vertices"][1], 6)
+            self.assertEqual(rows["draw"][1], 0)
+        finally:
+            os.remove(path)
+
+    def test_profiler(self):
+        """Assert that the profiler samples a busy function."""
+        def busy():
+            end = time.time() + 0.2
+            while time.time() < end:
+                pass
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        busy()
+        profiler.stop()
+        self.assertGreater(profiler.samples, 0)
+        self.assertTrue(any(location.startswith('busy ') for location in profiler.self_counts))
+
+if __name__ == "__main__":
+    unittest.main()
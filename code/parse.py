@@ -1,39 +1,76 @@
 """
 This parses a frame from Super Hexagon to extract the features we want, using
 Computer Vision.
+
+SimpleCV is only used through the methods of the images given to "parse_frame",
+so importing this module does not load it.
 """
 
-from SimpleCV import *
+import numpy as np
 
 from simplify_polygon import simplify_polygon_by_angle
 
-class ParsedFrame:
+# Version of the parsing algorithm.  Increase this whenever "parse_frame" may
+# find different features, so that stored results (e.g. sidecar files) are
+# rebuilt.
+PARSER_VERSION = 1
+
+# reasons that "parse_frame" can fail
+NO_BLOBS = 'no blobs found'
+NO_CENTER_BLOB = 'no blob around the center'
+
+class ParsedFrame(object):
     """
     This holds the features that we wish to extract from a Super Hexagon frame.
+
+    Only the center point and vertices are kept by default, so a parsed frame
+    is a few hundred bytes that are cheap to queue, cache and pickle (e.g. to
+    send to worker processes).  The images used to find those features are
+    only kept when requested for debugging.
     """
 
-    def __init__(self, img, center_blob, center_img):
+    __slots__ = ('center_point', 'center_vertices', 'img', 'center_img', 'center_blob')
+
+    def __init__(self, center_point, center_vertices, img=None, center_blob=None, center_img=None):
         """
-        img         = SimpleCV Image object of the original image
-        center_blob = SimpleCV Blob object of the center polygon
-        center_img  = SimpleCV Image object used to detect center polygon
+        center_point    = (x,y) midpoint of the center polygon
+        center_vertices = sequence of (x,y) vertices of the center polygon
+        img             = SimpleCV Image object of the original image (debug only)
+        center_blob     = SimpleCV Blob object of the center polygon (debug only)
+        center_img      = SimpleCV Image object used to detect center polygon (debug only)
         """
 
+        self.center_point = tuple(center_point)
+        self.center_vertices = np.array(center_vertices, np.float32).reshape(-1,2)
+
         self.img = img
         self.center_img = center_img
         self.center_blob = center_blob
 
-        # midpoint of the center polygon
-        # (Just assume center of image is center point instead of using
-        # center_blob.centroid())
-        w,h = img.size()
-        self.center_point = (w/2, h/2)
+    def __getstate__(self):
+        # Only pickle the features, never the debug images.
+        return (self.center_point, self.center_vertices.tostring())
 
-        # vertices of the center polygon
-        # (remove redundant vertices)
-        self.center_vertices = simplify_polygon_by_angle(center_blob.hull())
-    
-    def draw_frame(self, layer, linecolor=Color.RED, pointcolor=Color.WHITE):
+    def __setstate__(self, state):
+        center_point, vertices = state
+        self.center_point = center_point
+        self.center_vertices = np.fromstring(vertices, np.float32).reshape(-1,2)
+        self.img = self.center_img = self.center_blob = None
+
+    def scaled(self, sx, sy=None, center_point=None):
+        """
+        Get a copy of this frame's features for an image scaled by the given
+        factors (e.g. to map features parsed at a lower resolution back).
+
+        center_point = the center point of the scaled image, if known exactly
+        """
+        if sy is None:
+            sy = sx
+        if center_point is None:
+            center_point = (self.center_point[0]*sx, self.center_point[1]*sy)
+        return ParsedFrame(center_point, self.center_vertices * np.float32((sx,sy)))
+
+    def draw_frame(self, layer, linecolor=(255,0,0), pointcolor=(255,255,255)):
         """
         Draw the reference frame created by our detected features.
         (for debugging)
@@ -43,12 +80,13 @@ class ParsedFrame:
 
         # Draw the center polygon.
         width = 10
-        layer.polygon(self.center_vertices, color=linecolor,width=width)
+        vertices = [tuple(p) for p in self.center_vertices]
+        layer.polygon(vertices, color=linecolor,width=width)
 
         # Draw the axes by extending lines from the center past the vertices.
         c = self.center_point
         length = 100
-        for p in self.center_vertices:
+        for p in vertices:
             p2 = (c[0] + length*(p[0]-c[0]), c[1] + length*(p[1]-c[1]))
             layer.line(c,p2,color=linecolor,width=width)
         
@@ -57,13 +95,17 @@ class ParsedFrame:
             layer.circle(p, 10, color=linecolor, filled=True)
             layer.circle(p, 5, color=pointcolor, filled=True)
         circle(self.center_point)
-        for p in self.center_vertices:
+        for p in vertices:
             circle(p)
 
-def parse_frame(img):
+def parse_frame(img, debug=False, report=None):
     """
     Parses a SimpleCV image object of a frame from Super Hexagon.
     Returns a ParsedFrame object containing selected features.
+
+    debug  = keep the images and blob used for parsing in the ParsedFrame
+    report = optional dict that receives the reason parsing failed
+             (as its "failure" item)
     """
 
     # helper image size variables
@@ -104,15 +146,45 @@ def parse_frame(img):
                 continue
 
     if center_blob:
-        return ParsedFrame(img, center_blob, center_img)
+        # midpoint of the center polygon
+        # (Just assume center of image is center point instead of using
+        # center_blob.centroid())
+        center_point = (midx, midy)
+
+        # vertices of the center polygon
+        # (remove redundant vertices)
+        center_vertices = simplify_polygon_by_angle(center_blob.hull())
+
+        if debug:
+            return ParsedFrame(center_point, center_vertices, img, center_blob, center_img)
+        return ParsedFrame(center_point, center_vertices)
     else:
+        if report is not None:
+            report["failure"] = NO_CENTER_BLOB if blobs else NO_BLOBS
         return None
 
+def parse_frame_scaled(img, scale, report=None):
+    """
+    Parses a frame at a fraction of its resolution, which is faster, and maps
+    the features back to the full resolution.  (Vertices are less accurate.)
+    """
+    if scale == 1.0:
+        return parse_frame(img, report=report)
+    w,h = img.size()
+    small = img.scale(scale)
+    sw,sh = small.size()
+    frame = parse_frame(small, report=report)
+    if frame:
+        frame = frame.scaled(float(w)/sw, float(h)/sh, (w/2,h/2))
+    return frame
+
 if __name__ == "__main__":
 
+    from SimpleCV import Display, Image
+
     # Run a test by drawing the reference frame parsed from a screenshot.
     display = Display()
-    p = parse_frame(Image('test.jpg'))
+    p = parse_frame(Image('test.jpg'), debug=True)
     if p:
         img = p.center_img.binarize()
         p.draw_frame(img.dl())
@@ -0,0 +1,339 @@
+"""
+A local HTTP server that previews the pipeline while it runs, so progress can
+be watched from a browser (e.g. through an SSH tunnel to a headless machine)
+instead of from windows on the processing machine.
+
+    /               page showing both streams and the status
+    /orig.mjpg      MJPEG stream of the latest original frames
+    /unwrap.mjpg    MJPEG stream of the latest unwrapped frames
+    /orig.jpg       latest original frame   (same for unwrap)
+    /status.json    frame index, fps, failure rate, ...
+
+The pipeline only hands frames over (see "wants" and "publish"), which is a
+copy into a spare buffer, and only when a client is watching that stream and
+the preview rate allows it.  JPEG encoding happens in a thread of its own, and
+each client is sent the newest encoded frame whenever it is ready for one, so
+slow clients skip frames instead of slowing the pipeline down.
+
+The server is also a metrics hook (see "metrics.py"), which keeps the status
+up to date, and it is closed along with the metrics.
+
+See unit tests at the end of this file.
+"""
+
+import json
+import threading
+import timeit
+import BaseHTTPServer
+import SocketServer
+
+import numpy as np
+
+timer = timeit.default_timer
+
+DEFAULT_PORT = 8090
+
+# names of the previewed streams
+STREAMS = ('orig', 'unwrap')
+
+# separator of the frames of an MJPEG stream
+BOUNDARY = 'frame'
+
+PAGE = """<!DOCTYPE html>
+<html><head><title>Super Hexagon unwrap preview</title></head>
+<body style="background:#111; color:#ccc; font-family:monospace">
+<img src="/orig.mjpg" style="max-width:49%%"> <img src="/unwrap.mjpg" style="max-width:49%%">
+<pre id="status"></pre>
+<script>
+setInterval(function() {
+    var req = new XMLHttpRequest();
+    req.onload = function() { document.getElementById('status').textContent = req.responseText; };
+    req.open('GET', '/status.json');
+    req.send();
+}, %(interval)d);
+</script>
+</body></html>
+"""
+
+def encode_jpeg(img, quality=80):
+    """Encode a BGR array as JPEG bytes."""
+    import cv2
+    ok, data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return data.tostring()
+
+class PreviewStream:
+    """
+    The frame handed over for encoding, and the latest encoded frame, of one
+    stream.
+    """
+
+    def __init__(self):
+        self.pending = None
+        self.spare = None
+        self.jpeg = None
+        self.sequence = 0
+        self.clients = 0
+        self.last_publish = None
+
+class PreviewServer:
+    """
+    Serves the latest frames and status of the pipeline over HTTP.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, host='127.0.0.1', max_fps=10.0, encode=encode_jpeg):
+        """
+        port    = port to listen on (0 = any free port, see "port")
+        host    = address to listen on (only this machine by default)
+        max_fps = max rate of the frames handed over for each stream
+        encode  = function(BGR array) returning the encoded JPEG bytes
+        """
+        self.max_fps = max_fps
+        self.encode = encode
+        self.cond = threading.Condition()
+        self.streams = dict((name, PreviewStream()) for name in STREAMS)
+        self.status = {"frame": None, "frames": 0, "fps": 0.0, "failures": 0, "failure_rate": 0.0}
+        self.closed = False
+
+        self.httpd = PreviewHTTPServer((host, port), PreviewHandler)
+        self.httpd.preview = self
+        self.port = self.httpd.server_address[1]
+
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever)
+        self.server_thread.daemon = True
+        self.encoder_thread = threading.Thread(target=self.run_encoder)
+        self.encoder_thread.daemon = True
+
+    def start(self):
+        self.server_thread.start()
+        self.encoder_thread.start()
+        return self
+
+    def wants(self, name):
+        """
+        Determines if a frame of the given stream should be published now,
+        i.e. someone is watching it and the preview rate allows it.  (Check
+        first, so that frames are not read back or converted for nothing.)
+        """
+        stream = self.streams[name]
+        if not stream.clients:
+            return False
+        return stream.last_publish is None or timer() - stream.last_publish >= 1.0 / self.max_fps
+
+    def publish(self, name, img):
+        """
+        Hand a frame (BGR array) of the given stream over for encoding.  It is
+        copied, so the caller can reuse its array right away.  A frame that
+        was not encoded yet is replaced.
+        """
+        stream = self.streams[name]
+        stream.last_publish = timer()
+        with self.cond:
+            buf = stream.spare
+            if buf is None or buf.shape != img.shape:
+                buf = np.empty(img.shape, np.uint8)
+            stream.spare = None
+            np.copyto(buf, img)
+            if stream.pending is not None:
+                stream.spare = stream.pending
+            stream.pending = buf
+            self.cond.notify_all()
+
+    def run_encoder(self):
+        """Encode the frames that are handed over (run by the thread)."""
+        while True:
+            with self.cond:
+                while not self.closed and all(s.pending is None for s in self.streams.itervalues()):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                work = []
+                for name, stream in self.streams.iteritems():
+                    if stream.pending is not None:
+                        work.append((stream, stream.pending))
+                        stream.pending = None
+            for stream, img in work:
+                jpeg = self.encode(img)
+                with self.cond:
+                    stream.jpeg = jpeg
+                    stream.sequence += 1
+                    if stream.spare is None:
+                        stream.spare = img
+                    self.cond.notify_all()
+
+    def wait_jpeg(self, name, after, timeout=1.0):
+        """
+        Wait for an encoded frame of the given stream newer than the given
+        sequence number.  Returns (sequence, jpeg), or None on timeout.
+        """
+        stream = self.streams[name]
+        with self.cond:
+            if stream.sequence <= after and not self.closed:
+                self.cond.wait(timeout)
+            if stream.sequence <= after:
+                return None
+            return stream.sequence, stream.jpeg
+
+    def add_client(self, stream, count):
+        """Count the clients watching a stream."""
+        with self.cond:
+            stream.clients += count
+
+    def set_status(self, **fields):
+        """Set fields of the JSON status."""
+        with self.cond:
+            self.status.update(fields)
+
+    def get_status(self):
+        with self.cond:
+            status = dict(self.status)
+            status["clients"] = dict((name, s.clients) for name, s in self.streams.iteritems())
+            status["encoded"] = dict((name, s.sequence) for name, s in self.streams.iteritems())
+        return status
+
+    def __call__(self, record):
+        """Update the status from the record of a frame (called by Metrics)."""
+        frames = self.status["frames"] + 1
+        failures = self.status["failures"] + bool(record.get("failure"))
+        self.set_status(
+            frame = record["frame"],
+            frames = frames,
+            fps = frames / record["time"] if record["time"] else 0.0,
+            failures = failures,
+            failure_rate = float(failures) / frames,
+            last_frame_ms = record["total_ms"])
+
+    def close(self):
+        """Stop serving, and disconnect the clients."""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class PreviewHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class PreviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        preview = self.server.preview
+        path = self.path.split('?')[0]
+        if path == '/':
+            self.send_body('text/html', PAGE % {"interval": 500})
+        elif path == '/status.json':
+            self.send_body('application/json', json.dumps(preview.get_status(), indent=2, sort_keys=True))
+        elif path.endswith('.mjpg') and path[1:-5] in STREAMS:
+            self.send_stream(path[1:-5])
+        elif path.endswith('.jpg') and path[1:-4] in STREAMS:
+            stream = preview.streams[path[1:-4]]
+            preview.add_client(stream, +1)
+            try:
+                frame = preview.wait_jpeg(path[1:-4], 0, timeout=5.0)
+            finally:
+                preview.add_client(stream, -1)
+            if frame:
+                self.send_body('image/jpeg', frame[1])
+            else:
+                self.send_error(503, 'no frame yet')
+        else:
+            self.send_error(404)
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, name):
+        """Send the newest frames of a stream until the client leaves."""
+        preview = self.server.preview
+        stream = preview.streams[name]
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % BOUNDARY)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        preview.add_client(stream, +1)
+        try:
+            sequence = 0
+            while not preview.closed:
+                frame = preview.wait_jpeg(name, sequence)
+                if frame is None:
+                    continue
+                sequence, jpeg = frame
+                self.wfile.write('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (BOUNDARY, len(jpeg)))
+                self.wfile.write(jpeg)
+                self.wfile.write('\r\n')
+                self.wfile.flush()
+        except IOError:
+            # The client left.
+            pass
+        finally:
+            preview.add_client(stream, -1)
+
+    def log_message(self, format, *args):
+        # (do not write over the progress line of the pipeline)
+        pass
+
+######################################################################
+
+import unittest
+import httplib
+import time
+
+def encode_raw(img):
+    """A stand-in for JPEG encoding, which keeps the first pixel."""
+    return str(int(img.flat[0]))
+
+class TestPreviewServer(unittest.TestCase):
+
+    def setUp(self):
+        self.preview = PreviewServer(port=0, max_fps=1000, encode=encode_raw).start()
+
+    def tearDown(self):
+        self.preview.close()
+
+    def get(self, path):
+        conn = httplib.HTTPConnection('127.0.0.1', self.preview.port, timeout=5)
+        conn.request('GET', path)
+        return conn.getresponse()
+
+    def test_nobody_watching(self):
+        """Assert that no frames are wanted without clients."""
+        self.assertFalse(self.preview.wants('unwrap'))
+
+    def test_status(self):
+        self.preview({"frame": 7, "time": 2.0, "total_ms": 10.0, "failure": "no blobs found"})
+        self.preview({"frame": 8, "time": 2.0, "total_ms": 10.0})
+        status = json.loads(self.get('/status.json').read())
+        self.assertEqual(status["frame"], 8)
+        self.assertEqual(status["fps"], 1.0)
+        self.assertEqual(status["failure_rate"], 0.5)
+
+    def test_stream(self):
+        """Assert that a client gets the newest frame, skipping older ones."""
+        for i in xrange(5):
+            self.preview.publish('unwrap', np.full((2,2,3), i, np.uint8))
+        while self.preview.streams['unwrap'].jpeg != '4':
+            time.sleep(0.01)
+
+        response = self.get('/unwrap.mjpg')
+        self.assertTrue(response.getheader('Content-Type').startswith('multipart/x-mixed-replace'))
+        self.assertTrue(self.preview.wants('unwrap'))
+        response.fp.readline()
+        headers = response.fp.readline() + response.fp.readline()
+        self.assertTrue('image/jpeg' in headers)
+        length = int(headers.split('Content-Length:')[1].split()[0])
+        response.fp.readline()
+        self.assertEqual(response.fp.read(length), '4')
+        self.assertTrue(self.preview.streams['unwrap'].sequence <= 5)
+
+    def test_not_found(self):
+        self.assertEqual(self.get('/nothing').status, 404)
+
+if __name__ == "__main__":
+    unittest.main()
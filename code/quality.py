@@ -0,0 +1,233 @@
+"""
+Adjusts the quality of the unwrap pipeline to hold a target frame rate.
+
+The controller is a metrics hook (see "metrics.py"): it watches the time spent
+in each stage over a window of frames, and when the frame rate falls below the
+target it degrades the setting that cuts the slowest stage:
+
+    parse_scale  = fraction of the resolution that frames are parsed at
+    parse_every  = parse every Nth frame, reusing the previous ParsedFrame
+                   in between
+    filter       = texture sampling of the unwrap shader ('linear' or 'nearest')
+    output_scale = fraction of the window size that frames are unwrapped at
+
+When the frame rate is comfortably above the target again, the latest
+degradation is undone.  A setting that has to be degraded again right after
+being recovered waits twice as long before its next recovery, so that the
+controller settles instead of flipping back and forth.
+
+Every adjustment is logged with its reason.
+
+See unit tests at the end of this file.
+"""
+
+# (name, values from best to worst quality, stages whose time it cuts)
+KNOBS = [
+    ('parse_scale',  [1.0, 0.75, 0.5],      ['parse']),
+    ('parse_every',  [1, 2, 3, 4],          ['parse']),
+    ('filter',       ['linear', 'nearest'], ['draw']),
+    ('output_scale', [1.0, 0.75, 0.5],      ['draw', 'save_unwrap']),
+]
+
+class QualityController:
+    """
+    A metrics hook that adjusts quality "settings" to hold a target frame
+    rate (measured from the time spent on each frame).
+    """
+
+    def __init__(self, target_fps, knobs=None, window=15, headroom=1.25, log=None, metrics=None):
+        """
+        target_fps = frame rate to hold
+        knobs      = names of the settings that may be adjusted
+                     (defaults to all of KNOBS)
+        window     = number of frames measured before each decision
+        headroom   = how far above the target the frame rate must be before
+                     quality is recovered (1.25 = 25% above)
+        log        = function(message) called with every adjustment
+        metrics    = optional Metrics object whose gauges are set to the
+                     current settings (so they are in every frame's record)
+        """
+        self.target_fps = target_fps
+        self.window = window
+        self.headroom = headroom
+        self.log = log
+        self.metrics = metrics
+
+        self.knobs = [k for k in KNOBS if knobs is None or k[0] in knobs]
+        self.levels = dict((name, 0) for name, values, stages in self.knobs)
+        self.settings = dict((name, values[0]) for name, values, stages in KNOBS)
+
+        # names of the degraded knobs, latest last
+        self.degraded = []
+
+        # number of good windows needed before recovering each knob, and the
+        # number of good windows in a row so far
+        self.backoff = dict((name, 1) for name, values, stages in self.knobs)
+        self.calm = 0
+        self.last_recovered = None
+
+        self.records = []
+        self.since_parse = None
+        self.adjustments = []
+        self.update_gauges()
+
+    def __call__(self, record):
+        """Measure the record of a frame (called by Metrics)."""
+        self.records.append(record)
+        if len(self.records) >= self.window:
+            self.decide(self.records[-1].get("frame"))
+            self.records = []
+
+    def get_stage_ms(self):
+        """Get the mean milliseconds of a frame and of each of its stages."""
+        count = len(self.records)
+        stages = {}
+        for record in self.records:
+            for stage, ms in record["stages"].iteritems():
+                stages[stage] = stages.get(stage, 0.0) + ms / count
+        total = sum(record["total_ms"] for record in self.records) / count
+        return total, stages
+
+    def decide(self, frame=None):
+        """Degrade or recover the quality after a window of frames."""
+        total, stages = self.get_stage_ms()
+        fps = 1000.0 / total if total > 0 else float('inf')
+
+        if fps < self.target_fps:
+            self.calm = 0
+
+            # Degrade the knob that cuts the most time.
+            best = None
+            for name, values, knob_stages in self.knobs:
+                if self.levels[name] + 1 < len(values):
+                    ms = sum(stages.get(stage, 0.0) for stage in knob_stages)
+                    if ms > 0 and (best is None or ms > best[1]):
+                        best = (name, ms)
+            if best is None:
+                return
+            name, ms = best
+            if name == self.last_recovered:
+                self.backoff[name] *= 2
+            self.last_recovered = None
+            self.degraded.append(name)
+            self.adjust(frame, name, +1, '%.1f fps is below the target of %.1f fps, %s take %.1f of %.1f ms' % (
+                fps, self.target_fps, '+'.join(self.get_stages(name)), ms, total))
+
+        elif self.degraded and fps > self.target_fps * self.headroom:
+            self.calm += 1
+            name = self.degraded[-1]
+            if self.calm >= self.backoff[name]:
+                self.calm = 0
+                self.degraded.pop()
+                self.last_recovered = name
+                self.adjust(frame, name, -1, '%.1f fps is above the target of %.1f fps with room to spare' % (
+                    fps, self.target_fps))
+        else:
+            self.calm = 0
+
+    def get_stages(self, name):
+        for knob, values, stages in self.knobs:
+            if knob == name:
+                return stages
+
+    def adjust(self, frame, name, step, reason):
+        """Move the given knob by a step (+1 = lower quality) and log it."""
+        values = [v for knob, v, stages in self.knobs if knob == name][0]
+        old = self.settings[name]
+        self.levels[name] += step
+        self.settings[name] = values[self.levels[name]]
+        adjustment = {
+            "frame": frame,
+            "setting": name,
+            "old": old,
+            "new": self.settings[name],
+            "reason": reason,
+        }
+        self.adjustments.append(adjustment)
+        self.update_gauges()
+        if self.log:
+            self.log('frame %s: %s %s -> %s (%s)' % (frame, name, old, self.settings[name], reason))
+
+    def update_gauges(self):
+        if self.metrics:
+            for name, value in self.settings.iteritems():
+                self.metrics.set_gauge(name, value)
+
+    def should_parse(self):
+        """
+        Determines if the current frame should be parsed, or if the previous
+        ParsedFrame should be reused.  (Call once per frame.)
+        """
+        if self.since_parse is None or self.since_parse + 1 >= self.settings["parse_every"]:
+            self.since_parse = 0
+            return True
+        self.since_parse += 1
+        return False
+
+######################################################################
+
+import unittest
+
+def make_record(frame, parse_ms, draw_ms):
+    return {
+        "frame": frame,
+        "stages": {"parse": parse_ms, "draw": draw_ms},
+        "total_ms": parse_ms + draw_ms,
+    }
+
+class TestQualityController(unittest.TestCase):
+
+    def run_frames(self, controller, count, parse_ms, draw_ms):
+        """Feed frames whose stages are scaled by the current settings."""
+        for i in xrange(count):
+            s = controller.settings
+            parse = parse_ms * s["parse_scale"]**2 / s["parse_every"]
+            draw = draw_ms * s["output_scale"]**2 * (0.8 if s["filter"] == 'nearest' else 1.0)
+            controller(make_record(i, parse, draw))
+
+    def test_degrade_slowest(self):
+        """Assert that the setting of the slowest stage is degraded first."""
+        controller = QualityController(30, window=5)
+        self.run_frames(controller, 5, 40, 10)
+        self.assertEqual(controller.settings["parse_scale"], 0.75)
+        self.assertEqual(controller.adjustments[0]["setting"], 'parse_scale')
+        self.assertTrue('below the target' in controller.adjustments[0]["reason"])
+
+    def test_hold_and_recover(self):
+        """Assert that the target is reached, and quality recovered later."""
+        controller = QualityController(30, window=5)
+        self.run_frames(controller, 100, 40, 10)
+        s = controller.settings
+        self.assertTrue(40 * s["parse_scale"]**2 / s["parse_every"] + 10 <= 1000/30.0)
+
+        # Let the load drop, and the quality recover completely.
+        self.run_frames(controller, 200, 5, 5)
+        self.assertEqual(controller.degraded, [])
+        self.assertEqual(controller.settings["parse_scale"], 1.0)
+        self.assertEqual(controller.adjustments[-1]["old"], 0.75)
+
+    def test_backoff(self):
+        """Assert that a setting that flips back is recovered less often."""
+        controller = QualityController(30, window=1)
+        self.run_frames(controller, 1, 30, 5)
+        self.assertEqual(controller.settings["parse_scale"], 0.75)
+        self.run_frames(controller, 20, 30, 5)
+        self.assertTrue(controller.backoff["parse_scale"] > 1)
+        flips = len(controller.adjustments)
+        self.run_frames(controller, 20, 30, 5)
+        self.assertTrue(len(controller.adjustments) - flips < 10)
+
+    def test_knobs(self):
+        controller = QualityController(30, knobs=['filter'], window=1)
+        self.run_frames(controller, 3, 100, 10)
+        self.assertEqual(controller.settings["parse_scale"], 1.0)
+        self.assertEqual(controller.settings["filter"], 'nearest')
+
+    def test_should_parse(self):
+        controller = QualityController(30)
+        controller.settings["parse_every"] = 3
+        self.assertEqual([controller.should_parse() for i in xrange(7)],
+            [True, False, False, True, False, False, True])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,273 @@
+"""
+A ring of fixed-size frame slots in shared memory, for handing frames between
+processes without pickling them.
+
+The pixels never leave the shared memory: a producer fills a free slot in
+place and passes only the slot number and the frame index to the consumers,
+which read the slot in place as a NumPy view and then give it back.
+
+    ring = FrameRing(slots=8, shape=(720,1280,3))
+
+    # producer (e.g. the decoder process)
+    slot = ring.acquire_free()
+    ring.view(slot)[:] = img
+    ring.commit(slot, i)
+
+    # consumers (e.g. parse and render workers)
+    slot, i = ring.acquire_full()
+    ... ring.view(slot) ...
+    ring.release(slot)
+
+The ring must be created before the processes that share it are started.
+Output frames can flow back through a second ring.
+
+    Measure the throughput against pickling frames through a queue:
+    > python ring.py --benchmark --size 1920x1080
+
+See unit tests at the end of this file.
+"""
+
+import multiprocessing
+import timeit
+
+import numpy as np
+
+class FrameRing:
+    """
+    Fixed-size frame slots in shared memory, with queues of the slot numbers
+    that are free and the ones that hold a frame.
+    """
+
+    def __init__(self, slots, shape, dtype=np.uint8):
+        """
+        slots = number of frame slots (how far the producer can run ahead)
+        shape = shape of the array of each frame, e.g. (height,width,3)
+        dtype = NumPy type of the frame pixels
+        """
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.buffer = multiprocessing.RawArray('b', slots * frame_size)
+        self.free = multiprocessing.Queue()
+        self.full = multiprocessing.Queue()
+        for slot in xrange(slots):
+            self.free.put(slot)
+
+        # the views of the slots in the current process
+        self.views = None
+
+    def view(self, slot):
+        """Get the array of the given slot (in place, not a copy)."""
+        if self.views is None:
+            self.views = np.frombuffer(self.buffer, self.dtype).reshape((self.slots,) + self.shape)
+        return self.views[slot]
+
+    def acquire_free(self, timeout=None):
+        """
+        Get the number of a free slot to write a frame into, waiting for one
+        to be released if they are all in use.
+        """
+        return self.free.get(timeout=timeout)
+
+    def commit(self, slot, index):
+        """Pass the written slot (holding the frame of the given index) on."""
+        self.full.put((slot, index))
+
+    def acquire_full(self, timeout=None):
+        """
+        Get the (slot, index) of the next written frame, waiting for one.
+        Returns None once the producer has called "finish".
+        """
+        return self.full.get(timeout=timeout)
+
+    def release(self, slot):
+        """Give a slot that was read back to the producer."""
+        self.free.put(slot)
+
+    def finish(self, consumers=1):
+        """Tell the given number of consumers that no more frames will come."""
+        for n in xrange(consumers):
+            self.full.put(None)
+
+    def close(self, timeout=None):
+        """
+        Take back every slot once the other processes are done with the ring,
+        and close its queues in this process.  (This waits for the slot
+        numbers put by this process to be sent, which fails with a broken
+        pipe if the ring is dropped while they are still being sent.)
+        """
+        for n in xrange(self.slots):
+            self.acquire_free(timeout)
+        for queue in (self.free, self.full):
+            queue.close()
+            queue.join_thread()
+
+    def __getstate__(self):
+        # (views are made again in each process)
+        state = self.__dict__.copy()
+        state['views'] = None
+        return state
+
+def produce_frames(ring, frames, consumers=1):
+    """Write the given (index, array) frames into the ring."""
+    for i, img in frames:
+        slot = ring.acquire_free()
+        ring.view(slot)[...] = img
+        ring.commit(slot, i)
+    ring.finish(consumers)
+
+def consume_frames(ring, func, out_ring=None):
+    """
+    Call func(index, array) on each frame of the ring until it is finished.
+    If an output ring is given, the results (arrays of its shape) are written
+    into it.
+    """
+    while True:
+        item = ring.acquire_full()
+        if item is None:
+            break
+        slot, i = item
+        result = func(i, ring.view(slot))
+        ring.release(slot)
+        if out_ring is not None:
+            out_slot = out_ring.acquire_free()
+            out_ring.view(out_slot)[...] = result
+            out_ring.commit(out_slot, i)
+
+######################################################################
+# Benchmark against pickling the frames through a queue.
+
+def checksum(i, img):
+    """A cheap function that reads part of every row of a frame."""
+    return int(img[:, ::64].sum())
+
+def consume_ring(ring, results):
+    total = 0
+    count = 0
+    while True:
+        item = ring.acquire_full()
+        if item is None:
+            break
+        slot, i = item
+        total += checksum(i, ring.view(slot))
+        count += 1
+        ring.release(slot)
+    results.put((count, total))
+
+def consume_queue(queue, results):
+    total = 0
+    count = 0
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        i, img = item
+        total += checksum(i, img)
+        count += 1
+    results.put((count, total))
+
+def benchmark(shape, count, slots, consumers):
+    """
+    Time handing the given number of frames from this process to the given
+    number of consumer processes, through a ring and through a queue.
+    Returns the frames per second of each.
+    """
+    img = np.random.randint(0, 256, shape).astype(np.uint8)
+    results = {}
+
+    ring = FrameRing(slots, shape)
+    done = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=consume_ring, args=(ring, done)) for n in xrange(consumers)]
+    for p in processes:
+        p.start()
+    start = timeit.default_timer()
+    produce_frames(ring, ((i, img) for i in xrange(count)), consumers)
+    received = sum(done.get()[0] for p in processes)
+    results["ring"] = count / (timeit.default_timer() - start)
+    for p in processes:
+        p.join()
+    ring.close()
+    assert received == count
+
+    queue = multiprocessing.Queue(maxsize=slots)
+    processes = [multiprocessing.Process(target=consume_queue, args=(queue, done)) for n in xrange(consumers)]
+    for p in processes:
+        p.start()
+    start = timeit.default_timer()
+    for i in xrange(count):
+        queue.put((i, img))
+    for p in processes:
+        queue.put(None)
+    received = sum(done.get()[0] for p in processes)
+    results["pickle"] = count / (timeit.default_timer() - start)
+    for p in processes:
+        p.join()
+    assert received == count
+
+    return results
+
+######################################################################
+
+import unittest
+
+def invert(i, img):
+    return 255 - img
+
+def run_consumer(ring, out_ring):
+    consume_frames(ring, invert, out_ring)
+
+class TestFrameRing(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Assert that frames reach another process and come back intact."""
+        shape = (6,8,3)
+        ring = FrameRing(2, shape)
+        out_ring = FrameRing(2, shape)
+        worker = multiprocessing.Process(target=run_consumer, args=(ring, out_ring))
+        worker.start()
+
+        frames = [(i, np.full(shape, i, np.uint8)) for i in xrange(5)]
+        producer = multiprocessing.Process(target=produce_frames, args=(ring, frames))
+        producer.start()
+
+        for n in xrange(len(frames)):
+            slot, i = out_ring.acquire_full(timeout=10)
+            self.assertTrue((out_ring.view(slot) == 255 - i).all())
+            out_ring.release(slot)
+        producer.join()
+        worker.join()
+        ring.close(timeout=10)
+        out_ring.close(timeout=10)
+
+    def test_view_in_place(self):
+        ring = FrameRing(3, (2,2))
+        slot = ring.acquire_free()
+        ring.view(slot)[:] = 7
+        self.assertEqual(np.frombuffer(ring.buffer, np.uint8).sum(), 7*4)
+        ring.release(slot)
+        ring.close(timeout=10)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--benchmark', action='store_true', help='measure the throughput against pickling')
+    parser.add_argument('--size', metavar='WxH', default='1280x720', help='size of the frames (default 1280x720)')
+    parser.add_argument('--count', metavar='N', type=int, default=300, help='number of frames (default 300)')
+    parser.add_argument('--slots', metavar='N', type=int, default=8, help='number of ring slots (default 8)')
+    parser.add_argument('--consumers', metavar='N', type=int, default=2, help='number of consumer processes (default 2)')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        w,h = map(int, args.size.split('x'))
+        results = benchmark((h,w,3), args.count, args.slots, args.consumers)
+        print '%-8s %9s' % ('method', 'fps')
+        for method in ('pickle', 'ring'):
+            print '%-8s %9.1f' % (method, results[method])
+    else:
+        # Run the unit tests.
+        unittest.main(argv=[__file__])
@@ -0,0 +1,338 @@
+"""
+A compact file stored next to a video that remembers the parsed features of
+each of its frames, so that re-rendering a video (e.g. with a different output
+size, crop or encoder) can skip the Computer Vision entirely.
+
+The file is keyed by a hash of the video's content and by the version of the
+parser, so it is rebuilt whenever either of them changes.  Its columns are
+memory-mapped, so loading it is instant and frames that were not parsed yet
+are filled in as they are processed.
+
+File layout:
+
+    header   (HEADER_SIZE bytes, see HEADER_FORMAT)
+    status   uint8   [capacity]                      (MISSING, FAILED or PARSED)
+    center   float32 [capacity][2]                   (center point)
+    count    uint8   [capacity]                      (number of vertices)
+    vertices float32 [capacity][MAX_VERTICES][2]     (center polygon vertices)
+
+The row of each column is the frame index.
+
+See unit tests at the end of this file.
+"""
+
+import os
+import re
+import struct
+import hashlib
+
+import numpy as np
+
+from parse import ParsedFrame, PARSER_VERSION, parse_frame_scaled
+from simplify_polygon import simplify_polygon_to_count
+from source import is_image_sequence, list_image_sequence
+
+MAGIC = 'SHXPARSE'
+FORMAT_VERSION = 1
+
+# magic, format version, parser version, capacity, max vertices, video key
+HEADER_FORMAT = '<8sIIII40s'
+HEADER_SIZE = 128
+
+# Frames with more vertices than this are not stored.
+MAX_VERTICES = 16
+
+# names of the columns in the order they are stored
+COLUMNS = ('status', 'center', 'count', 'vertices')
+
+# status of each frame
+MISSING = 0
+FAILED = 1
+PARSED = 2
+
+def get_sidecar_path(video_path):
+    """
+    Get the path of the sidecar file of the given video (or image sequence,
+    whose pattern characters are replaced, e.g. "frames/orig#.jpg.parse").
+    """
+    if is_image_sequence(video_path):
+        video_path = re.sub(r'%0?\d*d|[*?]', '#', video_path.rstrip('/\\'))
+    return video_path + '.parse'
+
+def get_video_key(video_path, chunk_size=1<<20):
+    """
+    Get a hash identifying the content of the given video file.
+
+    (Hashing a whole video is too slow, so only its size and a chunk from its
+    start, middle and end are hashed.  An image sequence is identified by the
+    names and sizes of its files.)
+    """
+    if is_image_sequence(video_path):
+        sha = hashlib.sha1()
+        for path in list_image_sequence(video_path):
+            sha.update('%s %d\n' % (os.path.basename(path), os.path.getsize(path)))
+        return sha.hexdigest()
+    size = os.path.getsize(video_path)
+    sha = hashlib.sha1(str(size))
+    with open(video_path, 'rb') as f:
+        for offset in (0, max(0, size/2 - chunk_size/2), max(0, size - chunk_size)):
+            f.seek(offset)
+            sha.update(f.read(chunk_size))
+    return sha.hexdigest()
+
+class ParseSidecar:
+    """
+    The memory-mapped parse results of every frame of one video.
+    """
+
+    def __init__(self, path, key, capacity=1024, log=None):
+        """
+        Open the sidecar file at the given path, or create it if it is missing
+        or was made for a different video (key) or parser version.
+
+        path     = path of the sidecar file
+        key      = hash of the video content (see "get_video_key")
+        capacity = initial number of frames to allocate if creating the file
+        log      = optional function(message) to report frames that had to be
+                   simplified to be stored
+        """
+        self.path = path
+        self.key = key
+        self.log = log
+
+        header = None
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read(struct.calcsize(HEADER_FORMAT))
+            if len(data) == struct.calcsize(HEADER_FORMAT):
+                header = struct.unpack(HEADER_FORMAT, data)
+
+        if (header is None or
+            header[0] != MAGIC or
+            header[1] != FORMAT_VERSION or
+            header[2] != PARSER_VERSION or
+            header[4] != MAX_VERTICES or
+            header[5] != key):
+            self.create(capacity)
+        else:
+            self.map(header[3])
+
+    def get_column_layout(self, capacity):
+        """Get the (name, dtype, shape, offset) of each column in the file."""
+        layout = []
+        offset = HEADER_SIZE
+        dtypes = {
+            'status':   (np.uint8,   (capacity,)),
+            'center':   (np.float32, (capacity,2)),
+            'count':    (np.uint8,   (capacity,)),
+            'vertices': (np.float32, (capacity,MAX_VERTICES,2)),
+        }
+        for name in COLUMNS:
+            dtype, shape = dtypes[name]
+            layout.append((name, dtype, shape, offset))
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return layout, offset
+
+    def create(self, capacity, columns=None):
+        """
+        Create a new file with the given capacity, copying the given columns
+        (dict of arrays) into it.  (The file is written to a temporary path
+        first, then renamed over the old one.)
+        """
+        layout, size = self.get_column_layout(capacity)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, PARSER_VERSION, capacity, MAX_VERTICES, self.key)
+            f.write(header.ljust(HEADER_SIZE, '\0'))
+            f.truncate(size)
+        if columns:
+            for name, dtype, shape, offset in layout:
+                column = np.memmap(tmp_path, dtype, 'r+', offset, shape)
+                src = columns[name]
+                column[:len(src)] = src
+                column.flush()
+                del column
+        os.rename(tmp_path, self.path)
+        self.map(capacity)
+
+    def map(self, capacity):
+        """Memory-map the columns of the file."""
+        self.capacity = capacity
+        layout, size = self.get_column_layout(capacity)
+        for name, dtype, shape, offset in layout:
+            setattr(self, name, np.memmap(self.path, dtype, 'r+', offset, shape))
+
+    def grow(self, min_capacity):
+        """Make room for at least the given number of frames."""
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        columns = dict((name, np.array(getattr(self, name))) for name in COLUMNS)
+        self.close()
+        self.create(capacity, columns)
+
+    def lookup(self, i):
+        """
+        Look up the parse result of the i-th frame.
+
+        Returns (found, frame) where:
+            found = False if the frame was not parsed yet
+            frame = ParsedFrame object, or None if parsing it failed
+        """
+        if i >= self.capacity:
+            return False, None
+        status = self.status[i]
+        if status == PARSED:
+            count = self.count[i]
+            return True, ParsedFrame(tuple(map(float, self.center[i])), self.vertices[i,:count])
+        return bool(status == FAILED), None
+
+    def store(self, i, frame):
+        """
+        Store the parse result (ParsedFrame object or None) of the i-th frame.
+        (A center polygon of more than MAX_VERTICES vertices is simplified to
+        fit, so that the frame is not parsed again in every run.)
+        """
+        if i >= self.capacity:
+            self.grow(i+1)
+        if frame is None:
+            self.status[i] = FAILED
+            return
+        vertices = frame.center_vertices
+        if len(vertices) > MAX_VERTICES:
+            if self.log:
+                self.log('simplified the %d vertices of frame %d to store them' % (len(vertices), i))
+            vertices = simplify_polygon_to_count(list(vertices), MAX_VERTICES)
+        self.center[i] = frame.center_point
+        self.count[i] = len(vertices)
+        self.vertices[i,:len(vertices)] = vertices
+        # (status is written last so a partially written frame stays missing)
+        self.status[i] = PARSED
+
+    def flush(self):
+        """Write any changes to disk."""
+        for name in COLUMNS:
+            getattr(self, name).flush()
+
+    def close(self):
+        """Write any changes to disk and unmap the file."""
+        self.flush()
+        for name in COLUMNS:
+            setattr(self, name, None)
+
+def open_video_sidecar(video_path, capacity=1024, log=None):
+    """
+    Open the sidecar file of the given video.  Returns None if it cannot be
+    written (e.g. a read-only directory).
+    """
+    try:
+        return ParseSidecar(get_sidecar_path(video_path), get_video_key(video_path), capacity, log)
+    except (IOError, OSError):
+        return None
+
+def get_parsed_frame(img, i, sidecar=None, metrics=None, scale=1.0, parse=None):
+    """
+    Parses the i-th frame of a video, unless its result is already stored in
+    the video's sidecar file.  The result is recorded in the metrics if given.
+
+    scale = fraction of the resolution to parse at (results parsed at a lower
+            resolution are not stored in the sidecar, since they are less
+            accurate)
+    parse = function(img, scale, report) to parse with instead of
+            "parse_frame_scaled" (e.g. "batchparse.parse_luma" for grayscale
+            arrays), whose results are not stored in the sidecar either,
+            since it is keyed by the version of "parse_frame"
+    """
+    found = False
+    if sidecar:
+        found, frame = sidecar.lookup(i)
+    if found:
+        report = {"failure": "failed in a previous run"}
+    else:
+        report = {}
+        if metrics:
+            frame = metrics.measure('parse', parse or parse_frame_scaled, img, scale, report)
+        else:
+            frame = (parse or parse_frame_scaled)(img, scale, report)
+        if sidecar and scale == 1.0 and parse is None:
+            sidecar.store(i, frame)
+    if metrics:
+        metrics.set(
+            cache_hit = found,
+            parsed = bool(frame),
+            vertices = len(frame.center_vertices) if frame else 0,
+            failure = None if frame else report.get("failure"))
+    return frame
+
+######################################################################
+
+import unittest
+import tempfile
+import shutil
+
+class TestParseSidecar(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'video.parse')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_frame(self, i):
+        return ParsedFrame((320,240), [(i,0),(0,i),(-i,0),(0,-i)])
+
+    def test_reopen(self):
+        """
+        Assert that stored frames are found again after reopening the file,
+        and frames that were never stored are reported as missing.
+        """
+        sidecar = ParseSidecar(self.path, 'a'*40, capacity=4)
+        sidecar.store(1, self.make_frame(1))
+        sidecar.store(2, None)
+        sidecar.store(10, self.make_frame(10))
+        sidecar.close()
+
+        sidecar = ParseSidecar(self.path, 'a'*40)
+        self.assertGreaterEqual(sidecar.capacity, 11)
+        self.assertEqual(sidecar.lookup(0), (False, None))
+        self.assertEqual(sidecar.lookup(2), (True, None))
+        for i in (1, 10):
+            found, frame = sidecar.lookup(i)
+            self.assertTrue(found)
+            self.assertEqual(frame.center_point, (320,240))
+            self.assertEqual(frame.center_vertices.tolist(), self.make_frame(i).center_vertices.tolist())
+        sidecar.close()
+
+    def test_too_many_vertices(self):
+        """Assert that a polygon of too many vertices is stored simplified."""
+        angles = np.linspace(0, 2*np.pi, 6, endpoint=False)
+        hexagon = np.column_stack((np.cos(angles), np.sin(angles))) * 100
+        # (with two points along each side, which are removed first)
+        vertices = []
+        for k in xrange(6):
+            a, b = hexagon[k], hexagon[(k+1) % 6]
+            vertices += [a, a + (b-a)/3, a + (b-a)*2/3]
+        logged = []
+        sidecar = ParseSidecar(self.path, 'a'*40, log=logged.append)
+        sidecar.store(0, ParsedFrame((320,240), vertices))
+        found, frame = sidecar.lookup(0)
+        self.assertTrue(found)
+        self.assertEqual(len(frame.center_vertices), MAX_VERTICES)
+        self.assertEqual(len(logged), 1)
+        sidecar.close()
+
+    def test_key_change(self):
+        """
+        Assert that a sidecar made for different video content is discarded.
+        """
+        sidecar = ParseSidecar(self.path, 'a'*40)
+        sidecar.store(0, self.make_frame(1))
+        sidecar.close()
+
+        sidecar = ParseSidecar(self.path, 'b'*40)
+        self.assertEqual(sidecar.lookup(0), (False, None))
+        sidecar.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,7 +19,8 @@ def vector_angle(v0,v1):
     """Get angle between two 2D vectors."""
     dot = v0[0]*v1[0] + v0[1]*v1[1]
     den = vector_len(v0) * vector_len(v1)
-    return math.acos(dot/den)
+    # (clamped, since rounding can push the cosine of straight angles past 1)
+    return math.acos(max(-1.0, min(1.0, dot/den)))
 
 class VertexNode:
     """
@@ -137,3 +138,19 @@ def simplify_polygon_by_angle(points, epsilon=math.pi*0.8):
         should_stop  = lambda node : node.angle < epsilon,
         refresh_node = lambda node : node.calc_angle())
 
+
+def simplify_polygon_to_count(points, count):
+    """
+    Simplify polygon by removing the vertices that are closest to sitting on a
+    straight line between its neighbors until only the given number is left.
+    """
+    remaining = [len(points)]
+    def should_stop(node):
+        if remaining[0] <= count:
+            return True
+        remaining[0] -= 1
+        return False
+    return simplify_polygon_by(points,
+        is_higher    = lambda a,b  : a.angle > b.angle,
+        should_stop  = should_stop,
+        refresh_node = lambda node : node.calc_angle())
@@ -0,0 +1,765 @@
+"""
+Reads the selected frames of a video, skipping the others as cheaply as the
+decoder allows.
+
+A selection is a list of frame ranges and a stride (take every Nth frame of
+each range).  Skipped frames are only grabbed from the video, which avoids
+converting them to images.
+
+Frames that are already on disk can be read without a video decoder, with
+random access to any frame (see "open_source"):
+
+    image sequence = a directory of numbered images (e.g. an "--out" dump of
+                     "orig" frames), a pattern such as "frames/orig%05d.jpg",
+                     or a glob such as "frames/orig*.jpg".  The images are
+                     decoded ahead of time by a pool of threads.  JPEG files
+                     can also be decoded at 1/2, 1/4 or 1/8 of their size
+                     for parsing (see "read_jpeg_luma").
+    raw video      = a file of frames of a fixed size and pixel format
+                     (".bgr", ".rgb" or ".yuv" for yuv420p, e.g. written by
+                     "ffmpeg -f rawvideo"), which is memory-mapped.
+
+SimpleCV is only loaded once a video is opened, so that the frame selection
+can be used (e.g. to parse command line options) without loading it.
+
+See unit tests at the end of this file.
+"""
+
+import os
+import re
+import sys
+import glob
+import threading
+import collections
+import Queue
+
+import numpy as np
+
+# image files of a sequence
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.shxp')
+
+# reductions of the JPEG decoder's DCT scaling
+DRAFT_REDUCTIONS = (2, 4, 8)
+
+# pixel format of the raw video files of each extension
+RAW_EXTENSIONS = {'.bgr': 'bgr24', '.rgb': 'rgb24', '.yuv': 'yuv420p'}
+RAW_FORMATS = ('bgr24', 'rgb24', 'yuv420p')
+
+# threads decoding the images of a sequence, and how many images they may
+# decode ahead of the one being processed
+PREFETCH_WORKERS = 4
+PREFETCH_WINDOW = 16
+
+def parse_ranges(text):
+    """
+    Parse a list of frame ranges such as "0-100,500-600,900-" into a list of
+    (start, stop) pairs, where stop is inclusive (-1 means the end of video).
+    A single number selects one frame.
+    """
+    ranges = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, stop = part.split('-', 1)
+            start = int(start) if start.strip() else 0
+            stop = int(stop) if stop.strip() else -1
+        else:
+            start = stop = int(part)
+        if stop >= 0 and stop < start:
+            raise ValueError('frame range "%s" ends before it starts' % part)
+        ranges.append((start, stop))
+    if not ranges:
+        raise ValueError('no frame ranges in "%s"' % text)
+    return ranges
+
+class FrameSelection:
+    """
+    The frames to process from a video: every stride-th frame of each range
+    (counted from the start of the range).
+    """
+
+    def __init__(self, ranges=((0,-1),), stride=1):
+        """
+        ranges = list of (start, stop) frame ranges (stop is inclusive,
+                 -1 means the end of the video)
+        stride = take every stride-th frame of each range
+        """
+        if stride < 1:
+            raise ValueError('stride must be at least 1')
+        self.ranges = sorted(ranges)
+        self.stride = stride
+
+    def contains(self, i):
+        """Determines if the i-th frame is selected."""
+        for start, stop in self.ranges:
+            if start <= i and (stop < 0 or i <= stop) and (i - start) % self.stride == 0:
+                return True
+        return False
+
+    def is_done(self, i):
+        """Determines if no frame at or after the i-th frame is selected."""
+        for start, stop in self.ranges:
+            if stop < 0 or i <= stop:
+                return False
+        return True
+
+    def first(self):
+        """Get the index of the first selected frame."""
+        return self.ranges[0][0]
+
+    def count(self, total):
+        """
+        Get the number of selected frames of a video with the given total.
+        (Frames in overlapping ranges are only counted once.)
+        """
+        selected = np.zeros(total, bool)
+        for start, stop in self.ranges:
+            if stop < 0 or stop >= total:
+                stop = total - 1
+            selected[start:stop+1:self.stride] = True
+        return int(np.count_nonzero(selected))
+
+    def indices(self, start=0):
+        """
+        Iterate over the indices of the selected frames at or after the given
+        index (endlessly if the last range is open).
+        """
+        i = max(start, self.first())
+        while not self.is_done(i):
+            if self.contains(i):
+                yield i
+            i += 1
+
+    def resume_at(self, i):
+        """
+        Get the selection of the frames of this one at or after the i-th frame
+        (keeping the stride of each range aligned to its original start).
+        """
+        ranges = []
+        for start, stop in self.ranges:
+            if stop >= 0 and stop < i:
+                continue
+            if start < i:
+                # round up to the next frame of the stride
+                start -= (start - i) // self.stride * self.stride
+                if stop >= 0 and stop < start:
+                    continue
+            ranges.append((start, stop))
+        return FrameSelection(ranges or [(i, i-1)], self.stride)
+
+def read_video_frame(video):
+    """
+    Read the next frame of a SimpleCV VirtualCamera, or None at the end of
+    the video.
+    """
+    img = video.getImage()
+    try:
+        w,h = img.size()
+    except:
+        return None
+    if not w or not h:
+        return None
+    return img
+
+class VideoSource:
+    """
+    Reads the frames of a video file in order, through SimpleCV.
+    """
+
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self.open()
+
+    def open(self):
+        """Open the video at its first frame."""
+        import SimpleCV as scv
+        self.video = scv.VirtualCamera(self.video_path, 'video')
+
+        # OpenCV bindings for grabbing frames and probing the video
+        self.cv = scv.cv
+
+        # index of the next frame
+        self.index = 0
+
+    def frame_count(self):
+        """
+        Get the number of frames in the video, as reported by its container,
+        or None if it is unknown.
+        """
+        capture = getattr(self.video, 'capture', None)
+        if capture is None:
+            return None
+        count = int(self.cv.GetCaptureProperty(capture, self.cv.CV_CAP_PROP_FRAME_COUNT))
+        return count if count > 0 else None
+
+    def seek(self, i):
+        """
+        Jump to the i-th frame without reading the frames before it.  This is
+        only exact at keyframes for most codecs, so the position is read back
+        (as a frame index, and as a time at the frame rate of the video), and
+        the video is opened again at its start if it did not land on the i-th
+        frame, so that the frames before it are skipped instead.  Returns
+        False (and stays put, or goes back to the start) if the video cannot
+        seek exactly.
+        """
+        capture = getattr(self.video, 'capture', None)
+        if capture is None:
+            return False
+        cv = self.cv
+        cv.SetCaptureProperty(capture, cv.CV_CAP_PROP_POS_FRAMES, i)
+        exact = int(round(cv.GetCaptureProperty(capture, cv.CV_CAP_PROP_POS_FRAMES))) == i
+        fps = cv.GetCaptureProperty(capture, cv.CV_CAP_PROP_FPS)
+        if exact and fps > 0:
+            # (within half a frame of the time of the i-th frame)
+            msec = cv.GetCaptureProperty(capture, cv.CV_CAP_PROP_POS_MSEC)
+            exact = abs(msec - i * 1000.0 / fps) <= 500.0 / fps
+        if not exact:
+            self.open()
+            return False
+        self.index = i
+        return True
+
+    def read(self):
+        """Decode the next frame as a SimpleCV Image, or None at the end."""
+        img = read_video_frame(self.video)
+        self.index += 1
+        return img
+
+    def skip(self):
+        """
+        Move past the next frame without converting it to an image.
+        Returns False at the end of the video.
+        """
+        self.index += 1
+        capture = getattr(self.video, 'capture', None)
+        if capture is not None:
+            # Only grab the frame, which skips its color conversion and copy.
+            return bool(self.cv.GrabFrame(capture))
+        return read_video_frame(self.video) is not None
+
+    def frames(self, selection, log=None):
+        """
+        Iterate over (index, SimpleCV Image) of the selected frames.
+
+        log = optional function(*args) to report skipped frames to
+        """
+        while not selection.is_done(self.index):
+            i = self.index
+            if selection.contains(i):
+                img = self.read()
+                if img is None:
+                    return
+                yield i, img
+            else:
+                if log:
+                    log("skipping frame:", i)
+                if not self.skip():
+                    return
+
+def make_simplecv_image(img):
+    """Wrap a BGR array in a SimpleCV Image."""
+    from SimpleCV import Image
+    return Image(img, cv2image=True)
+
+def load_simplecv_image(path):
+    """Decode an image file as a SimpleCV Image."""
+    from SimpleCV import Image
+    return Image(path)
+
+def is_jpeg(path):
+    """Determines if the given file is a JPEG image (from its extension)."""
+    return path.lower().endswith(('.jpg', '.jpeg'))
+
+def get_image_size(path):
+    """Get the (width,height) of an image file from its header."""
+    from PIL import Image
+    return Image.open(path).size
+
+def read_jpeg_luma(path, reduction):
+    """
+    Decode the luminance of a JPEG file at 1/reduction of its size (2, 4 or
+    8), with PIL's "draft" mode.  The decoder then scales in the DCT domain
+    (only part of the coefficients of each block are transformed back), and
+    skips the color conversion, so this is much cheaper than decoding the
+    full image and scaling it down.
+
+    Returns (luma, size) where:
+        luma = (height,width) uint8 array of the reduced image
+        size = (width,height) of the full image
+    """
+    from PIL import Image
+    img = Image.open(path)
+    w, h = img.size
+    img.draft('L', (-(-w // reduction), -(-h // reduction)))
+    if img.mode != 'L':
+        img = img.convert('L')
+    return np.asarray(img), (w, h)
+
+def get_sequence_number(path):
+    """Get the last number in the name of an image file (for sorting)."""
+    numbers = re.findall(r'\d+', os.path.basename(path))
+    return int(numbers[-1]) if numbers else -1
+
+def list_image_sequence(path):
+    """
+    Get the sorted paths of the images of a sequence, given as a directory,
+    a printf pattern (e.g. "frames/orig%05d.jpg") or a glob pattern.
+    Returns an empty list if the path is not an image sequence.
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path)]
+    elif re.search(r'%0?\d*d', path):
+        paths = glob.glob(re.sub(r'%0?\d*d', '*', path))
+        pattern = re.compile(re.sub(r'%0?\d*d', r'\d+', re.escape(path).replace('\\%', '%')) + '$')
+        paths = [p for p in paths if pattern.match(p)]
+    elif glob.has_magic(path):
+        paths = glob.glob(path)
+    else:
+        return []
+    paths = [p for p in paths if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS]
+
+    # A directory must hold a single sequence (a dump holds both the "orig"
+    # and "unwrap" frames, which are told apart by a pattern instead).
+    if os.path.isdir(path):
+        names = set(re.sub(r'\d+', '#', os.path.basename(p)) for p in paths)
+        if len(names) > 1:
+            raise ValueError('"%s" holds several image sequences (%s), so give a pattern such as "%s"' % (
+                path, ', '.join(sorted(names)), os.path.join(path, sorted(names)[0].replace('#', '*'))))
+    return sorted(paths, key=lambda p: (get_sequence_number(p), p))
+
+def is_image_sequence(path):
+    """Determines if the given path names an image sequence."""
+    return os.path.isdir(path) or bool(re.search(r'%0?\d*d', path)) or glob.has_magic(path)
+
+class Prefetcher:
+    """
+    Loads items in order with a pool of threads, keeping at most "window"
+    items loaded or loading ahead of the one being consumed, so that memory
+    stays bounded however fast the threads are.
+    """
+
+    def __init__(self, load, keys, workers=PREFETCH_WORKERS, window=PREFETCH_WINDOW):
+        """
+        load    = function(key) returning the loaded item
+        keys    = iterable of the keys to load, in order
+        workers = number of loading threads
+        window  = max number of items loaded or loading ahead
+        """
+        self.load = load
+        self.keys = iter(keys)
+        self.window = max(1, window)
+        self.tasks = Queue.Queue()
+        self.results = {}
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.threads = []
+        for n in xrange(max(1, workers)):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        """Load the queued keys (run by each thread)."""
+        while True:
+            key = self.tasks.get()
+            if key is None:
+                return
+            try:
+                result = (True, self.load(key))
+            except Exception:
+                result = (False, sys.exc_info())
+            with self.cond:
+                self.results[key] = result
+                self.cond.notify_all()
+
+    def fill(self):
+        """Queue keys until the window is full."""
+        while len(self.pending) < self.window:
+            try:
+                key = next(self.keys)
+            except StopIteration:
+                return
+            self.pending.append(key)
+            self.tasks.put(key)
+
+    def __iter__(self):
+        """
+        Iterate over (key, item) in the order of the keys.  An error raised
+        by loading an item is raised here when its turn comes.
+        """
+        try:
+            self.fill()
+            while self.pending:
+                key = self.pending.popleft()
+                self.fill()
+                with self.cond:
+                    while key not in self.results:
+                        self.cond.wait()
+                    ok, result = self.results.pop(key)
+                if not ok:
+                    raise result[0], result[1], result[2]
+                yield key, result
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the threads (after the items they are loading)."""
+        for thread in self.threads:
+            self.tasks.put(None)
+        self.threads = []
+
+class RandomAccessSource:
+    """
+    The frame loop of the sources that can read any frame directly, with the
+    methods of VideoSource.  (Subclasses define "load" and "count".)
+    """
+
+    # index of the next frame
+    index = 0
+
+    def frame_count(self):
+        """Get the number of frames."""
+        return self.count
+
+    def seek(self, i):
+        """Jump to the i-th frame (exact, and without reading anything)."""
+        self.index = i
+        return True
+
+    def read(self):
+        """Read the next frame as a SimpleCV Image, or None at the end."""
+        if self.index >= self.count:
+            return None
+        img = self.load(self.index)
+        self.index += 1
+        return img
+
+    def skip(self):
+        """Move past the next frame.  Returns False at the end."""
+        self.index += 1
+        return self.index <= self.count
+
+    def get_indices(self, selection):
+        """Iterate over the selected indices from the current frame on."""
+        for i in selection.indices(self.index):
+            if i >= self.count:
+                return
+            yield i
+
+    def frames(self, selection, log=None):
+        """
+        Iterate over (index, SimpleCV Image) of the selected frames, going
+        straight to each of them.
+        """
+        for i in self.get_indices(selection):
+            self.index = i + 1
+            yield i, self.load(i)
+
+class ImageSequenceSource(RandomAccessSource):
+    """
+    Reads the frames of a sequence of numbered image files (the i-th frame is
+    the i-th file in the order of their numbers), decoding them ahead of time
+    with a pool of threads.
+    """
+
+    def __init__(self, path, workers=PREFETCH_WORKERS, window=PREFETCH_WINDOW, to_image=make_simplecv_image, load_image=load_simplecv_image):
+        """
+        path       = directory, printf pattern or glob pattern of the images
+                     (see "list_image_sequence")
+        workers    = number of decoding threads
+        window     = max number of frames decoded ahead
+        to_image   = function(BGR array) returning a frame (for ".shxp" files)
+        load_image = function(path) decoding a frame from another image file
+        """
+        self.paths = list_image_sequence(path)
+        if not self.paths:
+            raise ValueError('no images found in "%s"' % path)
+        self.count = len(self.paths)
+        self.workers = workers
+        self.window = window
+        self.to_image = to_image
+        self.load_image = load_image
+
+    def load(self, i):
+        """Decode the i-th image."""
+        path = self.paths[i]
+        if path.lower().endswith('.shxp'):
+            from codec import decode_frame
+            with open(path, 'rb') as f:
+                return self.to_image(decode_frame(f.read()))
+        return self.load_image(path)
+
+    def get_jpeg_path(self, i):
+        """
+        Get the path of the i-th image if it is a JPEG file, which can be
+        decoded at a reduced size (see "read_jpeg_luma"), else None.
+        """
+        path = self.paths[i]
+        return path if is_jpeg(path) else None
+
+    def frames(self, selection, log=None):
+        """
+        Iterate over (index, SimpleCV Image) of the selected frames, which are
+        decoded ahead by the thread pool.
+        """
+        prefetcher = Prefetcher(self.load, self.get_indices(selection), self.workers, self.window)
+        for i, img in prefetcher:
+            self.index = i + 1
+            yield i, img
+
+def yuv420p_to_bgr(frame, width, height):
+    """
+    Convert a planar YUV 4:2:0 frame (BT.601, limited range) to a BGR array.
+    """
+    size = width * height
+    y = frame[:size].reshape(height, width).astype(np.int32) - 16
+    u = frame[size:size*5/4].reshape(height/2, width/2).astype(np.int32) - 128
+    v = frame[size*5/4:size*3/2].reshape(height/2, width/2).astype(np.int32) - 128
+    u = u.repeat(2, axis=0).repeat(2, axis=1)
+    v = v.repeat(2, axis=0).repeat(2, axis=1)
+    y *= 298
+    y += 128
+    bgr = np.empty((height, width, 3), np.uint8)
+    bgr[...,0] = np.clip((y + 516*u) >> 8, 0, 255)
+    bgr[...,1] = np.clip((y - 100*u - 208*v) >> 8, 0, 255)
+    bgr[...,2] = np.clip((y + 409*v) >> 8, 0, 255)
+    return bgr
+
+def get_raw_frame_size(width, height, pixel_format):
+    """Get the number of bytes of a raw frame."""
+    if pixel_format == 'yuv420p':
+        if width % 2 or height % 2:
+            raise ValueError('yuv420p frames must have an even size, not %dx%d' % (width, height))
+        return width * height * 3 / 2
+    return width * height * 3
+
+class RawVideoSource(RandomAccessSource):
+    """
+    Reads the frames of a raw video file (frames of a fixed size and pixel
+    format, one after another), which is memory-mapped, so a frame is read
+    by the operating system only when it is used, and never decoded.
+    """
+
+    def __init__(self, path, size, pixel_format=None, to_image=make_simplecv_image):
+        """
+        path         = path of the raw video file
+        size         = (width,height) of its frames
+        pixel_format = 'bgr24', 'rgb24' or 'yuv420p' (defaults to the one of
+                       the file extension, see RAW_EXTENSIONS)
+        to_image     = function(BGR array) returning a frame
+        """
+        if pixel_format is None:
+            pixel_format = RAW_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+        if pixel_format not in RAW_FORMATS:
+            raise ValueError('unknown pixel format of raw video "%s"' % path)
+        self.width, self.height = size
+        self.pixel_format = pixel_format
+        self.to_image = to_image
+        self.frame_size = get_raw_frame_size(self.width, self.height, pixel_format)
+
+        # (a partial frame at the end is ignored)
+        self.count = os.path.getsize(path) // self.frame_size
+        if self.count:
+            self.data = np.memmap(path, np.uint8, 'r', shape=(self.count, self.frame_size))
+
+    def read_array(self, i):
+        """Get the i-th frame as a BGR array (a view into the file if possible)."""
+        frame = self.data[i]
+        if self.pixel_format == 'yuv420p':
+            return yuv420p_to_bgr(frame, self.width, self.height)
+        img = frame.reshape(self.height, self.width, 3)
+        if self.pixel_format == 'rgb24':
+            img = img[...,::-1]
+        return img
+
+    def load(self, i):
+        return self.to_image(self.read_array(i))
+
+def is_raw_video(path, raw_size=None, raw_format=None):
+    """Determines if "open_source" opens the given path as a raw video."""
+    return bool(raw_size or raw_format or os.path.splitext(path)[1].lower() in RAW_EXTENSIONS)
+
+def open_source(path, raw_size=None, raw_format=None, workers=PREFETCH_WORKERS):
+    """
+    Open a video file, an image sequence or a raw video file as a source of
+    frames (see the top of this file).
+
+    raw_size   = (width,height) of the frames of a raw video
+    raw_format = pixel format of a raw video (defaults to the one of its
+                 file extension)
+    workers    = number of threads decoding the images of a sequence
+    """
+    if is_raw_video(path, raw_size, raw_format):
+        if not raw_size:
+            raise ValueError('the frame size of raw video "%s" is needed' % path)
+        return RawVideoSource(path, raw_size, raw_format)
+    if is_image_sequence(path):
+        return ImageSequenceSource(path, workers)
+    return VideoSource(path)
+
+######################################################################
+
+import unittest
+import itertools
+import tempfile
+import shutil
+import time
+
+class TestFrameSelection(unittest.TestCase):
+
+    def test_parse_ranges(self):
+        self.assertEqual(parse_ranges("0-100,500-600,900-"), [(0,100), (500,600), (900,-1)])
+        self.assertEqual(parse_ranges("7"), [(7,7)])
+        self.assertRaises(ValueError, parse_ranges, "10-5")
+
+    def test_stride(self):
+        """Assert that the stride counts from the start of each range."""
+        selection = FrameSelection([(3,10), (20,25)], stride=4)
+        selected = [i for i in xrange(30) if selection.contains(i)]
+        self.assertEqual(selected, [3,7,20,24])
+
+    def test_done(self):
+        selection = FrameSelection([(0,5), (10,12)])
+        self.assertFalse(selection.is_done(7))
+        self.assertTrue(selection.is_done(13))
+        self.assertFalse(FrameSelection([(0,-1)]).is_done(10**9))
+
+    def test_resume_at(self):
+        """Assert that resuming keeps the same frames after the given one."""
+        selection = FrameSelection([(3,10), (20,-1)], stride=4)
+        resumed = selection.resume_at(8)
+        self.assertEqual(resumed.ranges, [(20,-1)])
+        self.assertEqual(list(itertools.islice(resumed.indices(), 3)), [20,24,28])
+        self.assertEqual([i for i in xrange(40) if resumed.contains(i)],
+                         [i for i in xrange(8,40) if selection.contains(i)])
+        self.assertTrue(selection.resume_at(5).contains(7))
+
+    def test_count(self):
+        selection = FrameSelection([(3,10), (20,-1)], stride=4)
+        self.assertEqual(selection.count(30), len([i for i in xrange(30) if selection.contains(i)]))
+        self.assertEqual(selection.count(5), 1)
+        overlapping = FrameSelection([(0,20), (10,30), (12,-1)], stride=2)
+        self.assertEqual(overlapping.count(40), len([i for i in xrange(40) if overlapping.contains(i)]))
+
+class TestPrefetcher(unittest.TestCase):
+
+    def test_order(self):
+        """Assert that items come in order however long each one takes."""
+        def load(key):
+            time.sleep(0.001 * (key % 3))
+            return key * 10
+        items = list(Prefetcher(load, xrange(20), workers=4, window=5))
+        self.assertEqual(items, [(k, k*10) for k in xrange(20)])
+
+    def test_window(self):
+        """Assert that no more than the window is loaded ahead."""
+        loaded = []
+        prefetcher = Prefetcher(loaded.append, xrange(100), workers=2, window=4)
+        iterator = iter(prefetcher)
+        next(iterator)
+        time.sleep(0.05)
+        self.assertTrue(len(loaded) <= 5)
+        iterator.close()
+
+    def test_error(self):
+        def load(key):
+            if key == 3:
+                raise IOError('bad image')
+            return key
+        items = []
+        with self.assertRaises(IOError):
+            for key, item in Prefetcher(load, xrange(10)):
+                items.append(key)
+        self.assertEqual(items, [0,1,2])
+
+class TestFileSources(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_frame(self, i):
+        img = np.zeros((6,8,3), np.uint8)
+        img[:, :, 0] = i
+        img[:, :4, 2] = 200
+        return img
+
+    def test_image_sequence(self):
+        """Assert that a dump is read in the order of its numbers."""
+        from codec import encode_frame
+        for i in (0, 1, 2, 9, 10, 11):
+            with open(os.path.join(self.dir, 'orig%d.shxp' % i), 'wb') as f:
+                f.write(encode_frame(self.make_frame(i)))
+        with open(os.path.join(self.dir, 'crop.json'), 'w') as f:
+            f.write('{}')
+        identity = lambda img: img
+        self.assertEqual(len(list_image_sequence(self.dir)), 6)
+
+        source = ImageSequenceSource(self.dir, to_image=identity)
+        self.assertEqual(source.frame_count(), 6)
+        frames = list(source.frames(FrameSelection([(1,4)], stride=2)))
+        self.assertEqual([i for i, img in frames], [1,3])
+        self.assertEqual(frames[1][1][0,0,0], 9)
+
+        pattern = os.path.join(self.dir, 'orig%d.shxp')
+        self.assertEqual(len(list_image_sequence(pattern)), 6)
+        source = open_source(pattern)
+        source.to_image = identity
+        source.seek(4)
+        self.assertEqual(source.read()[0,0,0], 10)
+        self.assertEqual([i for i, img in source.frames(FrameSelection())], [5])
+
+        # (the unwrapped frames of a dump need a pattern)
+        with open(os.path.join(self.dir, 'unwrap0000.shxp'), 'wb') as f:
+            f.write(encode_frame(self.make_frame(0)))
+        self.assertRaises(ValueError, list_image_sequence, self.dir)
+
+    def test_jpeg_draft(self):
+        """Assert that JPEG files are decoded at a reduced size."""
+        try:
+            from PIL import Image
+        except ImportError:
+            return
+        img = np.zeros((60,80,3), np.uint8)
+        img[:, :40] = 200
+        path = os.path.join(self.dir, 'orig0000.jpg')
+        Image.fromarray(img).save(path)
+        luma, size = read_jpeg_luma(path, 4)
+        self.assertEqual(size, (80,60))
+        self.assertEqual(luma.shape, (15,20))
+        self.assertTrue(abs(int(luma[7,2]) - 200) < 8 and luma[7,17] < 8)
+        self.assertEqual(get_image_size(path), (80,60))
+        self.assertEqual(ImageSequenceSource(self.dir).get_jpeg_path(0), path)
+
+    def test_raw(self):
+        """Assert that the frames of raw files are read at any position."""
+        path = os.path.join(self.dir, 'clip.rgb')
+        with open(path, 'wb') as f:
+            for i in xrange(5):
+                f.write(self.make_frame(i)[...,::-1].tostring())
+            f.write('partial')
+        source = open_source(path, (8,6))
+        self.assertEqual(source.frame_count(), 5)
+        self.assertTrue((source.read_array(3) == self.make_frame(3)).all())
+        source.to_image = lambda img: img
+        self.assertEqual([i for i, img in source.frames(FrameSelection([(2,-1)]))], [2,3,4])
+        self.assertRaises(ValueError, open_source, path)
+
+    def test_yuv(self):
+        """Assert that gray and colored yuv420p pixels convert to BGR."""
+        w, h = 4, 2
+        frame = np.empty(w*h*3/2, np.uint8)
+        frame[:w*h] = 126
+        frame[w*h:] = 128
+        bgr = yuv420p_to_bgr(frame, w, h)
+        self.assertTrue((np.abs(bgr.astype(int) - 128) <= 1).all())
+        frame[w*h*5/4:] = 240
+        self.assertTrue((yuv420p_to_bgr(frame, w, h)[...,2] > 200).all())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+A library interface for unwrapping a video frame by frame, as an iterator of
+NumPy arrays instead of a pyglet window or dumped image files.
+
+    from code.stream import UnwrapStream
+
+    with UnwrapStream('vid/trailer.mp4', stop_frame=100) as stream:
+        for index, original, parsed, unwrapped in stream:
+            ...
+
+Frames are decoded ahead by a background thread into a bounded queue, so the
+decoder waits whenever the caller is slower (back-pressure).  Nothing is
+parsed or rendered until the caller asks for the next frame.
+
+The OpenGL work happens in the thread that iterates the stream, which must be
+the thread that owns pyglet's OpenGL context (usually the main thread).
+"""
+
+import threading
+import Queue
+
+import numpy as np
+
+from sidecar import get_parsed_frame
+from unwrap import Unwrapper, OffscreenTarget
+from source import open_source, FrameSelection
+
+# marks the end of the decoded frames in the queue
+END = object()
+
+class UnwrapStream:
+    """
+    An iterator of (index, original, parsed, unwrapped) for each frame of a
+    video, where:
+
+        index     = index of the frame in the video
+        original  = (height,width,3) BGR array of the frame
+        parsed    = ParsedFrame object, or None if parsing failed
+        unwrapped = BGR array of the unwrapped frame, or None if parsing failed
+                    (a view whose first row is the top of the image)
+    """
+
+    def __init__(self, video_path, start_frame=0, stop_frame=-1, size=None,
+                 crop=False, reuse_buffers=False, prefetch=4, sidecar=None,
+                 stride=1, ranges=None):
+        """
+        video_path    = path to the Super Hexagon video
+        start_frame   = start at this frame in the video
+        stop_frame    = stop at this frame in the video
+        size          = (width,height) of the unwrapped images
+                        (defaults to the size of the video)
+        crop          = only return the valid rows of the unwrapped images
+        reuse_buffers = read every unwrapped image into the same array instead
+                        of allocating a new one, so each one is only valid
+                        until the next frame is requested (ignored with crop)
+        prefetch      = max number of frames decoded ahead of the caller
+        sidecar       = optional ParseSidecar object to reuse parse results
+        stride        = only return every stride-th frame of each range
+        ranges        = list of (start, stop) frame ranges to return instead
+                        of start_frame and stop_frame
+        """
+        self.video_path = video_path
+        self.selection = FrameSelection(ranges or [(start_frame, stop_frame)], stride)
+        self.size = size
+        self.crop = crop
+        self.reuse_buffers = reuse_buffers
+        self.sidecar = sidecar
+
+        self.queue = Queue.Queue(maxsize=max(1, prefetch))
+        self.stopped = threading.Event()
+        self.thread = None
+        self.unwrapper = None
+        self.target = None
+        self.buffer = None
+
+    def decode_frames(self):
+        """Decode frames into the queue (run by the background thread)."""
+        try:
+            for i, img in open_source(self.video_path).frames(self.selection):
+                if self.stopped.is_set():
+                    break
+                self.put((i, img))
+        except Exception, e:
+            self.put(e)
+        self.put(END)
+
+    def put(self, item):
+        """Put an item in the queue, waiting while it is full until stopped."""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def render(self, img, frame):
+        """Unwrap an original image array into a new or reused array."""
+        h,w = img.shape[:2]
+        if self.target is None:
+            self.unwrapper = Unwrapper()
+            self.target = OffscreenTarget(*(self.size or (w,h)))
+        self.target.bind((1,1))
+        try:
+            self.unwrapper.update(img, frame)
+            self.unwrapper.draw()
+            if self.crop:
+                return self.unwrapper.read_image(self.unwrapper.get_crop())
+            if not self.reuse_buffers:
+                return self.unwrapper.read_image()
+            if self.buffer is None:
+                self.buffer = np.empty((self.target.height, self.target.width, 3), np.uint8)
+            return self.unwrapper.read_image(out=self.buffer)
+        finally:
+            self.target.unbind()
+
+    def __iter__(self):
+        if self.stopped.is_set():
+            raise ValueError('cannot iterate over a closed UnwrapStream')
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.decode_frames, name='UnwrapStream')
+            self.thread.daemon = True
+            self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                i, img = item
+                original = img.getNumpyCv2()
+                parsed = get_parsed_frame(img, i, self.sidecar)
+                unwrapped = self.render(original, parsed) if parsed else None
+                yield i, original, parsed, unwrapped
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop decoding and free the OpenGL objects.  (This is called when the
+        iteration ends, breaks or fails, and the stream cannot be iterated
+        over again afterwards.)
+        """
+        self.stopped.set()
+        if self.thread:
+            # Unblock the decoder if it is waiting for room in the queue.
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+        if self.target:
+            self.target.delete()
+            self.target = None
+        self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def iter_unwrapped(video_path, **options):
+    """
+    Iterate over (index, original, parsed, unwrapped) for each frame of a video.
+    (see UnwrapStream for the options)
+    """
+    return iter(UnwrapStream(video_path, **options))
@@ -0,0 +1,338 @@
+"""
+Generates Super Hexagon-like frames with known features (ground truth), for
+load testing and for checking the accuracy of the parser without needing real
+game footage.
+
+Each frame has a center polygon with 4, 5 or 6 sides surrounded by walls on
+striped sectors, and can be rotated, pulsed in scale, color-inverted, skewed
+by perspective and degraded by compression-like noise, at any resolution.
+
+    Generate a test video (requires the FFmpeg command):
+    > python synthetic.py --out synthetic.mp4 --size 1920x1080
+
+    Measure the vertex error of the parser (requires SimpleCV):
+    > python synthetic.py --accuracy
+
+See unit tests at the end of this file.
+"""
+
+import colorsys
+import json
+import math
+import random
+import subprocess
+
+import numpy as np
+
+class SyntheticFrame:
+    """
+    The parameters of a synthetic frame, which are also its ground truth.
+    """
+    def __init__(self, width, height, sides=6, rotation=0.0, radius=None,
+                 walls=(), inverted=False, skew=(0.0,0.0), hue=0.0, noise=0.0, seed=0):
+        """
+        width,height = size of the frame in pixels
+        sides        = number of sides of the center polygon
+        rotation     = angle of the first vertex of the center polygon (radians)
+        radius       = distance from the center to each vertex (pixels)
+        walls        = list of (sector, distance, thickness) of the walls,
+                       measured in the same units as radius
+        inverted     = swap the bright and dark colors
+        skew         = (x,y) perspective coefficients per pixel of the game
+                       plane (about 1e-4 is a noticeable skew)
+        hue          = hue of the colors (0 to 1)
+        noise        = amount of compression-like noise (0 to 1)
+        seed         = seed of the random noise
+        """
+        self.width = width
+        self.height = height
+        self.sides = sides
+        self.rotation = rotation
+        self.radius = radius if radius is not None else height * 0.08
+        self.walls = list(walls)
+        self.inverted = inverted
+        self.skew = skew
+        self.hue = hue
+        self.noise = noise
+        self.seed = seed
+
+    def get_center(self):
+        """Get the center of the game in the image (the middle of the image)."""
+        return (self.width/2.0, self.height/2.0)
+
+    def plane_to_image(self, q):
+        """
+        Project points of the game plane (relative to the center, shape (..,2))
+        into image coordinates.
+        """
+        q = np.asarray(q, np.float64)
+        a = np.array(self.skew, np.float64)
+        w = 1.0 + (q*a).sum(axis=-1)
+        return np.array(self.get_center()) + q / w[...,None]
+
+    def image_to_plane(self, x, y):
+        """
+        Project image coordinate arrays back into the game plane (relative to
+        the center).  This is the inverse of "plane_to_image".
+        """
+        cx,cy = self.get_center()
+        px, py = x - cx, y - cy
+        w = 1.0 - (self.skew[0]*px + self.skew[1]*py)
+        return px/w, py/w
+
+    def get_vertices(self):
+        """
+        Get the vertices of the center polygon in image coordinates, as a
+        (sides,2) array.  (This is the inner edge of the polygon's outline,
+        which is what the parser detects.)
+        """
+        angles = self.rotation + np.arange(self.sides) * (math.pi*2/self.sides)
+        q = np.column_stack((np.cos(angles), np.sin(angles))) * self.radius
+        return self.plane_to_image(q)
+
+    def get_colors(self):
+        """Get the (wall, background 1, background 2, center) BGR colors."""
+        def bgr(s, v):
+            r,g,b = colorsys.hsv_to_rgb(self.hue, s, v)
+            return np.array((b*255, g*255, r*255), np.float32)
+        bright = bgr(0.6, 1.0)
+        dark1 = bgr(0.8, 0.25)
+        dark2 = bgr(0.8, 0.35)
+        if self.inverted:
+            return bgr(0.8, 0.3), bgr(0.3, 1.0), bgr(0.3, 0.85), bgr(0.3, 1.0)
+        return bright, dark1, dark2, dark1
+
+    def to_dict(self):
+        """Get the ground truth as a JSON-compatible dict."""
+        return {
+            "size": [self.width, self.height],
+            "sides": self.sides,
+            "rotation": self.rotation,
+            "radius": self.radius,
+            "walls": self.walls,
+            "inverted": self.inverted,
+            "skew": list(self.skew),
+            "vertices": self.get_vertices().tolist(),
+        }
+
+def render_frame(frame):
+    """
+    Render a SyntheticFrame as a (height,width,3) BGR uint8 array.
+    """
+    h,w = frame.height, frame.width
+    y,x = np.mgrid[0:h, 0:w].astype(np.float32) + 0.5
+    qx, qy = frame.image_to_plane(x, y)
+
+    # Find the sector of each pixel, and its "polygonal radius" which is
+    # constant along lines parallel to the edges of the center polygon.
+    sector_angle = math.pi*2/frame.sides
+    angle = (np.arctan2(qy, qx) - frame.rotation) % (math.pi*2)
+    sector = np.minimum((angle / sector_angle).astype(np.int32), frame.sides-1)
+    offset = angle - (sector + 0.5) * sector_angle
+    radius = np.hypot(qx, qy) * np.cos(offset) / math.cos(sector_angle/2)
+
+    wall_color, bg1, bg2, center_color = frame.get_colors()
+
+    # striped background sectors
+    img = np.where((sector % 2 == 0)[...,None], bg1, bg2)
+
+    # walls
+    is_wall = np.zeros((h,w), bool)
+    for wall_sector, distance, thickness in frame.walls:
+        is_wall |= (sector == wall_sector) & (radius >= distance) & (radius < distance + thickness)
+
+    # center polygon and its outline
+    outline = frame.radius * 0.15
+    is_wall |= (radius >= frame.radius) & (radius < frame.radius + outline)
+    img[is_wall] = wall_color
+    img[radius < frame.radius] = center_color
+
+    # Add compression-like noise: an offset per 8x8 block, plus per pixel noise.
+    if frame.noise > 0:
+        rng = np.random.RandomState(frame.seed)
+        blocks = rng.normal(0, 12*frame.noise, ((h+7)/8, (w+7)/8, 1)).astype(np.float32)
+        img += np.repeat(np.repeat(blocks, 8, axis=0), 8, axis=1)[:h,:w]
+        img += rng.normal(0, 6*frame.noise, (h,w,1)).astype(np.float32)
+
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+def generate_frames(width, height, count, seed=0, noise=0.5, skew=1.0):
+    """
+    Generate a stream of (image, SyntheticFrame) pairs of an animated game,
+    with the center polygon rotating and pulsing, walls moving inward, and
+    the number of sides and inversion changing over time.
+
+    width,height = size of the frames in pixels
+    count        = number of frames
+    seed         = seed of all random choices
+    noise        = amount of compression-like noise (0 to 1)
+    skew         = amount of perspective skew (0 to 1)
+    """
+    rng = random.Random(seed)
+    base_radius = height * 0.08
+    max_skew = 2e-4 * 480.0 / height * skew
+    sides = 6
+    walls = []
+    for i in xrange(count):
+        t = i / 30.0
+
+        # Change the number of sides and the inversion occasionally.
+        if i > 0 and i % 90 == 0:
+            sides = rng.choice((4,5,6))
+            walls = []
+        inverted = (i / 150) % 2 == 1
+
+        # Move the walls inward, adding new ones at the edge of the screen.
+        walls = [(s, d - base_radius*0.15, t_) for s,d,t_ in walls if d > base_radius*1.2]
+        if not walls or walls[-1][1] < height*0.5:
+            gap = rng.randrange(sides)
+            for s in xrange(sides):
+                if s != gap:
+                    walls.append((s, height*0.8, base_radius*0.5))
+
+        frame = SyntheticFrame(width, height,
+            sides = sides,
+            rotation = t * 2.0,
+            radius = base_radius * (1.0 + 0.08*math.sin(t*math.pi*4)),
+            walls = walls,
+            inverted = inverted,
+            skew = (max_skew*math.sin(t), max_skew*math.cos(t*0.7)),
+            hue = (t * 0.05) % 1.0,
+            noise = noise,
+            seed = seed*100003 + i)
+        yield render_frame(frame), frame
+
+def write_video(path, frames, fps=30):
+    """
+    Write a stream of (image, SyntheticFrame) pairs to a video file using the
+    FFmpeg command, and their ground truth to "path.truth.json" (one JSON
+    object per line).
+    """
+    process = None
+    with open(path + '.truth.json', 'w') as truth:
+        for img, frame in frames:
+            if process is None:
+                h,w = img.shape[:2]
+                process = subprocess.Popen([
+                    'ffmpeg', '-y', '-loglevel', 'error',
+                    '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (w,h), '-r', str(fps), '-i', '-',
+                    '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path],
+                    stdin=subprocess.PIPE)
+            process.stdin.write(img.tostring())
+            truth.write(json.dumps(frame.to_dict()) + '\n')
+    if process:
+        process.stdin.close()
+        process.wait()
+
+def get_vertex_error(truth, found):
+    """
+    Get the mean distance (pixels) from each true vertex to its nearest found
+    vertex, and from each found vertex to its nearest true vertex.
+    """
+    truth = np.asarray(truth, np.float64).reshape(-1,2)
+    found = np.asarray(found, np.float64).reshape(-1,2)
+    if not len(truth) or not len(found):
+        return float('inf')
+    dist = np.sqrt(((truth[:,None,:] - found[None,:,:])**2).sum(axis=2))
+    return (dist.min(axis=1).sum() + dist.min(axis=0).sum()) / (len(truth) + len(found))
+
+def measure_accuracy(parse, frames):
+    """
+    Measure the accuracy of a parser over a stream of (image, SyntheticFrame)
+    pairs.
+
+    parse = function(image array) returning a ParsedFrame object or None
+
+    Returns a dict with the number of frames, failures, frames with the
+    wrong number of vertices, and the mean and max vertex error.
+    """
+    errors = []
+    failures = 0
+    wrong_count = 0
+    for img, frame in frames:
+        parsed = parse(img)
+        if not parsed:
+            failures += 1
+            continue
+        if len(parsed.center_vertices) != frame.sides:
+            wrong_count += 1
+        errors.append(get_vertex_error(frame.get_vertices(), parsed.center_vertices))
+    return {
+        "frames": len(errors) + failures,
+        "failures": failures,
+        "wrong_count": wrong_count,
+        "mean_error": float(np.mean(errors)) if errors else None,
+        "max_error": float(np.max(errors)) if errors else None,
+    }
+
+######################################################################
+
+import unittest
+
+class TestSyntheticFrame(unittest.TestCase):
+
+    def test_projection(self):
+        """Assert that projecting to the image and back is lossless."""
+        frame = SyntheticFrame(640, 480, skew=(2e-4, -1e-4))
+        q = np.array([[10.0, 20.0], [-50.0, 5.0]])
+        p = frame.plane_to_image(q)
+        qx, qy = frame.image_to_plane(p[:,0], p[:,1])
+        self.assertTrue(np.allclose(np.column_stack((qx,qy)), q))
+
+    def test_render(self):
+        """
+        Assert that the center is dark and the outline just outside of each
+        vertex is bright (and the opposite when inverted).
+        """
+        for inverted in (False, True):
+            frame = SyntheticFrame(640, 480, sides=5, rotation=0.3, inverted=inverted, skew=(1e-4, 0))
+            img = render_frame(frame).astype(int)
+            cx, cy = frame.get_center()
+            center = img[int(cy), int(cx)].sum()
+            for x,y in frame.get_vertices():
+                # step slightly outward from the vertex onto the outline
+                x += (x-cx) * 0.05
+                y += (y-cy) * 0.05
+                outline = img[int(y), int(x)].sum()
+                if inverted:
+                    self.assertLess(outline, center)
+                else:
+                    self.assertGreater(outline, center)
+
+    def test_vertex_error(self):
+        """Assert the vertex error of matching and shifted vertices."""
+        truth = [(0,0), (10,0), (0,10)]
+        self.assertEqual(get_vertex_error(truth, truth), 0)
+        self.assertAlmostEqual(get_vertex_error(truth, [(x+1,y) for x,y in truth]), 1)
+
+    def test_generate(self):
+        """Assert that generated frames match their requested size."""
+        for img, frame in generate_frames(160, 120, 3):
+            self.assertEqual(img.shape, (120,160,3))
+            self.assertEqual(len(frame.get_vertices()), frame.sides)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--out', metavar='FILE', help='write a synthetic video to this file')
+    parser.add_argument('--accuracy', action='store_true', help='measure the vertex error of the parser')
+    parser.add_argument('--size', metavar='WxH', default='640x480', help='size of the frames (default 640x480)')
+    parser.add_argument('--count', metavar='N', type=int, default=300, help='number of frames (default 300)')
+    parser.add_argument('--seed', metavar='N', type=int, default=0, help='seed of the random choices')
+    args = parser.parse_args()
+
+    w,h = map(int, args.size.split('x'))
+    frames = generate_frames(w, h, args.count, args.seed)
+    if args.out:
+        write_video(args.out, frames)
+    elif args.accuracy:
+        import SimpleCV as scv
+        from parse import parse_frame
+        result = measure_accuracy(lambda img: parse_frame(scv.Image(img, cv2image=True)), frames)
+        print json.dumps(result, indent=2)
+    else:
+        # Run the unit tests.
+        unittest.main(argv=[__file__])
@@ -43,144 +43,17 @@ image.  It is a hard problem to undo perspective deformation, so this
 
 """
 
-from SimpleCV import *
+import math
 
+import numpy as np
 import pyglet
 from pyglet.gl import *
 from shader import Shader
 
-from parse import parse_frame
-
-def dist(p0,p1):
-    """Distance between two 2D points."""
-    x0,y0 = p0
-    x1,y1 = p1
-    dx = x0-x1
-    dy = y0-y1
-    return math.sqrt(dx*dx + dy*dy)
-
-class Vertex:
-    """A vertex of a polygon, containing calculated properties of that vertex."""
-    def __init__(self,point,center):
-        self.point = point
-        self.center = center
-        self.radius = dist(point,center)
-        self.rel = (point[0]-center[0], point[1]-center[1])
-        self.angle = math.atan2(self.rel[1], self.rel[0])
-    
-    def copy(self):
-        return Vertex(self.point, self.center)
-
-class TriangleProjector:
-    """
-    Given two Vertex objects sharing a center point, this class determines the
-    distance from that center point to the line segment of those two vertices
-    along the direction of a given angle.
-
-    To illustrate:
-
-        vertex1   = V1
-        vertex2   = V2
-        center    = C
-        intersect = X
-
-                V1 .............X........... V2
-                      ..........|........
-                           .....|....
-                               .|.
-                                C
-
-    After computing the distance from C to X, we can compute the distance
-    from the center to any point on V1->V2 given some angle:
-
-          R(ANGLE) = |CX| / cos(ANGLE - angle(CX))
-
-    """
-
-    def __init__(self, vertex1, vertex2):
-
-        # define angle bounds for this projector
-        self.start_angle = vertex1.angle
-        self.end_angle = vertex2.angle
-
-        # short-hand names for each point
-        point1 = vertex1.point
-        point_center = vertex1.center
-        point2 = vertex2.point
-
-        # define the 2nd vertex and the center point relative to the 1st vertex
-        rel_center = (point_center[0]-point1[0], point_center[1]-point1[1]) 
-        rel_point2 = (point2[0]-point1[0], point2[1]-point1[1])
-
-        # distance between the two vertices
-        den = dist(rel_point2, (0,0))
-
-        # Rotate the center point such that the 1st and 2nd vertex will be
-        # horizontal from each other.
-        x = (rel_center[0]*rel_point2[0] + rel_center[1]*rel_point2[1]) / den
-        y = (rel_center[1]*rel_point2[0] - rel_center[0]*rel_point2[1]) / den
-
-        # On the line segment between the vertices, find the closest point
-        # to the center point.
-        # (This is just the x-component of our rotated center point, so we pick
-        # the point that is 'x' distance along the line between vertex 1 and
-        # 2.)
-        intersect = (
-                int(point1[0] + x * rel_point2[0]/den),
-                int(point1[1] + x * rel_point2[1]/den))
-
-        # The angle to the mid point.
-        self.center_angle = math.atan2(intersect[1]-point_center[1], intersect[0]-point_center[0])
-
-        # Distance from the center point to the mid point on the line segment.
-        self.center_dist = dist(intersect, point_center)
-    
-    def is_angle_inside(self, angle):
-        """
-        Determines if the given angle is inside the range covered by our
-        triangle.
-        """
-        return self.start_angle <= angle and angle <= self.end_angle
-
-    def angle_to_radius(self, angle):
-        """
-        Returns the distance to the line segment created by our two vertices
-        at the given angle.
-        """
-        return self.center_dist / math.cos(abs(angle-self.center_angle))
-
-class PolygonProjector:
-    """
-    Given a list of points along a concave polygon, this class creates a list
-    of TriangleProjector objects so that we can compute the distance between
-    the center and the edge of the polygon given some angle.
-    """
-    def __init__(self, center, points):
-
-        vertices = [Vertex(v, center) for v in points]
-        vertices.sort(key=lambda v: v.angle)
-
-        # Make angle wrap from -pi to pi easier to deal with by copying each
-        # endpoint vertex to the opposite side of the list with a lower or higher
-        # but equivalent angle.
-        v0 = vertices[0].copy()
-        v0.angle += math.pi*2
-        v1 = vertices[-1].copy()
-        v1.angle -= math.pi*2
-        vertices.insert(0,v1)
-        vertices.append(v0)
-
-        self.projectors = [TriangleProjector(vertices[i],vertices[i+1]) for i in xrange(len(vertices)-1)]
-        self.vertices = vertices
-    
-    def angle_to_radius(self, angle):
-        """
-        Get the distance from the center of this polygon to its edge at the
-        given angle.
-        """
-        for p in self.projectors:
-            if p.is_angle_inside(angle):
-                return p.angle_to_radius(angle)
+# The projection math is kept in a module of its own, so it can be used
+# without loading pyglet.
+from geometry import dist, Vertex, TriangleProjector, PolygonProjector
+from geometry import MAX_RADIUS_SCALE, ray_exit_distance, get_valid_extent, get_crop_rect
 
 # We do not use custom vertex shaders, so this is the default one.
 vertex_shader = """
@@ -208,6 +81,23 @@ uniform vec2 actual_size;
 // size of the active region of the texture (excluding the padding)
 uniform vec2 region_size;
 
+// 1 if the top row of the image was uploaded first (from an array)
+// 0 if the bottom row was uploaded first (loaded by pyglet)
+uniform int top_first;
+
+// what the texture holds (see "colormode.py"):
+//    0 = colors
+//    1 = 8-bit luminance
+//    2 = 8-bit indices into the palette
+uniform int color_mode;
+
+// the colors of the palette indices (256x1)
+uniform sampler2D palette;
+
+// 1 to blend the palette colors of the 4 nearest pixels (the indices cannot
+// be filtered by the texture unit, so it samples the nearest pixel)
+uniform int blend_palette;
+
 // angle of each vertex
 // (14 is arbitrary length to allow for redundant vertices)
 uniform float angle_bounds[14];
@@ -222,6 +112,34 @@ uniform int count;
 
 float PI = 3.14159265358979323846264;
 
+// get the palette color of the pixel at the given texture UV coordinates
+vec3 get_palette_color(vec2 p) {
+    float index = texture2D(tex0, p).r * 255.0;
+    return texture2D(palette, vec2((index + 0.5) / 256.0, 0.5)).rgb;
+}
+
+// get the color of the original image at the given texture UV coordinates
+vec3 get_color(vec2 p) {
+    if (color_mode == 0) {
+        return texture2D(tex0, p).rgb;
+    }
+    if (color_mode == 1) {
+        return vec3(texture2D(tex0, p).r);
+    }
+    if (blend_palette == 0) {
+        return get_palette_color(p);
+    }
+
+    // bilinear filtering of the colors of the 4 nearest pixels
+    vec2 t = p * actual_size - 0.5;
+    vec2 f = fract(t);
+    vec2 p0 = (floor(t) + 0.5) / actual_size;
+    vec2 d = 1.0 / actual_size;
+    vec3 bottom = mix(get_palette_color(p0), get_palette_color(p0 + vec2(d.x, 0.0)), f.x);
+    vec3 top = mix(get_palette_color(p0 + vec2(0.0, d.y)), get_palette_color(p0 + d), f.x);
+    return mix(bottom, top, f.y);
+}
+
 // get radius of the polygon at the given angle
 float get_radius(float angle) {
     int i;
@@ -247,13 +165,16 @@ void main() {
 
     // calculate the pixel position to retrieve from the original texture
     vec2 p = region_size/2.0 + r * vec2(cos(angle),-sin(angle));
+    if (top_first != 0) {
+        p.y = region_size.y - p.y;
+    }
 
     // convert pixel position to texture UV coordinates
     p /= actual_size;
 
     // Return color of that pixel if in bounds, else return black.
     if (0.0 <= p.x && p.x < 1.0 && 0.0 <= p.y && p.y < 1.0) {
-        gl_FragColor = vec4(texture2D(tex0, p).rgb, 1.0);
+        gl_FragColor = vec4(get_color(p), 1.0);
     }
     else {
         gl_FragColor = vec4(0.0, 0.0, 0.0, 1.0);
@@ -261,33 +182,229 @@ void main() {
 }
 """
 
+# Number of tiles whose parameters fit in the uniforms of one atlas draw call,
+# and the number of polygon edges stored per tile (same as "radii" above).
+ATLAS_TILES_PER_DRAW = 8
+ATLAS_MAX_EDGES = 13
+
+# This fragment shader unwraps many frames at once.  Each tile of the output
+# atlas is drawn by its own quad, whose 3rd texture coordinate holds the index
+# of the tile (within the current draw call).  Each tile reads its original
+# image from the same index in the source atlas.
+#    Input:  gl_TexCoord[0].xy   (0 <= x,y < 1  inside the tile)
+#            gl_TexCoord[0].z    (tile index)
+#    Output: gl_FragColor
+atlas_fragment_shader = """
+
+#define TILES %(tiles)d
+#define EDGES %(edges)d
+
+// the texture holding the original game images side by side
+// (uploaded top row first, so y+ is down inside each image)
+uniform sampler2D tex0;
+
+// size of the source atlas texture
+uniform vec2 actual_size;
+
+// size of each original image in the source atlas
+uniform vec2 region_size;
+
+// number of columns of original images in the source atlas
+uniform float source_columns;
+
+// Each edge of each tile's polygon packed as:
+//    (start angle, end angle, radius of edge center, angle of edge center)
+// (unused edges have an empty angle range)
+uniform vec4 edges[TILES*EDGES];
+
+float PI = 3.14159265358979323846264;
+
+// get radius of the given tile's polygon at the given angle
+float get_radius(int tile, float angle) {
+    int i;
+    for (i=tile*EDGES; i<(tile+1)*EDGES; i++) {
+        vec4 e = edges[i];
+        if (e.x <= angle && angle < e.y) {
+            return e.z / cos(abs(e.w-angle));
+        }
+    }
+    return 0.0;
+}
+
+void main() {
+
+    vec2 c = gl_TexCoord[0].xy;
+    int tile = int(gl_TexCoord[0].z + 0.5);
+
+    // interpolate angle between -pi and pi
+    float angle = c.x*PI*2.0 - PI;
+
+    // interpolate radius between 0 and 11*radius(angle)
+    float r = c.y * get_radius(tile, angle) * 11.0;
+
+    // calculate the pixel position to retrieve from the original image
+    vec2 p = region_size/2.0 + r * vec2(cos(angle),sin(angle));
+
+    // Return color of that pixel if in bounds, else return black.
+    if (0.0 <= p.x && p.x < region_size.x && 0.0 <= p.y && p.y < region_size.y) {
+        float column = mod(float(tile), source_columns);
+        vec2 origin = vec2(column, (float(tile)-column)/source_columns) * region_size;
+        gl_FragColor = vec4(texture2D(tex0, (origin + p) / actual_size).rgb, 1.0);
+    }
+    else {
+        gl_FragColor = vec4(0.0, 0.0, 0.0, 1.0);
+    }
+}
+""" % {"tiles": ATLAS_TILES_PER_DRAW, "edges": ATLAS_MAX_EDGES}
+
+class ArrayTexture:
+    """
+    An OpenGL texture that is updated from NumPy image arrays, uploading the
+    top row first.  (It has the "target" and "id" of a pyglet texture.)
+    """
+    def __init__(self, sampling=GL_LINEAR):
+        self.target = GL_TEXTURE_2D
+        texture = GLuint(0)
+        glGenTextures(1, byref(texture))
+        self.id = texture.value
+        self.width = self.height = self.channels = 0
+        self.sampling = sampling
+
+    def upload(self, img):
+        """
+        Upload a (height,width,3) BGR array, or a (height,width) array of
+        8-bit values (a single channel, a third of the bytes), to this texture.
+        """
+        img = np.ascontiguousarray(img, np.uint8)
+        h,w = img.shape[:2]
+        channels = img.shape[2] if img.ndim == 3 else 1
+        if channels == 1:
+            internal_format, pixel_format = GL_LUMINANCE8, GL_LUMINANCE
+        else:
+            internal_format, pixel_format = GL_RGB8, GL_BGR
+        glBindTexture(self.target, self.id)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        if (w,h,channels) != (self.width,self.height,self.channels):
+            # (Re)allocate the texture for a new size or format.
+            glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, self.sampling)
+            glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, self.sampling)
+            glTexImage2D(self.target, 0, internal_format, w, h, 0, pixel_format, GL_UNSIGNED_BYTE, img.ctypes.data_as(c_void_p))
+            self.width, self.height, self.channels = w, h, channels
+        else:
+            glTexSubImage2D(self.target, 0, 0, 0, w, h, pixel_format, GL_UNSIGNED_BYTE, img.ctypes.data_as(c_void_p))
+        glBindTexture(self.target, 0)
+
+    def __del__(self):
+        try:
+            glDeleteTextures(1, byref(GLuint(self.id)))
+        except:
+            pass
+
 class Unwrapper:
     """
-    This unwrapper takes an image path and a parsed frame and fulfills
-    the operations required to draw the unwrapped image.
+    This unwrapper takes an image (path or array) and a parsed frame and
+    fulfills the operations required to draw the unwrapped image.
 
     The draw operations MUST be called inside of the "on_draw" callback
     passed to "start_unwrap_window" in order to be fulfilled.  This class
-    cannot function without an OpenGL window.
+    cannot function without an OpenGL window, unless an OffscreenTarget is
+    bound (with units of (1,1)) around the draw and read operations.
     """
     def __init__(self):
 
         # Create the shader.
         self.shader = Shader(vertex_shader, fragment_shader)
 
-        # Set the texture unit.
+        # Set the texture units.
         self.shader.bind()
         self.shader.uniformi('tex0', 0)
+        self.shader.uniformi('palette', 1)
         self.shader.unbind()
 
         # Create a quad geometry to fit the whole window that will be the target of our drawing.
+        # (Its top edge is lowered in "update" to only cover the valid rows.)
         self.batch = pyglet.graphics.Batch()
-        self.batch.add(4, GL_QUADS, None, ('v2i', (0,0, 1,0, 1,1, 0,1)), ('t2f', (0,0, 1,0, 1,1, 0,1)))
+        self.quad = self.batch.add(4, GL_QUADS, None, ('v2f', (0,0, 1,0, 1,1, 0,1)), ('t2f', (0,0, 1,0, 1,1, 0,1)))
+
+        # fraction of the window height containing valid (non-black) rows
+        self.extent = 1.0
 
-    def update(self, img_path, frame):
+        # texture of the original image
+        self.texture = None
+
+        # what the texture holds (see "color_mode" in the shader), and the
+        # texture of the palette colors with the colors it was last given
+        self.color_mode = 0
+        self.palette_texture = None
+        self.palette = None
+
+        # sampling quality (see "set_quality")
+        self.output_scale = 1.0
+        self.smooth = True
+
+    def update(self, img, frame, palette=None):
         """
-        Update the texture to the given image path, and update the shaders with the new
+        Update the texture to the given image, and update the shaders with the new
         frame information to unwrap the given image correctly.
+
+        img     = path of the image file, or the image as a BGR, luminance or
+                  palette index array (see "load_image")
+        palette = colors of the palette indices
+        """
+        self.load_image(img, palette)
+        self.set_frame(frame)
+
+    def load_image(self, img, palette=None):
+        """
+        Update the texture to the given image.
+
+        img     = path of the image file, or the image as a (height,width,3)
+                  BGR array (e.g. from SimpleCV's "getNumpyCv2"), which is
+                  uploaded directly instead of being written to a file first,
+                  or as a (height,width) uint8 array of luminance or palette
+                  indices (see "colormode.py")
+        palette = (256,3) BGR array of the colors of the palette indices
+                  (None if a single-channel image is luminance)
+        """
+        if isinstance(img, basestring):
+            self.texture = pyglet.image.load(img).get_texture()
+            self.region_size = (self.texture.width, self.texture.height)
+            self.actual_size = (self.texture.owner.width, self.texture.owner.height)
+            top_first = 0
+            color_mode = 0
+        else:
+            if not isinstance(self.texture, ArrayTexture):
+                self.texture = ArrayTexture()
+            self.texture.upload(img)
+            self.region_size = self.actual_size = (self.texture.width, self.texture.height)
+            top_first = 1
+            color_mode = 0 if img.ndim == 3 else 2 if palette is not None else 1
+        if color_mode == 2:
+            self.set_palette(palette)
+        self.color_mode = color_mode
+
+        self.shader.bind()
+        self.shader.uniformf('region_size', *self.region_size)
+        self.shader.uniformf('actual_size', *self.actual_size)
+        self.shader.uniformi('top_first', top_first)
+        self.shader.uniformi('color_mode', color_mode)
+        self.shader.unbind()
+
+    def set_palette(self, palette):
+        """
+        Upload the colors of the palette indices, unless they did not change.
+        """
+        if self.palette is not None and np.array_equal(self.palette, palette):
+            return
+        if self.palette_texture is None:
+            self.palette_texture = ArrayTexture(GL_NEAREST)
+        self.palette_texture.upload(palette.reshape(1,-1,3))
+        self.palette = np.array(palette)
+
+    def set_frame(self, frame):
+        """
+        Update the shaders with the new frame information to unwrap the
+        current texture correctly.
         """
 
         # Recalculate the variables required to unwrap the new image.
@@ -296,37 +413,352 @@ class Unwrapper:
         radii = [p.center_dist for p in projector.projectors]
         angles = [p.center_angle for p in projector.projectors]
 
-        # Load the new image, and update the size variables.
-        self.texture = pyglet.image.load(img_path).get_texture()
-        region_w, region_h = self.texture.width, self.texture.height
-        actual_w, actual_h = self.texture.owner.width, self.texture.owner.height
-
         # Update the shader variables.
         self.shader.bind()
-        self.shader.uniformf('region_size', region_w, region_h)
-        self.shader.uniformf('actual_size', actual_w, actual_h)
         self.shader.uniformfv('angle_bounds', 1, angle_bounds)
         self.shader.uniformfv('radii', 1, radii)
         self.shader.uniformfv('angles', 1, angles)
         self.shader.uniformi('count', len(radii))
         self.shader.unbind()
 
+        # Only cover the rows that sample from inside the original image, so
+        # that no fragments are spent on the black region above them.
+        self.extent = get_valid_extent(projector, self.region_size)
+        y = self.extent
+        self.quad.vertices = (0,0, 1,0, 1,y, 0,y)
+        self.quad.tex_coords = (0,0, 1,0, 1,y, 0,y)
+
+    def set_quality(self, output_scale=1.0, smooth=True):
+        """
+        Trade quality for speed (e.g. from a "quality.QualityController").
+
+        output_scale = fraction of the window size to unwrap into (the output
+                       is the top-left of the window, see "get_output_rect")
+        smooth       = sample the original image with linear filtering,
+                       instead of the nearest pixel
+        """
+        self.output_scale = output_scale
+        self.smooth = smooth
+
+    def get_output_rect(self):
+        """
+        Get the (x,y,width,height) rectangle of the window image (with its
+        origin at the top-left) that the unwrapped image is drawn into.
+        """
+        buf = pyglet.image.get_buffer_manager().get_color_buffer()
+        w = max(1, int(buf.width * self.output_scale))
+        h = max(1, int(buf.height * self.output_scale))
+        return (0, 0, w, h)
+
     def draw(self):
         """Draw the unwrapped image to the window."""
+        glClear(GL_COLOR_BUFFER_BIT)
+        if self.color_mode == 2:
+            # (indices are filtered by the shader, after looking up colors)
+            glActiveTexture(GL_TEXTURE1)
+            glBindTexture(GL_TEXTURE_2D, self.palette_texture.id)
+            glActiveTexture(GL_TEXTURE0)
         glBindTexture(self.texture.target, self.texture.id)
+        sampling = GL_LINEAR if self.smooth and self.color_mode != 2 else GL_NEAREST
+        glTexParameteri(self.texture.target, GL_TEXTURE_MIN_FILTER, sampling)
+        glTexParameteri(self.texture.target, GL_TEXTURE_MAG_FILTER, sampling)
+        if self.output_scale != 1.0:
+            # (viewports have their origin at the bottom-left)
+            buf = pyglet.image.get_buffer_manager().get_color_buffer()
+            x,y,w,h = self.get_output_rect()
+            glViewport(x, buf.height-y-h, w, h)
         self.shader.bind()
+        self.shader.uniformi('blend_palette', int(self.smooth))
         self.batch.draw()
         self.shader.unbind()
+        if self.output_scale != 1.0:
+            glViewport(0, 0, buf.width, buf.height)
         glBindTexture(self.texture.target, 0)
+        if self.color_mode == 2:
+            glActiveTexture(GL_TEXTURE1)
+            glBindTexture(GL_TEXTURE_2D, 0)
+            glActiveTexture(GL_TEXTURE0)
+
+    def get_crop(self, extent=None):
+        """
+        Get the (x,y,width,height) rectangle of the window image (with its
+        origin at the top-left) that holds the valid rows.
+
+        extent = fraction of the window height to keep (defaults to the valid
+                 extent of the current frame)
+        """
+        if extent is None:
+            extent = self.extent
+        x,y,w,h = self.get_output_rect()
+        return get_crop_rect(extent, w, h)
 
-    def save_image(self, filename):
-        """Save the current window image to the given filename."""
-        pyglet.image.get_buffer_manager().get_color_buffer().save(filename)
+    def save_image(self, filename, crop=None):
+        """
+        Save the current window image to the given filename.
+
+        crop = optional (x,y,width,height) rectangle from "get_crop" so that
+               only those rows are read back and saved
+        """
+        buf = pyglet.image.get_buffer_manager().get_color_buffer()
+        if crop is None and self.output_scale != 1.0:
+            crop = self.get_output_rect()
+        if crop:
+            # (buffer regions have their origin at the bottom-left)
+            x,y,w,h = crop
+            buf = buf.get_region(x, buf.height-y-h, w, h)
+        buf.save(filename)
+
+    def read_image(self, crop=None, out=None, gray=False):
+        """
+        Read back the current window image as a (height,width,3) BGR array
+        whose first row is the top of the image.
+
+        crop = optional (x,y,width,height) rectangle from "get_crop" so that
+               only those rows are read back
+        out  = optional array of the same shape to read into
+        gray = read back a (height,width) array of one channel instead (a
+               third of the bytes, for images unwrapped from luminance)
+        """
+        buf = pyglet.image.get_buffer_manager().get_color_buffer()
+        x,y,w,h = crop or self.get_output_rect()
+        shape, pixel_format = ((h,w), GL_RED) if gray else ((h,w,3), GL_BGR)
+        if out is None:
+            out = np.empty(shape, np.uint8)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(x, buf.height-y-h, w, h, pixel_format, GL_UNSIGNED_BYTE, out.ctypes.data_as(c_void_p))
+        return out[::-1]
 
     def get_fps(self):
         """Get the current framerate in frames per second."""
         return pyglet.clock.get_fps()
 
+def get_atlas_edges(frame):
+    """
+    Get the packed polygon edges of a parsed frame for "atlas_fragment_shader",
+    padded with empty edges up to ATLAS_MAX_EDGES.
+    """
+    projector = PolygonProjector(frame.center_point, frame.center_vertices)
+    edges = []
+    for p in projector.projectors[:ATLAS_MAX_EDGES]:
+        edges.extend((p.start_angle, p.end_angle, p.center_dist, p.center_angle))
+    edges.extend((1,0,0,0) * (ATLAS_MAX_EDGES - len(edges)/4))
+    return edges
+
+class OffscreenTarget:
+    """
+    An OpenGL framebuffer object that can be drawn to without a visible
+    window, and read back in a single transfer as a NumPy array.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        max_size = GLint(0)
+        glGetIntegerv(GL_MAX_RENDERBUFFER_SIZE_EXT, byref(max_size))
+        if width > max_size.value or height > max_size.value:
+            raise ValueError('offscreen target %dx%d exceeds the max size of %d' % (width, height, max_size.value))
+
+        # Create the color buffer and attach it to a new framebuffer.
+        self.renderbuffer = GLuint(0)
+        glGenRenderbuffersEXT(1, byref(self.renderbuffer))
+        glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, self.renderbuffer)
+        glRenderbufferStorageEXT(GL_RENDERBUFFER_EXT, GL_RGB8, width, height)
+        glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, 0)
+
+        self.framebuffer = GLuint(0)
+        glGenFramebuffersEXT(1, byref(self.framebuffer))
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.framebuffer)
+        glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_RENDERBUFFER_EXT, self.renderbuffer)
+        status = glCheckFramebufferStatusEXT(GL_FRAMEBUFFER_EXT)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        if status != GL_FRAMEBUFFER_COMPLETE_EXT:
+            raise RuntimeError('offscreen target is incomplete (status 0x%x)' % status)
+
+    def bind(self, units=None):
+        """
+        Direct drawing (and reading) to this target.
+
+        units = (width,height) of the target in drawing coordinates
+                (defaults to one unit per pixel, use (1,1) for "Unwrapper")
+        """
+        units_w, units_h = units or (self.width, self.height)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.framebuffer)
+        glPushAttrib(GL_VIEWPORT_BIT)
+        glViewport(0, 0, self.width, self.height)
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        glOrtho(0, units_w, 0, units_h, -1, 1)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadIdentity()
+
+    def unbind(self):
+        """Direct drawing back to the window."""
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        glPopMatrix()
+        glPopAttrib()
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+
+    def read(self, out=None):
+        """
+        Read back the whole target as a (height,width,3) BGR array, flipped so
+        that its first row is the top of the target.  (The flip is a view, so
+        no pixels are copied after the transfer.)
+
+        out = optional array of the same shape to read into instead of
+              allocating a new one
+        """
+        if out is None:
+            out = np.empty((self.height, self.width, 3), np.uint8)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.framebuffer)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, self.width, self.height, GL_BGR, GL_UNSIGNED_BYTE, out.ctypes.data_as(c_void_p))
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        return out[::-1]
+
+    def delete(self):
+        """Free the OpenGL objects of this target."""
+        glDeleteFramebuffersEXT(1, byref(self.framebuffer))
+        glDeleteRenderbuffersEXT(1, byref(self.renderbuffer))
+
+class BatchUnwrapper:
+    """
+    This unwraps many parsed frames at once by drawing them as tiles of one
+    offscreen atlas, which is then read back in a single transfer.  This saves
+    the per-frame texture binds, uniform uploads, draw calls and readbacks
+    that dominate when the unwrapped images are small (e.g. previews and
+    thumbnails).
+
+    Unlike "Unwrapper", this only needs an OpenGL context (pyglet creates a
+    hidden one on import), not a window or its "on_draw" callback.
+    """
+    def __init__(self, tile_size, source_size, count):
+        """
+        tile_size   = (width,height) of each unwrapped image
+        source_size = (width,height) of each original image
+        count       = max number of frames rendered per batch
+        """
+        self.tile_size = tile_size
+        self.source_size = source_size
+        self.count = count
+
+        # Lay out the output tiles in a grid as square as possible.
+        tw,th = tile_size
+        self.columns = int(math.ceil(math.sqrt(count)))
+        self.rows = int(math.ceil(float(count) / self.columns))
+        self.target = OffscreenTarget(self.columns*tw, self.rows*th)
+
+        # Create the source atlas holding the original images of one draw call.
+        sw,sh = source_size
+        self.source_columns = int(math.ceil(math.sqrt(ATLAS_TILES_PER_DRAW)))
+        source_rows = int(math.ceil(float(ATLAS_TILES_PER_DRAW) / self.source_columns))
+        self.source_actual_size = (self.source_columns*sw, source_rows*sh)
+        self.texture = GLuint(0)
+        glGenTextures(1, byref(self.texture))
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB8, self.source_actual_size[0], self.source_actual_size[1], 0, GL_BGR, GL_UNSIGNED_BYTE, None)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        # Create the shader.
+        self.shader = Shader(vertex_shader, atlas_fragment_shader)
+        self.shader.bind()
+        self.shader.uniformi('tex0', 0)
+        self.shader.uniformf('actual_size', *self.source_actual_size)
+        self.shader.uniformf('region_size', sw, sh)
+        self.shader.uniformf('source_columns', self.source_columns)
+        self.shader.unbind()
+
+        # reusable readback buffer
+        self.buffer = np.empty((self.target.height, self.target.width, 3), np.uint8)
+
+    def get_tile_rect(self, i):
+        """
+        Get the (x,y,width,height) rectangle of the i-th tile in the atlas
+        returned by "render" (with its origin at the top-left).
+        """
+        tw,th = self.tile_size
+        row, column = divmod(i, self.columns)
+        return (column*tw, self.target.height-(row+1)*th, tw, th)
+
+    def upload_source(self, i, img):
+        """Upload an original image (BGR array) into the i-th source tile."""
+        sw,sh = self.source_size
+        h,w = img.shape[:2]
+        if (w,h) != (sw,sh):
+            raise ValueError('image size %dx%d does not match the source size %dx%d' % (w,h,sw,sh))
+        img = np.ascontiguousarray(img, np.uint8)
+        row, column = divmod(i, self.source_columns)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, column*sw, row*sh, sw, sh, GL_BGR, GL_UNSIGNED_BYTE, img.ctypes.data_as(c_void_p))
+
+    def render(self, frames, images):
+        """
+        Unwrap the given frames and return a list of their unwrapped images as
+        BGR arrays.  Each returned image is a view into one atlas, which is
+        overwritten by the next call to "render".
+
+        frames = list of ParsedFrame objects (or None for failed frames, which
+                 are left black)
+        images = list of the original images as (height,width,3) BGR arrays
+                 (e.g. from SimpleCV's "getNumpyCv2")
+        """
+        if len(frames) > self.count:
+            raise ValueError('cannot render %d frames in a batch of %d' % (len(frames), self.count))
+
+        tw,th = self.tile_size
+        self.target.bind()
+        glClear(GL_COLOR_BUFFER_BIT)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        self.shader.bind()
+
+        # Draw the frames in groups whose parameters fit in the uniforms.
+        for start in xrange(0, len(frames), ATLAS_TILES_PER_DRAW):
+            edges = []
+            vertices = []
+            tex_coords = []
+            for j, frame in enumerate(frames[start:start+ATLAS_TILES_PER_DRAW]):
+                if not frame:
+                    edges.extend((1,0,0,0) * ATLAS_MAX_EDGES)
+                    continue
+                self.upload_source(j, images[start+j])
+                edges.extend(get_atlas_edges(frame))
+
+                # Only cover the rows of the tile that are valid.
+                projector = PolygonProjector(frame.center_point, frame.center_vertices)
+                extent = get_valid_extent(projector, self.source_size)
+                row, column = divmod(start+j, self.columns)
+                x0, y0 = column*tw, row*th
+                x1, y1 = x0+tw, y0+th*extent
+                vertices.extend((x0,y0, x1,y0, x1,y1, x0,y1))
+                tex_coords.extend((0,0,j, 1,0,j, 1,extent,j, 0,extent,j))
+            if not vertices:
+                continue
+            edges.extend((1,0,0,0) * (ATLAS_TILES_PER_DRAW*ATLAS_MAX_EDGES - len(edges)/4))
+            self.shader.uniformfv('edges', 4, edges)
+            pyglet.graphics.draw(len(vertices)/2, GL_QUADS, ('v2f', vertices), ('t3f', tex_coords))
+
+        self.shader.unbind()
+        glBindTexture(GL_TEXTURE_2D, 0)
+        self.target.unbind()
+
+        # Read back the whole atlas at once, then split it into views.
+        atlas = self.target.read(self.buffer)
+        tiles = []
+        for i in xrange(len(frames)):
+            x,y,w,h = self.get_tile_rect(i)
+            tiles.append(atlas[y:y+h, x:x+w])
+        return tiles
+
+    def delete(self):
+        """Free the OpenGL objects of this unwrapper."""
+        self.target.delete()
+        glDeleteTextures(1, byref(self.texture))
+
 def start_unwrap_window(width, height, draw_callback):
     """
     This starts the Pyglet OpenGL window and does not return until window has exited.
@@ -351,13 +783,24 @@ def start_unwrap_window(width, height, draw_callback):
 
     # This is a dummy event whose presence in the event queue causes consistent redrawing.
     # Otherwise, the window would only draw when necessary (e.g. when window is moved).
-    pyglet.clock.schedule_interval(lambda dt: None, 1.0/60.0)
+    def redraw(dt):
+        pass
+    pyglet.clock.schedule_interval(redraw, 1.0/60.0)
      
     window.set_visible(True)
-    pyglet.app.run()
+    try:
+        pyglet.app.run()
+    finally:
+        # Clean up when the callback raises to stop, so that another window
+        # can be started by the same process (e.g. by a batch worker).
+        pyglet.clock.unschedule(redraw)
+        window.close()
 
 if __name__ == "__main__":
 
+    from SimpleCV import Image
+    from parse import parse_frame
+
     # Run a test by unwrapping a screenshot.
     img_path = 'test.jpg'
     img = Image(img_path)
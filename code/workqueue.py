@@ -0,0 +1,519 @@
+"""
+A work queue in a shared directory, so that several machines can split one
+long video between them with the shared filesystem as the only coordination.
+
+The video is split into segments that start at keyframes (so that a worker
+can seek straight to its segment, falling back to skipping the frames before
+it when the decoder does not land exactly on it), and each segment is
+claimed, processed and committed by one worker at a time:
+
+    QUEUE/job.json                  the video, its options and its segments
+    QUEUE/leases/seg0003.json       lease of a claimed segment (host, token,
+                                    expiry), renewed by heartbeats
+    QUEUE/work/seg0003.TOKEN/       private output of a worker's attempt
+    QUEUE/done/seg0003.TOKEN/       output of a finished attempt
+    QUEUE/done/seg0003.json         commit record (which attempt's output is
+                                    the segment's, who made it, how many
+                                    frames)
+
+Claiming creates the lease file exclusively, so only one worker gets it.  A
+lease whose holder stops renewing it (the host crashed or lost the share)
+expires and is reclaimed by another worker, by renaming it aside first so
+that only one reclaimer wins.  A worker commits by renaming its whole output
+directory into "done" and then linking its commit record into place, which
+fails if another worker committed the segment first, so a segment is never
+committed twice.
+
+Once every segment is done, "stitch" moves the frames of all the segments into
+one dump directory, in frame order.
+
+(Expiry compares the clocks of the hosts, so they should be kept in sync, and
+the lease time should be well above their difference.)
+
+See unit tests at the end of this file.
+"""
+
+import os
+import json
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+from checkpoint import is_frame_dumped
+
+JOB_NAME = 'job.json'
+
+# default number of seconds a lease lasts without a heartbeat
+LEASE_SECONDS = 60.0
+
+# default number of frames per segment
+SEGMENT_FRAMES = 3000
+
+def get_host_name():
+    """Get a name for this worker (host and process)."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def write_json_file(path, data):
+    """
+    Write the data as JSON to the given path atomically.  (The temporary
+    file is unique, since several hosts may write the same path.)
+    """
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def read_json_file(path):
+    """Read a JSON file, or None if it is missing or half written."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def probe_keyframes(video_path):
+    """
+    Get the display indices of the keyframes of a video, and its number of
+    frames, from the packets listed by the ffprobe command (without decoding
+    the video).  Returns None if ffprobe is not available.
+    """
+    try:
+        out = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0',
+            video_path])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    packets = []
+    for line in out.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) < 2 or fields[0] in ('', 'N/A'):
+            continue
+        packets.append((float(fields[0]), 'K' in fields[1]))
+
+    # (packets are listed in decoding order, so sort them into display order)
+    packets.sort()
+    keyframes = [i for i, (pts, key) in enumerate(packets) if key]
+    return keyframes, len(packets)
+
+def plan_segments(frame_count, keyframes=None, segment_frames=SEGMENT_FRAMES):
+    """
+    Split the frames of a video into segments of about the given length,
+    each starting at a keyframe if keyframes are given.  Returns a list of
+    (start, stop) frame ranges (stop is inclusive).
+    """
+    starts = [0]
+    for target in xrange(segment_frames, frame_count, segment_frames):
+        if keyframes:
+            later = [k for k in keyframes if k >= target]
+            if not later:
+                break
+            target = later[0]
+        if target > starts[-1] and target < frame_count:
+            starts.append(target)
+    stops = [s-1 for s in starts[1:]] + [frame_count-1]
+    return zip(starts, stops)
+
+def get_segment_name(n):
+    return 'seg%04d' % n
+
+class WorkQueue:
+    """
+    The segments of one video in a shared queue directory.
+    """
+
+    def __init__(self, queue_dir):
+        self.dir = queue_dir
+        self.job = read_json_file(os.path.join(queue_dir, JOB_NAME))
+        if self.job is None:
+            raise ValueError('"%s" is not a work queue' % queue_dir)
+        self.segments = self.job["segments"]
+        self.lease_dir = os.path.join(queue_dir, 'leases')
+        self.work_dir = os.path.join(queue_dir, 'work')
+        self.done_dir = os.path.join(queue_dir, 'done')
+
+    @staticmethod
+    def create(queue_dir, video_path, options, ranges, keyframe_aligned):
+        """
+        Publish the segments of a video in a new queue directory.
+
+        options          = options of "unwrap_video" for every segment
+        ranges           = (start, stop) frame range of each segment
+        keyframe_aligned = whether every segment starts at a keyframe
+        """
+        for name in ('', 'leases', 'work', 'done'):
+            path = os.path.join(queue_dir, name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        segments = [{"name": get_segment_name(n), "start": start, "stop": stop}
+            for n, (start, stop) in enumerate(ranges)]
+        write_json_file(os.path.join(queue_dir, JOB_NAME), {
+            "video": os.path.abspath(video_path),
+            "options": options,
+            "keyframe_aligned": keyframe_aligned,
+            "segments": segments,
+            "created": time.time(),
+        })
+        return WorkQueue(queue_dir)
+
+    def get_lease_path(self, segment):
+        return os.path.join(self.lease_dir, segment["name"] + '.json')
+
+    def get_record_path(self, segment):
+        return os.path.join(self.done_dir, segment["name"] + '.json')
+
+    def get_output_dir(self, segment):
+        """Get the directory of the committed output of a segment."""
+        record = read_json_file(self.get_record_path(segment))
+        return os.path.join(self.done_dir, record["dir"])
+
+    def is_done(self, segment):
+        return os.path.exists(self.get_record_path(segment))
+
+    def claim(self, host, lease_seconds=LEASE_SECONDS):
+        """
+        Claim the first segment that is neither done nor leased (reclaiming
+        expired leases).  Returns a Lease, or None if there is none to claim.
+        """
+        for segment in self.segments:
+            if self.is_done(segment):
+                continue
+            lease = Lease(self, segment, host, lease_seconds)
+            if lease.acquire():
+                # (it may have been committed since it was checked)
+                if self.is_done(segment):
+                    lease.release()
+                    continue
+                return lease
+        return None
+
+    def is_finished(self):
+        """Determines if every segment is done."""
+        return all(self.is_done(segment) for segment in self.segments)
+
+    def status(self):
+        """Get the state of each segment, with its lease or commit record."""
+        now = time.time()
+        states = []
+        for segment in self.segments:
+            state = dict(segment)
+            if self.is_done(segment):
+                state["state"] = 'done'
+                state.update(read_json_file(self.get_record_path(segment)) or {})
+            else:
+                lease = read_json_file(self.get_lease_path(segment))
+                if lease is None:
+                    state["state"] = 'waiting'
+                elif lease["expires"] < now:
+                    state["state"] = 'expired'
+                    state["host"] = lease["host"]
+                else:
+                    state["state"] = 'leased'
+                    state["host"] = lease["host"]
+            states.append(state)
+        return states
+
+class Lease:
+    """
+    A worker's claim on a segment, valid until it expires unless renewed.
+    """
+
+    def __init__(self, queue, segment, host, seconds=LEASE_SECONDS):
+        self.queue = queue
+        self.segment = segment
+        self.host = host
+        self.seconds = seconds
+        self.token = uuid.uuid4().hex
+        self.path = queue.get_lease_path(segment)
+
+        # private directory of this attempt's output
+        self.out_dir = os.path.join(queue.work_dir, '%s.%s' % (segment["name"], self.token))
+
+    def get_record(self):
+        return {"host": self.host, "token": self.token, "expires": time.time() + self.seconds}
+
+    def acquire(self):
+        """Try to take the lease, reclaiming it if it expired."""
+        if self.create():
+            return True
+        record = read_json_file(self.path)
+        if record is not None and record["expires"] >= time.time():
+            return False
+
+        # The lease expired (or was left half written), so move it aside.
+        # Only one worker can rename it, and that one creates it again.
+        stale_path = '%s.%s.stale' % (self.path, self.token)
+        try:
+            os.rename(self.path, stale_path)
+        except OSError:
+            return False
+        record = read_json_file(stale_path)
+        if record is not None and record["expires"] >= time.time():
+            # Another reclaimer got it (or its holder renewed it) in the
+            # meantime, so put it back unless it was replaced again.
+            try:
+                os.link(stale_path, self.path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return self.create()
+
+    def create(self):
+        """Create the lease file, unless it exists."""
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.get_record(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def is_held(self):
+        """Determines if the lease is still ours (it was not reclaimed)."""
+        record = read_json_file(self.path)
+        return record is not None and record["token"] == self.token
+
+    def renew(self):
+        """
+        Extend the lease (a heartbeat).  Returns False if it was lost to
+        another worker.
+        """
+        if not self.is_held():
+            return False
+        write_json_file(self.path, self.get_record())
+        return True
+
+    def commit(self, frames):
+        """
+        Publish the output of this attempt as the segment's output.  Returns
+        False (and deletes the output) if the segment was committed by
+        another worker.
+        """
+        name = os.path.basename(self.out_dir)
+        done_dir = os.path.join(self.queue.done_dir, name)
+        os.rename(self.out_dir, done_dir)
+
+        # Write the record completely, then link it into place, which is
+        # atomic and fails if the record exists.
+        record_path = self.queue.get_record_path(self.segment)
+        tmp_path = '%s.%s.tmp' % (record_path, self.token)
+        with open(tmp_path, 'w') as f:
+            json.dump({"dir": name, "host": self.host, "frames": frames, "committed": time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, record_path)
+            won = True
+        except OSError:
+            remove_tree(done_dir)
+            won = False
+        os.remove(tmp_path)
+        self.release()
+        return won
+
+    def release(self):
+        """Give the lease up, if it is still ours."""
+        if self.is_held():
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+class Heartbeat:
+    """
+    A thread that renews a lease every once in a while, until stopped.
+    """
+
+    def __init__(self, lease, interval=None):
+        self.lease = lease
+        self.interval = interval or lease.seconds / 4.0
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.lease.renew():
+                self.lost = True
+                break
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+def remove_tree(path):
+    """Remove a directory and everything in it, if it exists."""
+    import shutil
+    shutil.rmtree(path, ignore_errors=True)
+
+def run_worker(queue_dir, process, host=None, lease_seconds=LEASE_SECONDS, poll=5.0, log=None):
+    """
+    Claim, process and commit segments until every segment of the queue is
+    done.  Returns the number of segments committed by this worker.
+
+    process = function(job, segment, out_dir) that writes the output of a
+              segment into out_dir and returns its number of frames
+    poll    = seconds to wait before looking again when all the remaining
+              segments are leased by other workers
+    """
+    queue = WorkQueue(queue_dir)
+    host = host or get_host_name()
+    committed = 0
+    while not queue.is_finished():
+        lease = queue.claim(host, lease_seconds)
+        if lease is None:
+            time.sleep(poll)
+            continue
+        if log:
+            log('%s: processing %s (frames %d-%d)' % (host, lease.segment["name"],
+                lease.segment["start"], lease.segment["stop"]))
+        os.makedirs(lease.out_dir)
+        try:
+            with Heartbeat(lease) as heartbeat:
+                frames = process(queue.job, lease.segment, lease.out_dir)
+        except BaseException:
+            remove_tree(lease.out_dir)
+            lease.release()
+            raise
+        if heartbeat.lost and log:
+            log('%s: lost the lease of %s' % (host, lease.segment["name"]))
+        if lease.commit(frames):
+            committed += 1
+            if log:
+                log('%s: committed %s' % (host, lease.segment["name"]))
+    return committed
+
+def stitch(queue_dir, out_dir, prefixes=('orig', 'unwrap'), ext='jpg'):
+    """
+    Move the frames of every committed segment into one dump directory, in
+    frame order, merging their crop rectangles.  Returns the number of frames.
+    """
+    queue = WorkQueue(queue_dir)
+    missing = [s["name"] for s in queue.segments if not queue.is_done(s)]
+    if missing:
+        raise ValueError('segments %s are not done yet' % ', '.join(missing))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    frames = 0
+    crop = None
+    for segment in queue.segments:
+        segment_dir = queue.get_output_dir(segment)
+        names = sorted(os.listdir(segment_dir))
+        for name in names:
+            if name.endswith(ext):
+                os.rename(os.path.join(segment_dir, name), os.path.join(out_dir, name))
+                if name.startswith(prefixes[0]):
+                    frames += 1
+        segment_crop = read_json_file(os.path.join(segment_dir, 'crop.json'))
+        if segment_crop:
+            if crop is None:
+                crop = {"canvas": segment_crop["canvas"], "crops": {}}
+            crop["crops"].update(segment_crop["crops"])
+
+    if crop:
+        write_json_file(os.path.join(out_dir, 'crop.json'), crop)
+    return frames
+
+######################################################################
+
+import unittest
+import tempfile
+import multiprocessing
+
+from checkpoint import get_dump_path
+
+JPEG = '\xff\xd8' + 'x' * 10 + '\xff\xd9'
+
+def write_fake_frames(job, segment, out_dir):
+    """Stand in for "unwrap_video", dumping fake JPEG files."""
+    for i in xrange(segment["start"], segment["stop"]+1):
+        for prefix in ('orig', 'unwrap'):
+            with open(get_dump_path(out_dir, prefix, i), 'wb') as f:
+                f.write(JPEG)
+        time.sleep(0.002)
+    return segment["stop"] - segment["start"] + 1
+
+def fake_host(queue_dir, name):
+    run_worker(queue_dir, write_fake_frames, host=name, lease_seconds=1.0, poll=0.1)
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.dir, 'queue')
+
+    def tearDown(self):
+        remove_tree(self.dir)
+
+    def test_plan(self):
+        """Assert that segments start at the first keyframe after each cut."""
+        self.assertEqual(plan_segments(100, [0, 30, 45, 70, 95], 40),
+            [(0,44), (45,94), (95,99)])
+        self.assertEqual(plan_segments(100, None, 40), [(0,39), (40,79), (80,99)])
+        self.assertEqual(plan_segments(10, [0], 40), [(0,9)])
+
+    def test_exclusive(self):
+        """Assert that a leased segment is not claimed twice until it expires."""
+        queue = WorkQueue.create(self.queue_dir, 'video.mp4', {}, [(0,9)], True)
+        lease = queue.claim('a', lease_seconds=0.2)
+        self.assertNotEqual(lease, None)
+        self.assertEqual(queue.claim('b'), None)
+        time.sleep(0.3)
+        stolen = queue.claim('b')
+        self.assertNotEqual(stolen, None)
+        self.assertFalse(lease.renew())
+
+        # The first holder loses the race to commit.
+        os.makedirs(stolen.out_dir)
+        os.makedirs(os.path.join(lease.out_dir, 'x'))
+        self.assertTrue(stolen.commit(10))
+        self.assertFalse(lease.commit(10))
+        self.assertTrue(queue.is_finished())
+
+    def test_hosts(self):
+        """
+        Assert that processes standing in for hosts split the segments, that
+        a crashed host's segment is reclaimed, and that the stitched frames
+        are all there.
+        """
+        ranges = plan_segments(60, None, 10)
+        queue = WorkQueue.create(self.queue_dir, 'video.mp4', {}, ranges, False)
+
+        # A host that claimed a segment and died without committing it.
+        crashed = queue.claim('crashed', lease_seconds=0.5)
+        os.makedirs(crashed.out_dir)
+
+        hosts = [multiprocessing.Process(target=fake_host, args=(self.queue_dir, 'host%d' % n))
+            for n in xrange(3)]
+        for p in hosts:
+            p.start()
+        for p in hosts:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+        status = queue.status()
+        self.assertEqual([s["state"] for s in status], ['done'] * 6)
+        self.assertEqual(status[0]["frames"], 10)
+        self.assertTrue(status[0]["host"].startswith('host'))
+
+        out_dir = os.path.join(self.dir, 'frames')
+        self.assertEqual(stitch(self.queue_dir, out_dir), 60)
+        for i in xrange(60):
+            self.assertTrue(is_frame_dumped(out_dir, i))
+
+if __name__ == "__main__":
+    unittest.main()
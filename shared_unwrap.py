@@ -0,0 +1,158 @@
+"""
+Splits one long Super Hexagon video between several machines that share a
+directory (e.g. over NFS), which is their only coordination.
+
+Publish the segments of the video once:
+
+    python shared_unwrap.py plan vid/long.mp4 /shared/queue --segment-frames 3000
+
+Start workers on any number of hosts (each claims segments until all are done,
+and a crashed host's segments are reclaimed once their leases expire):
+
+    python shared_unwrap.py work /shared/queue
+
+Watch the progress, and stitch the segments into one dump once they are done:
+
+    python shared_unwrap.py status /shared/queue
+    python shared_unwrap.py stitch /shared/queue frames
+
+(see "code/workqueue.py")
+"""
+
+import sys
+import argparse
+
+from code.workqueue import WorkQueue, run_worker, stitch, plan_segments, probe_keyframes
+from code.workqueue import LEASE_SECONDS, SEGMENT_FRAMES
+from code.source import open_source, is_image_sequence, is_raw_video, RAW_FORMATS
+from code.metrics import Metrics
+from unwrap_video import DUMP_EXTENSIONS
+
+def plan(video_path, queue_dir, options, segment_frames=SEGMENT_FRAMES):
+    """
+    Split the video into keyframe-aligned segments and publish them in the
+    queue directory.  Returns the WorkQueue.
+    """
+    raw_size, raw_format = options.get('raw_size'), options.get('raw_format')
+    probe = None
+    if not is_image_sequence(video_path) and not is_raw_video(video_path, raw_size, raw_format):
+        probe = probe_keyframes(video_path)
+        if not probe:
+            # Without ffprobe, the segments cannot be aligned to keyframes, so
+            # the workers skip to their segments instead of seeking.
+            print 'ffprobe was not found, so the segments are not aligned to keyframes'
+    if probe:
+        keyframes, frame_count = probe
+    else:
+        # (the frames of image sequences and raw videos are read directly, so
+        # their segments need no keyframes)
+        keyframes = None
+        frame_count = open_source(video_path, raw_size, raw_format).frame_count()
+        if frame_count is None:
+            raise ValueError('cannot tell the length of "%s"' % video_path)
+    ranges = plan_segments(frame_count, keyframes, segment_frames)
+    return WorkQueue.create(queue_dir, video_path, options, ranges, keyframes is not None)
+
+def make_segment_unwrapper():
+    """
+    Get a function that unwraps a segment of a job into a directory (see
+    "run_worker"), reusing one Unwrapper for every segment of this worker.
+    """
+    from unwrap_video import unwrap_video
+    from code.unwrap import Unwrapper
+    unwrapper = Unwrapper()
+
+    def unwrap_segment(job, segment, out_dir):
+        options = dict(job["options"])
+
+        # Keep the stride aligned to the start of the video.
+        stride = options.get('stride', 1)
+        start = -(-segment["start"] // stride) * stride
+
+        metrics = Metrics()
+        unwrap_video(job["video"], dump_dir=out_dir, ranges=[(start, segment["stop"])],
+            seek_frame=segment["start"] if job["keyframe_aligned"] else None,
+            use_sidecar=False, metrics=metrics, unwrapper=unwrapper,
+            print_log=False, **options)
+        return metrics.summary()["frames"]
+
+    return unwrap_segment
+
+def print_status(queue):
+    """Print the state of every segment of the queue."""
+    print '%-8s %15s  %-8s %s' % ('segment', 'frames', 'state', 'host')
+    for state in queue.status():
+        print '%-8s %7d-%-7d  %-8s %s' % (state["name"], state["start"], state["stop"],
+            state["state"], state.get("host", ''))
+
+if __name__ == "__main__":
+
+    def log(message):
+        print message
+        sys.stdout.flush()
+
+    # Create argument parser
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    plan_parser = commands.add_parser('plan', help='publish the segments of a video')
+    plan_parser.add_argument('video', help='path to video of super hexagon (on the shared filesystem)\n(or a directory or pattern of numbered images, or a raw video)')
+    plan_parser.add_argument('queue', help='shared queue directory')
+    plan_parser.add_argument('--segment-frames', metavar='N', type=int, default=SEGMENT_FRAMES, help='about this many frames per segment (default %d)' % SEGMENT_FRAMES)
+    plan_parser.add_argument('--stride', metavar='N', type=int, help='only process every Nth frame')
+    plan_parser.add_argument('--crop', choices=['frame'], help='only dump the valid rows of the unwrapped frames\n(per frame, since segments cannot share a clip crop)')
+    plan_parser.add_argument('--raw-size', metavar='WxH', help='size of the frames of a raw video file (.bgr, .rgb or .yuv)')
+    plan_parser.add_argument('--raw-format', choices=RAW_FORMATS, help='pixel format of a raw video file (default from its extension)')
+    plan_parser.add_argument('--codec', choices=['jpeg','palette'], help='format of the dumped frames (default jpeg)')
+    plan_parser.add_argument('--color', choices=['rgb','lossless','gray','palette'], help='convert the frames to 8 bits per pixel after decoding (default rgb)')
+    plan_parser.add_argument('--dedup', metavar='T', type=float, nargs='?', const=1.0, help='reuse results for frames that repeat the previous one')
+
+    work_parser = commands.add_parser('work', help='process segments until all are done')
+    work_parser.add_argument('queue', help='shared queue directory')
+    work_parser.add_argument('--host', metavar='NAME', help='name of this worker (default host:pid)')
+    work_parser.add_argument('--lease', metavar='SECONDS', type=float, default=LEASE_SECONDS, help='how long a claim lasts without a heartbeat (default %d)' % LEASE_SECONDS)
+
+    status_parser = commands.add_parser('status', help='show the state of every segment')
+    status_parser.add_argument('queue', help='shared queue directory')
+
+    stitch_parser = commands.add_parser('stitch', help='move the frames of all segments into one directory')
+    stitch_parser.add_argument('queue', help='shared queue directory')
+    stitch_parser.add_argument('out', help='directory to dump the frames in')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'plan':
+            opts = {}
+            if args.stride:
+                opts['stride'] = args.stride
+            if args.crop:
+                opts['crop'] = args.crop
+            if args.codec:
+                opts['codec'] = args.codec
+            if args.color:
+                opts['color'] = args.color
+            if args.raw_size:
+                opts['raw_size'] = map(int, args.raw_size.split('x'))
+            if args.raw_format:
+                opts['raw_format'] = args.raw_format
+            if args.dedup is not None:
+                opts['repeat_threshold'] = args.dedup
+            queue = plan(args.video, args.queue, opts, args.segment_frames)
+            print 'Published %d segments in "%s".' % (len(queue.segments), args.queue)
+
+        elif args.command == 'work':
+            committed = run_worker(args.queue, make_segment_unwrapper(), args.host, args.lease, log=log)
+            print 'Committed %d segments, and every segment is done.' % committed
+
+        elif args.command == 'status':
+            print_status(WorkQueue(args.queue))
+
+        elif args.command == 'stitch':
+            queue = WorkQueue(args.queue)
+            ext = DUMP_EXTENSIONS[queue.job["options"].get('codec', 'jpeg')]
+            frames = stitch(args.queue, args.out, ext=ext)
+            print 'Stitched %d frames into "%s".' % (frames, args.out)
+    except ValueError, e:
+        sys.exit(str(e))
@@ -0,0 +1,249 @@
+"""
+Unwraps videos sent to a long-running server, which keeps SimpleCV, pyglet
+and the compiled shader loaded between videos, so that short clips are not
+dominated by the startup time of "unwrap_video.py".
+
+Start the server once:
+
+    python unwrap_daemon.py --serve
+
+Then send it videos with the same options as "unwrap_video.py":
+
+    python unwrap_daemon.py vid/trailer.mp4 --out frames --stop 100
+
+The client only imports the standard library, so it starts instantly.
+
+Protocol: the client connects to the server's Unix socket and sends a request
+as one line of JSON.  The server answers with lines of JSON events until the
+request is done, then closes the connection.
+
+    request:  {"video": PATH, "out": DIR, "options": {...}}
+              (options of "unwrap_video", with "ranges" as a string)
+              {"command": "shutdown"}
+
+    events:   {"event": "accepted"}
+              {"event": "progress", "frame": N, "frames": N, "fps": F}
+              {"event": "done", "report": {...}}    (see "batch_unwrap.run_job")
+              {"event": "error", "message": TEXT}
+
+Requests are run one at a time in the order they arrive (OpenGL has to be used
+from the server's main thread).  Closing the connection cancels a request
+after its current frame, keeping its progress for --resume.
+"""
+
+import sys
+import os
+import argparse
+import json
+import socket
+import tempfile
+import time
+
+# default path of the server's socket
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'superhexagon-unwrap-%d.sock' % os.getuid())
+
+# min number of seconds between progress events
+PROGRESS_INTERVAL = 0.25
+
+def send_event(f, **event):
+    """Write an event to the given socket file."""
+    f.write(json.dumps(event) + '\n')
+    f.flush()
+
+class ProgressHook:
+    """
+    A metrics hook that sends a progress event to the client every once in a
+    while.  (Failing to send, because the client left, stops the job.)
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.frames = 0
+        self.last_time = 0
+
+    def __call__(self, record):
+        self.frames += 1
+        if record["time"] - self.last_time >= PROGRESS_INTERVAL:
+            self.last_time = record["time"]
+            send_event(self.f, event='progress', frame=record["frame"],
+                frames=self.frames, fps=self.frames / record["time"] if record["time"] else 0.0)
+
+def serve(socket_path=SOCKET_PATH):
+    """
+    Run the server until it is sent the "shutdown" command or interrupted.
+    """
+    # Load the heavy libraries once, before the first request.
+    from code.source import parse_ranges
+    from code.unwrap import Unwrapper
+    from batch_unwrap import run_job, JOB_OPTIONS
+
+    unwrapper = Unwrapper()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(8)
+    print 'listening on', socket_path
+    sys.stdout.flush()
+
+    try:
+        while True:
+            conn, addr = server.accept()
+            f = conn.makefile('rw')
+            try:
+                request = json.loads(f.readline())
+                if request.get("command") == 'shutdown':
+                    send_event(f, event='done', report=None)
+                    break
+
+                options = dict(request.get("options") or {})
+                for key in options:
+                    if key not in JOB_OPTIONS:
+                        raise ValueError('unknown option "%s"' % key)
+                if isinstance(options.get('ranges'), basestring):
+                    options['ranges'] = parse_ranges(options['ranges'])
+                job = {"video": request["video"], "out": request["out"], "options": options}
+
+                send_event(f, event='accepted')
+                print 'unwrapping', job["video"]
+                sys.stdout.flush()
+                report = run_job(job, [ProgressHook(f)], unwrapper)
+                send_event(f, event='done', report=report)
+                print '%s %s (%d frames, %.1f fps)' % ('failed' if report["error"] else 'finished',
+                    job["video"], report["frames"], report["fps"])
+                sys.stdout.flush()
+
+                # Stop serving if the job was stopped by Ctrl-C or SIGTERM.
+                if not report["complete"] and not report["error"]:
+                    break
+            except (ValueError, KeyError), e:
+                try:
+                    send_event(f, event='error', message='bad request: %s' % e)
+                except socket.error:
+                    pass
+            except socket.error:
+                # The client left.
+                pass
+            finally:
+                try:
+                    f.close()
+                    conn.close()
+                except socket.error:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+def request(message, socket_path=SOCKET_PATH):
+    """
+    Send a request to the server, and iterate over the events it answers with.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    f = client.makefile('rw')
+    try:
+        f.write(json.dumps(message) + '\n')
+        f.flush()
+        for line in f:
+            yield json.loads(line)
+    finally:
+        f.close()
+        client.close()
+
+def unwrap(video_path, out_dir, options, socket_path=SOCKET_PATH):
+    """
+    Have the server unwrap the given video into the given directory, printing
+    its progress.  Returns the report of the job, or raises ValueError if the
+    server failed or closed the connection before the job was done.
+    """
+    message = {
+        "video": os.path.abspath(video_path),
+        "out": os.path.abspath(out_dir),
+        "options": options,
+    }
+    report = None
+    for event in request(message, socket_path):
+        if event["event"] == 'progress':
+            sys.stdout.write(('\rprocessing/dumping frame: %d (%d fps)' % (event["frame"], event["fps"])).ljust(60))
+            sys.stdout.flush()
+        elif event["event"] == 'done':
+            report = event["report"]
+        elif event["event"] == 'error':
+            raise ValueError(event["message"])
+    print
+    if report is None:
+        raise ValueError('the server at %s closed the connection before the job was done' % socket_path)
+    return report
+
+if __name__ == "__main__":
+
+    # Create argument parser
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('video', nargs='?', help='path to video of super hexagon')
+    parser.add_argument('--serve', action='store_true', help='run the server')
+    parser.add_argument('--shutdown', action='store_true', help='stop the server')
+    parser.add_argument('--socket', metavar='PATH', default=SOCKET_PATH, help='path of the server socket (default %s)' % SOCKET_PATH)
+    parser.add_argument('--out', metavar='DIR', help='dump frames into this directory')
+    parser.add_argument('--start', metavar='N', type=int, help='start at this frame of the video')
+    parser.add_argument('--stop', metavar='N', type=int, help='stop at this frame of the video')
+    parser.add_argument('--stride', metavar='N', type=int, help='only process every Nth frame')
+    parser.add_argument('--ranges', metavar='LIST', help='only process these frame ranges, e.g. "0-100,500-600,900-"')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted dump into the --out directory')
+    parser.add_argument('--no-sidecar', action='store_true', help='do not store or reuse parsed frames in a file next to the video')
+    parser.add_argument('--codec', choices=['jpeg','palette'], help='format of the dumped frames (default jpeg)')
+    parser.add_argument('--color', choices=['rgb','lossless','gray','palette'], help='convert the frames to 8 bits per pixel after decoding (default rgb)')
+    parser.add_argument('--dedup', metavar='T', type=float, nargs='?', const=1.0, help='reuse results for frames that repeat the previous one')
+    parser.add_argument('--crop', choices=['frame','clip'], help='only dump the valid rows of the unwrapped frames')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.socket)
+        sys.exit(0)
+
+    if args.shutdown:
+        list(request({"command": "shutdown"}, args.socket))
+        sys.exit(0)
+
+    if not args.video or not args.out:
+        parser.error('a video and its --out directory are needed')
+
+    # Create optional args from those parsed
+    opts = {}
+    if args.start:
+        opts['start_frame'] = args.start
+    if args.stop:
+        opts['stop_frame'] = args.stop
+    if args.stride:
+        opts['stride'] = args.stride
+    if args.ranges:
+        opts['ranges'] = args.ranges
+    if args.crop:
+        opts['crop'] = args.crop
+    if args.codec:
+        opts['codec'] = args.codec
+    if args.color:
+        opts['color'] = args.color
+    if args.dedup is not None:
+        opts['repeat_threshold'] = args.dedup
+    if args.no_sidecar:
+        opts['use_sidecar'] = False
+    if args.resume:
+        opts['resume'] = True
+
+    try:
+        report = unwrap(args.video, args.out, opts, args.socket)
+    except socket.error, e:
+        sys.exit('cannot reach the server at %s (%s), start it with --serve' % (args.socket, e))
+    except ValueError, e:
+        sys.exit(str(e))
+
+    if report["error"]:
+        sys.exit(report["error"])
+    print 'Dumped %d frames to "%s".' % (report["frames"], args.out)
+    if not report["complete"]:
+        sys.exit('The dump was interrupted (use --resume to continue).')
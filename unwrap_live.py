@@ -0,0 +1,223 @@
+"""
+Unwraps live Super Hexagon gameplay read as raw BGR frames from stdin or a
+named pipe (e.g. from an FFmpeg screen capture), for stream overlays.
+
+Frames that arrive while one is being unwrapped replace each other, so only
+the newest is unwrapped next, and frames older than the deadline are dropped
+instead of being shown late.  The end-to-end latency percentiles are reported
+at the end (see "code/live.py").
+"""
+
+import sys
+import argparse
+import json
+
+from code.live import RawFrameReader, LatestFrame, LiveStats, take_fresh_frame, format_stats, timer, DEFAULT_DEADLINE
+from code.checkpoint import StopSignals
+from code.metrics import Metrics, JsonLinesLog, format_summary
+from code.quality import QualityController
+from code.preview import PreviewServer, DEFAULT_PORT
+from code.colormode import FrameConverter, COLOR_MODES
+from unwrap_video import VideoDone
+
+# max seconds to wait for a new frame before redrawing the last one
+FRAME_WAIT = 1.0 / 120
+
+def unwrap_live(f, width, height, deadline=DEFAULT_DEADLINE, metrics=None, target_fps=None, preview_port=None, color='rgb', print_log=True):
+    """
+    Shows the live frames read from the given file object unwrapped, until
+    the stream ends or we are interrupted.  Returns the summary of the
+    LiveStats.
+
+    f        = file object of the pipe of raw BGR frames
+    width    = width of the frames
+    height   = height of the frames
+    deadline = max age in seconds of a frame when it starts being unwrapped
+               (older ones are dropped, None = never drop)
+    metrics  = Metrics object to record the stages of each frame with
+    target_fps = degrade the quality when needed to hold this frame rate
+               (see "code/quality.py")
+    preview_port = serve the latest frames and the status over HTTP on this
+               local port (see "code/preview.py")
+    color    = convert the frames to 8 bits per pixel for parsing and
+               unwrapping, which skips SimpleCV unless it is 'rgb'
+               (see "code/colormode.py")
+    """
+
+    from code.parse import parse_frame_scaled
+    from code.batchparse import parse_luma
+    from code.unwrap import start_unwrap_window, Unwrapper
+    from pyglet.gl import glFinish
+
+    def log(*args):
+        """
+        Helper function to display messages on the same line.
+        """
+        if print_log:
+            sys.stdout.write('\r' + ' '.join(map(str, args)).ljust(60))
+            sys.stdout.flush()
+
+    def log_line(message):
+        """
+        Helper function to display a message on its own line.
+        """
+        if print_log:
+            sys.stdout.write('\r' + message.ljust(60) + '\n')
+            sys.stdout.flush()
+
+    latest = LatestFrame(RawFrameReader(f, width, height)).start()
+    converter = FrameConverter(color)
+    stats = LiveStats()
+    unwrapper = Unwrapper()
+
+    show_summary = metrics is not None
+    if metrics is None:
+        metrics = Metrics()
+
+    # Adjust the quality to hold the target frame rate.
+    quality = None
+    if target_fps:
+        quality = QualityController(target_fps, log=log_line, metrics=metrics)
+        metrics.add_hook(quality)
+
+    # Serve a preview of the frames and the status (closed with the metrics).
+    preview = None
+    if preview_port is not None:
+        preview = PreviewServer(preview_port).start()
+        metrics.add_hook(preview)
+        log_line('preview at http://localhost:%d/' % preview.port)
+
+    # create state object for the "on_draw" callback
+    self = {
+        "drawn": False,
+        "parsed": None,
+    }
+
+    def on_draw():
+        """
+        Unwrap the newest fresh frame, or redraw the last one if none came.
+        """
+        if stop.requested or latest.is_done():
+            raise VideoDone()
+
+        frame = take_fresh_frame(latest, stats, deadline, FRAME_WAIT)
+        if frame is None:
+            if self["drawn"]:
+                unwrapper.draw()
+            return
+
+        i, arrival, arr = frame
+        metrics.begin_frame(i)
+        try:
+            if quality:
+                unwrapper.set_quality(quality.settings["output_scale"], quality.settings["filter"] == 'linear')
+
+            luma, texture, palette = metrics.measure('convert', converter.convert, arr)
+
+            # Parse the frame, unless the quality controller reuses the
+            # previous result for it.
+            if quality and not quality.should_parse() and self["parsed"]:
+                parsed = self["parsed"]
+                metrics.set(parsed=True, reused=True)
+            else:
+                report = {}
+                scale = quality.settings["parse_scale"] if quality else 1.0
+                if luma is not None:
+                    parsed = metrics.measure('parse', parse_luma, luma, scale, report)
+                else:
+                    from SimpleCV import Image
+                    img = metrics.measure('decode', lambda: Image(arr, cv2image=True))
+                    parsed = metrics.measure('parse', parse_frame_scaled, img, scale, report)
+                metrics.set(parsed=bool(parsed), failure=None if parsed else report.get("failure"))
+                self["parsed"] = parsed
+            if parsed:
+                metrics.measure('upload', unwrapper.update, texture, parsed, palette)
+                self["drawn"] = True
+            if self["drawn"]:
+                # (wait for the GPU, so the latency includes the drawing)
+                metrics.measure('draw', unwrapper.draw)
+                metrics.measure('draw', glFinish)
+            latency = timer() - arrival
+
+            # Hand the frames to the preview server if someone watches.
+            if preview and preview.wants('orig'):
+                metrics.measure('preview', preview.publish, 'orig', arr)
+            if preview and self["drawn"] and preview.wants('unwrap'):
+                metrics.measure('preview', lambda: preview.publish('unwrap', unwrapper.read_image(gray=color == 'gray')))
+        finally:
+            latest.give_back(frame)
+
+        # (frames before the first one that parsed show nothing)
+        if self["drawn"]:
+            stats.add_latency(latency)
+            metrics.set(latency_ms=latency * 1000)
+        else:
+            stats.blank += 1
+        metrics.end_frame()
+        log('live frame:', i, '(%d fps)' % unwrapper.get_fps())
+
+    # Run the opengl window until the stream ends, or until we are interrupted.
+    with StopSignals() as stop:
+        try:
+            start_unwrap_window(width, height, on_draw)
+        except VideoDone:
+            pass
+
+    metrics.close()
+    summary = stats.summary(latest.overwritten)
+
+    if print_log:
+        print
+        print format_stats(summary)
+        if show_summary:
+            print format_summary(metrics.summary())
+
+    return summary
+
+if __name__ == "__main__":
+
+    # Create argument parser
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('pipe', nargs='?', default='-', help='path of a named pipe of raw BGR frames (default stdin)')
+    parser.add_argument('--size', metavar='WxH', required=True, help='size of the frames, e.g. 1280x720')
+    parser.add_argument('--deadline', metavar='MS', type=float, default=DEFAULT_DEADLINE*1000, help='drop frames older than this when their turn comes\n(default %d ms, 0 = never drop)' % (DEFAULT_DEADLINE*1000))
+    parser.add_argument('--target-fps', metavar='N', type=float, help='degrade the quality when needed to hold this frame rate')
+    parser.add_argument('--preview', metavar='PORT', type=int, nargs='?', const=DEFAULT_PORT, help='serve the latest frames (MJPEG) and status (JSON) on this\nlocal port (default %d)' % DEFAULT_PORT)
+    parser.add_argument('--color', choices=COLOR_MODES, help='convert the frames to 8 bits per pixel for parsing and\nunwrapping (default rgb, see unwrap_video.py)')
+    parser.add_argument('--metrics', metavar='FILE', help='write the metrics of each frame to this file as JSON lines')
+    parser.add_argument('--stats', metavar='FILE', help='write the frame counts and latency percentiles to this file as JSON')
+    args = parser.parse_args()
+
+    try:
+        w,h = map(int, args.size.split('x'))
+    except ValueError:
+        parser.error('--size must look like 1280x720')
+
+    opts = {}
+    if args.deadline:
+        opts['deadline'] = args.deadline / 1000.0
+    else:
+        opts['deadline'] = None
+    if args.target_fps:
+        opts['target_fps'] = args.target_fps
+    if args.preview:
+        opts['preview_port'] = args.preview
+    if args.color:
+        opts['color'] = args.color
+    if args.metrics:
+        opts['metrics'] = Metrics([JsonLinesLog(args.metrics)])
+
+    if args.pipe == '-':
+        f = sys.stdin
+    else:
+        f = open(args.pipe, 'rb')
+    try:
+        summary = unwrap_live(f, w, h, **opts)
+    finally:
+        f.close()
+
+    if args.stats:
+        with open(args.stats, 'w') as out:
+            json.dump(summary, out, indent=2, sort_keys=True)
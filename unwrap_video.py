@@ -2,18 +2,41 @@
 Shows the given Super Hexagon video next to an unwrapped* version of it.
 
 *unwrapped means the walls fall top-to-bottom instead of out-to-in.
+
+The video can also be a sequence of numbered images (a directory, or a pattern
+such as "frames/orig%04d.jpg") or a raw video file (".bgr", ".rgb" or ".yuv"
+with --raw-size), whose frames are read directly instead of decoded in order.
 """
 
 import sys
 import os
 import argparse
+import json
 
-# SimpleCV image processing and computer vision library
-import SimpleCV as scv
+import numpy as np
 
 # Custom "Super Hexagon" parsing library
-from code.parse import parse_frame
-from code.unwrap import start_unwrap_window, Unwrapper
+# (OpenGL is only loaded by "unwrap_video", so that "--help" and batch workers
+# start fast)
+from code.sidecar import open_video_sidecar, get_parsed_frame, get_video_key
+from code.geometry import PolygonProjector, get_valid_extent
+from code.source import open_source, FrameSelection, parse_ranges, RAW_FORMATS
+from code.source import ImageSequenceSource, DRAFT_REDUCTIONS, get_image_size
+from code.dedup import RepeatDetector, link_file
+from code.checkpoint import ProgressManifest, StopSignals, find_resume_frame, get_last_dumped_frame, get_dump_path
+from code.framestore import FrameStore, DONE, FAILED
+from code.codec import encode_frame
+from code.colormode import FrameConverter, COLOR_MODES
+from code.batchparse import parse_luma, parse_jpeg
+from code.quality import QualityController, KNOBS
+from code.preview import PreviewServer, DEFAULT_PORT
+from code.metrics import Metrics, JsonLinesLog, BinaryLog, SamplingProfiler, format_summary
+
+# extension of the dumped files of each codec
+DUMP_EXTENSIONS = {'jpeg': 'jpg', 'palette': 'shxp'}
+
+# the stages of processing a frame, as named in the metrics
+STAGES = ['decode', 'convert', 'show', 'fingerprint', 'parse', 'save_orig', 'upload', 'draw', 'save_unwrap', 'preview']
 
 class VideoDone(Exception):
     """
@@ -22,18 +45,111 @@ class VideoDone(Exception):
     """
     pass
 
-def unwrap_video(video_path, start_frame=0, stop_frame=-1, dump_dir=None, print_log=True):
+def get_draft_parser(reduction):
+    """
+    Get a parse function for "get_parsed_frame" that parses a JPEG file from
+    a decode at 1/reduction of its size (see "code/batchparse.py").
+    """
+    return lambda path, scale, report: parse_jpeg(path, reduction, scale, report)
+
+def get_clip_extent(source, selection, log=None, sidecar=None, parse_draft=None):
+    """
+    Parses every selected frame of the video (opened by "open_source") to
+    find the largest fraction of the unwrapped image height that holds valid
+    rows, so that a single crop can be used for the whole clip.
+
+    parse_draft = parse the JPEG files of an image sequence from a decode at
+                  1/parse_draft of their size
+    """
+    if parse_draft and isinstance(source, ImageSequenceSource):
+        # Only the features are needed here, so JPEG files are parsed from a
+        # reduced decode instead of being decoded fully.
+        frames = ((i, source.get_jpeg_path(i) or source.load(i)) for i in source.get_indices(selection))
+    else:
+        frames = source.frames(selection)
+    extent = 0.0
+    for i, img in frames:
+        if log:
+            log("measuring crop of frame:", i)
+        if isinstance(img, basestring):
+            frame = get_parsed_frame(img, i, sidecar, parse=get_draft_parser(parse_draft))
+            size = get_image_size(img)
+        else:
+            frame = get_parsed_frame(img, i, sidecar)
+            size = img.size()
+        if frame:
+            projector = PolygonProjector(frame.center_point, frame.center_vertices)
+            extent = max(extent, get_valid_extent(projector, size))
+    return extent
+
+def unwrap_video(video_path, start_frame=0, stop_frame=-1, dump_dir=None, crop=None, use_sidecar=True, repeat_threshold=None, metrics=None, stride=1, ranges=None, resume=False, unwrapper=None, store_path=None, codec='jpeg', target_fps=None, preview_port=None, seek_frame=None, color='rgb', raw_size=None, raw_format=None, parse_draft=None, print_log=True):
     """
     Shows the given Super Hexagon video next to an unwrapped* version of it.
 
     *unwrapped means the walls fall top-to-bottom instead of out-to-in.
 
-    video_path  = path to the Super Hexagon video
+    video_path  = path to the Super Hexagon video (or image sequence, or raw
+                  video, see "code/source.py")
     start_frame = start at this frame in the video
     stop_frame = stop at this frame in the video
     frames_dir  = directory to dump the frames in
+    crop        = only dump the valid rows of each unwrapped frame:
+                    'frame' = crop each frame to its own valid rows
+                    'clip'  = crop every frame to the valid rows of the whole clip
+                  (the crop rectangles are written to "crop.json" in frames_dir)
+    use_sidecar = store the parsed frames in a file next to the video, so that
+                  later runs skip parsing them again
+    repeat_threshold = reuse the results of the previous frame for frames that
+                  differ from it by at most this much (mean difference per
+                  pixel channel, 0 to 255), dumping them as links to the
+                  previous files
+    metrics     = Metrics object to record the stages of each frame with
+                  (its summary is printed at the end)
+    stride      = only process every stride-th frame of each range
+    ranges      = list of (start, stop) frame ranges to process instead of
+                  start_frame and stop_frame (stop is inclusive, -1 = end)
+    resume      = continue an interrupted dump into frames_dir from its first
+                  missing or incomplete frame (the progress of a dump is kept
+                  in "progress.json" in frames_dir)
+    unwrapper   = Unwrapper object to reuse (its shader is already compiled),
+                  e.g. for many videos unwrapped by the same process
+    store_path  = store the raw original and unwrapped frames in this frame
+                  store file instead of dumping them as JPEG files
+                  (see "code/framestore.py", resumed from its last frame)
+    codec       = format of the dumped frames: 'jpeg', or 'palette' for the
+                  lossless codec of "code/codec.py" (run-lengths of exact
+                  palette colors for flat frames, which are small, and
+                  compressed pixels for decoded video, which are several
+                  times larger than JPEG)
+    target_fps  = degrade the quality (parse resolution and frequency, texture
+                  sampling, output size) when needed to hold this frame rate,
+                  recovering it when the load drops (see "code/quality.py")
+    preview_port = serve the latest frames and the status over HTTP on this
+                  local port, instead of showing the frames in SimpleCV's
+                  window (see "code/preview.py")
+    seek_frame  = jump straight to this frame (a keyframe at or before the
+                  first selected frame) instead of skipping the frames before
+                  it one by one (unless the video does not land exactly on
+                  it, see "VideoSource.seek")
+    color       = convert each decoded frame to 8 bits per pixel for parsing
+                  and unwrapping (see "code/colormode.py"):
+                    'rgb'      = keep the decoded colors everywhere
+                    'lossless' = parse the luminance, unwrap the colors
+                    'gray'     = parse and unwrap the luminance
+                    'palette'  = parse the luminance, and unwrap palette
+                                 indices (the shader looks up the colors)
+    raw_size    = (width,height) of the frames of a raw video file
+    raw_format  = pixel format of a raw video file (defaults to the one of
+                  its extension: ".bgr", ".rgb" or ".yuv" for yuv420p)
+    parse_draft = parse the JPEG files of an image sequence from a decode at
+                  1/parse_draft (2, 4 or 8) of their size, which the JPEG
+                  decoder does cheaply, and only decode them at full size for
+                  unwrapping (the vertices are scaled back up, and are less
+                  accurate)
     """
 
+    from code.unwrap import start_unwrap_window, Unwrapper
+
     def log(*args):
         """
         Helper function to display messages on the same line.
@@ -42,110 +158,411 @@ def unwrap_video(video_path, start_frame=0, stop_frame=-1, dump_dir=None, print_
             sys.stdout.write('\r' + ' '.join(map(str, args)).ljust(60))
             sys.stdout.flush()
 
-    # Create virtual camera for reading the video.
-    video = scv.VirtualCamera(video_path, 'video')
+    def log_line(message):
+        """
+        Helper function to display a message on its own line.
+        """
+        if print_log:
+            sys.stdout.write('\r' + message.ljust(60) + '\n')
+            sys.stdout.flush()
+
+    # Select the frames to process.
+    selection = FrameSelection(ranges or [(start_frame, stop_frame)], stride)
 
     # Create frames output directory.
     if dump_dir:
         if not os.path.exists(dump_dir):
             os.makedirs(dump_dir)
 
-    # Skip to the starting frame.
-    i = 0
-    while i < start_frame:
-        video.getImage()
-        log("skipping frame:",i)
-        i += 1
+    # extension of the dumped files
+    dump_ext = DUMP_EXTENSIONS[codec]
 
-    # create unwrapper
-    unwrapper = Unwrapper()
+    # Open the video to read the selected frames from (later), and to know
+    # where it ends when resuming an open-ended selection.
+    source = open_source(video_path, raw_size, raw_format)
+    frame_count = source.frame_count()
 
-    # get first image so we can correctly size the gl window
-    img = video.getImage()
+    # Keep track of the progress of the dump, so that it can be resumed.
+    manifest = None
+    if dump_dir:
+        video_key = get_video_key(video_path)
+        options = {"ranges": selection.ranges, "stride": stride, "crop": crop, "codec": codec, "color": color}
+        manifest = ProgressManifest(dump_dir, video_key, options)
+        if resume:
+            previous = ProgressManifest.load(dump_dir)
+            if previous:
+                if not previous.matches(video_key, options):
+                    raise ValueError('Cannot resume "%s" since it was dumped from another video or with other options.' % dump_dir)
+                manifest = previous
+
+            # Continue from the first frame after the recorded progress whose
+            # files are missing or incomplete (which is at most the one after
+            # the last dumped frame, when the length of the video is unknown).
+            resume_frame = None
+            if not manifest.complete:
+                last = max(manifest.last_frame, get_last_dumped_frame(dump_dir, dump_ext))
+                resume_frame = find_resume_frame(dump_dir, selection.indices(manifest.last_frame), dump_ext, frame_count, last)
+            if resume_frame is None:
+                manifest.complete = True
+                manifest.flush()
+                log('All frames were already dumped to "%s".' % dump_dir)
+                if print_log:
+                    print
+                return
+            log('resuming at frame:', resume_frame)
+            selection = selection.resume_at(resume_frame)
+            manifest.resume_at(resume_frame)
+
+    # Open the stored parse results of previous runs.
+    sidecar = None
+    if use_sidecar:
+        sidecar = open_video_sidecar(video_path, log=log_line)
+
+    # Measure a single crop for the whole clip before processing it.
+    clip_extent = None
+    if (dump_dir or store_path) and crop == 'clip':
+        if manifest and manifest.clip_extent is not None:
+            clip_extent = manifest.clip_extent
+        else:
+            clip_extent = get_clip_extent(open_source(video_path, raw_size, raw_format), selection, log, sidecar, parse_draft)
+        if manifest:
+            manifest.clip_extent = clip_extent
+
+    # Continue an existing frame store after its last frame.
+    store = None
+    if store_path and resume and os.path.exists(store_path):
+        store = FrameStore(store_path, 'r+')
+        store.rewind()
+        resume_frame = store.last_index() + 1
+        first_left = next(selection.indices(resume_frame), None)
+        if first_left is None or (frame_count is not None and first_left >= frame_count):
+            store.close()
+            if sidecar:
+                sidecar.close()
+            log('All frames were already stored in "%s".' % store_path)
+            if print_log:
+                print
+            return
+        log('resuming at frame:', resume_frame)
+        selection = selection.resume_at(resume_frame)
+
+    # Read the selected frames of the video, skipping the others without
+    # fully decoding them (or going straight to them in image sequences and
+    # raw videos).
+    if seek_frame and seek_frame <= selection.first():
+        if not source.seek(seek_frame):
+            log_line('Could not seek exactly to frame %d, skipping to it instead.' % seek_frame)
+    frames = source.frames(selection, log)
+
+    # create unwrapper (unless a warm one was given)
+    if unwrapper is None:
+        unwrapper = Unwrapper()
+
+    # Record metrics even if nobody listens, since it is cheap.
+    show_summary = metrics is not None
+    if metrics is None:
+        metrics = Metrics()
+
+    # Adjust the quality to hold the target frame rate.  (The output size is
+    # fixed when frames are cropped, stored or dumped, so it is left alone
+    # then.)
+    quality = None
+    if target_fps:
+        knobs = [name for name, values, stages in KNOBS
+            if name != 'output_scale' or not (crop or store_path or dump_dir)]
+        quality = QualityController(target_fps, knobs, log=log_line, metrics=metrics)
+        metrics.add_hook(quality)
+
+    # Serve a preview of the frames and the status (closed with the metrics).
+    preview = None
+    if preview_port is not None:
+        preview = PreviewServer(preview_port).start()
+        metrics.add_hook(preview)
+        log_line('preview at http://localhost:%d/' % preview.port)
+
+    # Convert the frames to 8 bits per pixel (if they are not parsed and
+    # unwrapped in their decoded colors).
+    converter = None
+    if color != 'rgb':
+        converter = FrameConverter(color)
+
+    # create detector of repeated frames
+    repeats = None
+    if repeat_threshold is not None:
+        repeats = RepeatDetector(repeat_threshold)
+
+    # get first image so we can correctly size the gl window (there may be
+    # none left, e.g. when resuming after the last frame of the video)
+    try:
+        i, img = next(frames)
+    except StopIteration:
+        if manifest:
+            manifest.complete = True
+            manifest.flush()
+        if store:
+            store.close()
+        if sidecar:
+            sidecar.close()
+        metrics.close()
+        log('No frames left to process in "%s".' % video_path)
+        if print_log:
+            print
+        return
     w,h = img.size()
 
+    # Create the frame store, with room for every selected frame if the length
+    # of the video is known.
+    if store_path and store is None:
+        capacity = selection.count(frame_count) if frame_count else 1024
+        store = FrameStore.create(store_path, w, h, capacity=max(1, capacity))
+    if store and (store.width, store.height) != (w,h):
+        raise ValueError('Cannot resume "%s" since its frames are not %dx%d.' % (store_path, w, h))
+
     # create state object for the "on_draw" callback
     self = {
         "i": i,
         "total": 0,
         "first_img": img,
+        "crop": None,
+        "prev": None,
+        "repeats": 0,
+        "buffer": None,
     }
 
     def get_dump_name(prefix):
         """
         Get the filename of the dumped frame.
         """
-        return "%s/%s%04d.jpg" % (dump_dir, prefix, self["i"])
+        return get_dump_path(dump_dir, prefix, self["i"], dump_ext)
+
+    def save_orig(img, name):
+        """Dump the original frame."""
+        if codec == 'palette':
+            with open(name, 'wb') as f:
+                f.write(encode_frame(img.getNumpyCv2()))
+        else:
+            img.save(name)
+
+    def save_unwrap(name, crop):
+        """Dump the unwrapped frame, optionally cropped."""
+        if codec == 'palette':
+            with open(name, 'wb') as f:
+                f.write(encode_frame(unwrapper.read_image(crop)))
+        else:
+            unwrapper.save_image(name, crop)
+
+    def store_orig(k, img):
+        """Copy the original image into the k-th record of the frame store."""
+        orig = store.image(k, 'orig')
+        orig[...] = img.getNumpyCv2()
+        return orig
+
+    def store_unwrap(k):
+        """Read the unwrapped image back into the k-th record of the frame store."""
+        if self["buffer"] is None:
+            self["buffer"] = np.empty((h,w,3), np.uint8)
+        store.image(k, 'unwrap')[...] = unwrapper.read_image(out=self["buffer"])
+        store.set_crop(k, self["crop"])
+
+    def publish_preview(img, drawn):
+        """
+        Hand the current frames to the preview server if someone watches.
+        """
+        if preview.wants('orig'):
+            preview.publish('orig', img.getNumpyCv2())
+        if drawn and preview.wants('unwrap'):
+            preview.publish('unwrap', unwrapper.read_image(gray=color == 'gray'))
 
     def on_draw():
         """
         Our main processing loop that is called by the OpenGL window draw event.
         """
 
+        # Stop between frames if we were asked to.
+        if stop.requested:
+            raise VideoDone()
+
+        metrics.begin_frame(None)
+
+        if quality:
+            unwrapper.set_quality(quality.settings["output_scale"], quality.settings["filter"] == 'linear')
+
+        # Crop every frame of the clip the same way, including the ones that
+        # fail to parse before the first frame is drawn.
+        if clip_extent is not None and self["crop"] is None:
+            self["crop"] = unwrapper.get_crop(clip_extent)
+
         # get first image or read next image
         img = self["first_img"]
         if img:
             self["first_img"] = None
         else:
-            img = video.getImage()
-
-        # Try to show the retrieved image in SimpleCV's own window.  If it
-        # fails, then we reached the end of the video and can raise the custom
-        # VideoDone exception.
-        try:
-            img.show()
-        except:
-            raise VideoDone()
+            try:
+                self["i"], img = metrics.measure('decode', next, frames)
+            except StopIteration:
+                raise VideoDone()
+        metrics.set(frame=self["i"])
+
+        # Try to show the retrieved image in SimpleCV's own window (unless
+        # it is previewed over HTTP).  If it fails, then we reached the end of
+        # the video and can raise the custom VideoDone exception.
+        if not preview:
+            try:
+                metrics.measure('show', img.show)
+            except:
+                raise VideoDone()
 
         # Print log message
-        if dump_dir:
+        if dump_dir or store:
             log('processing/dumping frame:', self["i"],'(%d fps)' % unwrapper.get_fps())
         else:
             log('processing frame:', self["i"],'(%d fps)' % unwrapper.get_fps())
 
-        # Get the features out of the image.
-        frame = parse_frame(img)
-
         # Create file names of the dumped frames.
         orig_name = get_dump_name('orig')
         unwrap_name = get_dump_name('unwrap')
 
+        # Reuse the results of the previous frame if this one repeats it.
+        if repeats and metrics.measure('fingerprint', repeats.is_repeat, img.getNumpyCv2()) and self["prev"]:
+            frame, prev_dump = self["prev"]
+            # (not stored in the sidecar, which only holds results parsed
+            # from the frame itself at full scale)
+            metrics.set(repeat=True, parsed=bool(frame))
+            if dump_dir:
+                link_file(prev_dump[0], orig_name)
+                link_file(prev_dump[1], unwrap_name)
+            elif store:
+                # (a store cannot link records, so the images are copied)
+                k = store.append(self["i"], self["crop"])
+                for name in store.names:
+                    store.image(k, name)[...] = store.image(prev_dump, name)
+                store.commit(k, DONE if frame else FAILED)
+            elif frame:
+                unwrapper.draw()
+            self["repeats"] += 1
+            next_frame()
+            return
+
+        # Convert the frame to 8 bits per pixel.  (Only luminance, and palette
+        # indices with their palette, are uploaded instead of the colors.)
+        luma = texture = palette = None
+        if converter:
+            luma, texture, palette = metrics.measure('convert', converter.convert, img.getNumpyCv2())
+            if texture.ndim == 3:
+                texture = None
+
+        # Get the features out of the image, unless the quality controller
+        # reuses the previous ones for this frame.
+        if quality and not quality.should_parse() and self["prev"] and self["prev"][0]:
+            frame = self["prev"][0]
+            metrics.set(parsed=True, reused=True)
+        else:
+            scale = quality.settings["parse_scale"] if quality else 1.0
+            draft_path = None
+            if parse_draft and isinstance(source, ImageSequenceSource):
+                draft_path = source.get_jpeg_path(self["i"])
+            if draft_path:
+                frame = get_parsed_frame(draft_path, self["i"], sidecar, metrics, scale, get_draft_parser(parse_draft))
+            elif luma is not None:
+                frame = get_parsed_frame(luma, self["i"], sidecar, metrics, scale, parse_luma)
+            else:
+                frame = get_parsed_frame(img, self["i"], sidecar, metrics, scale)
+
         # Generate and show the unwrapped image.
-        if frame:
+        if store:
+            k = store.append(self["i"])
+
+            # Store the original frame, and upload it from the store.
+            orig = metrics.measure('save_orig', store_orig, k, img)
+            if frame:
+                src = orig if texture is None else texture
+                metrics.measure('upload', unwrapper.update, src, frame, palette)
+                metrics.measure('draw', unwrapper.draw)
+                if crop:
+                    self["crop"] = unwrapper.get_crop(clip_extent)
+
+            # Store the unwrapped frame (the previous one if parsing failed).
+            metrics.measure('save_unwrap', store_unwrap, k)
+            store.commit(k, DONE if frame else FAILED)
+            if preview:
+                metrics.measure('preview', publish_preview, img, bool(frame))
+            self["prev"] = (frame, k)
+            next_frame()
+            return
+        elif frame:
             if not dump_dir:
-                # Write the image to a temp file so pyglet can read the texture.
-                img.save('tmp.jpg')
-                unwrapper.update('tmp.jpg', frame)
-                unwrapper.draw()
+                if texture is None:
+                    # Write the image to a temp file so pyglet can read the texture.
+                    metrics.measure('save_orig', img.save, 'tmp.jpg')
+                    metrics.measure('upload', unwrapper.update, 'tmp.jpg', frame)
+                else:
+                    metrics.measure('upload', unwrapper.update, texture, frame, palette)
+                metrics.measure('draw', unwrapper.draw)
             else:
                 # Dump the original frame.
-                img.save(orig_name)
-
-                # Update the unwrapper and draw the unwrapped frame.
-                unwrapper.update(orig_name, frame)
-                unwrapper.draw()
+                metrics.measure('save_orig', save_orig, img, orig_name)
+
+                # Update the unwrapper (from the dumped JPEG file, which pyglet
+                # can read, or directly from the image array or its 8-bit
+                # conversion) and draw the unwrapped frame.
+                if texture is not None:
+                    src = texture
+                elif codec == 'jpeg':
+                    src = orig_name
+                else:
+                    src = img.getNumpyCv2()
+                metrics.measure('upload', unwrapper.update, src, frame, palette)
+                metrics.measure('draw', unwrapper.draw)
 
                 # Dump the unwrapped frame.
-                unwrapper.save_image(unwrap_name)
+                if crop:
+                    self["crop"] = unwrapper.get_crop(clip_extent)
+                metrics.measure('save_unwrap', save_unwrap, unwrap_name, self["crop"])
         else:
             if dump_dir:
                 # dump the current images if the parsing failed
-                img.save(orig_name)
-                unwrapper.save_image(unwrap_name)
+                metrics.measure('save_orig', save_orig, img, orig_name)
+                metrics.measure('save_unwrap', save_unwrap, unwrap_name, self["crop"])
+
+        if preview:
+            metrics.measure('preview', publish_preview, img, bool(frame))
+        self["prev"] = (frame, (orig_name, unwrap_name))
+        next_frame()
+
+    def next_frame():
+        """
+        Finish processing the current frame and advance to the next one.
+        """
+        if manifest:
+            manifest.mark_done(self["i"], self["crop"])
 
         self["total"] += 1
+        metrics.end_frame()
 
         # Stop processing if we reached the last requested frame.
-        if self["i"] == stop_frame:
+        if selection.is_done(self["i"]+1):
             raise VideoDone()
 
-        self["i"] += 1
-
-    # Run the opengl window until the last video frame is processed.
-    try:
-        start_unwrap_window(w,h,on_draw)
-    except VideoDone:
-        pass
+    # Run the opengl window until the last video frame is processed, or until
+    # we are interrupted.
+    with StopSignals() as stop:
+        try:
+            start_unwrap_window(w,h,on_draw)
+        except VideoDone:
+            if manifest and not stop.requested:
+                manifest.complete = True
+        finally:
+            # Save the progress and the parse results for later runs, even if
+            # we stopped because of an error.
+            if manifest:
+                manifest.flush()
+            if store:
+                store.close()
+            if sidecar:
+                sidecar.close()
+
+    # Finish writing the metrics.
+    metrics.close()
 
     # Try to remove the temporary image file.
     if not dump_dir:
@@ -154,16 +571,35 @@ def unwrap_video(video_path, start_frame=0, stop_frame=-1, dump_dir=None, print_
         except OSError:
             pass
 
+    # Record the crop rectangles so the full unwrapped frames can be
+    # reconstructed by pasting each one onto a black canvas of the window size.
+    if dump_dir and crop:
+        with open(os.path.join(dump_dir, 'crop.json'), 'w') as f:
+            json.dump({
+                "canvas": [w,h],
+                "crops": dict((str(k),v) for k,v in manifest.crops.iteritems()),
+            }, f)
+
     # Print final log message.
-    if dump_dir:
-        log('Dumped',self["total"],'frames to "%s".' % dump_dir)
+    repeated = ''
+    if repeats:
+        repeated = '(%d repeated)' % self["repeats"]
+    if stop.requested and (dump_dir or store):
+        log('Stopped after frame', self["i"], repeated, '(use --resume to continue)')
+    elif store:
+        log('Stored',self["total"],'frames in "%s".' % store_path, repeated)
+    elif dump_dir:
+        log('Dumped',self["total"],'frames to "%s".' % dump_dir, repeated)
     else:
-        log(self["total"],'frames processed.')
+        log(self["total"],'frames processed.', repeated)
 
     # Append new line so the terminal can continue after our log line.
     if print_log:
         print
 
+    if print_log and show_summary:
+        print format_summary(metrics.summary())
+
 if __name__ == "__main__":
 
     # Create argument parser
@@ -171,10 +607,26 @@ if __name__ == "__main__":
         description=__doc__,
         formatter_class=argparse.RawTextHelpFormatter)
         #usage="%(prog)s [options] video")
-    parser.add_argument('video', help='path to video of super hexagon')
+    parser.add_argument('video', help='path to video of super hexagon (or a directory or pattern of\nnumbered images, e.g. "frames/orig%%04d.jpg", or a raw video)')
     parser.add_argument('--out', metavar='DIR', help='dump frames into this directory')
     parser.add_argument('--start', metavar='N', type=int, help='start at this frame of the video')
     parser.add_argument('--stop', metavar='N', type=int, help='stop at this frame of the video')
+    parser.add_argument('--stride', metavar='N', type=int, help='only process every Nth frame')
+    parser.add_argument('--ranges', metavar='LIST', type=parse_ranges, help='only process these frame ranges, e.g. "0-100,500-600,900-"\n(instead of --start and --stop)')
+    parser.add_argument('--raw-size', metavar='WxH', help='size of the frames of a raw video file (.bgr, .rgb or .yuv)')
+    parser.add_argument('--raw-format', choices=RAW_FORMATS, help='pixel format of a raw video file (default from its extension)')
+    parser.add_argument('--parse-draft', metavar='N', type=int, choices=DRAFT_REDUCTIONS, help='parse the JPEG files of an image sequence from a decode\nat 1/N of their size (N = 2, 4 or 8)')
+    parser.add_argument('--codec', choices=['jpeg','palette'], help='format of the dumped frames (default jpeg)\n(palette = lossless: run-lengths of exact palette colors for\n flat frames, compressed pixels larger than JPEG for decoded video)')
+    parser.add_argument('--color', choices=COLOR_MODES, help='convert the frames to 8 bits per pixel after decoding (default rgb)\n(lossless = parse luminance but unwrap colors, gray = luminance\nonly, palette = unwrap palette indices and look up their colors)')
+    parser.add_argument('--store', metavar='FILE', help='store the raw frames in this single frame store file\n(instead of dumping JPEG files with --out)')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted dump into the --out directory\n(or frame store)')
+    parser.add_argument('--no-sidecar', action='store_true', help='do not store or reuse parsed frames in a file next to the video')
+    parser.add_argument('--dedup', metavar='T', type=float, nargs='?', const=1.0, help='reuse results for frames that repeat the previous one\n(T = max mean pixel difference, default 1.0)')
+    parser.add_argument('--metrics', metavar='FILE', help='write the metrics of each frame to this file\n(as JSON lines, or binary if FILE ends with ".bin")')
+    parser.add_argument('--profile', action='store_true', help='sample where the time goes, and report it at the end')
+    parser.add_argument('--target-fps', metavar='N', type=float, help='degrade the quality when needed to hold this frame rate\n(each adjustment is logged with its reason)')
+    parser.add_argument('--preview', metavar='PORT', type=int, nargs='?', const=DEFAULT_PORT, help='serve the latest frames (MJPEG) and status (JSON) on this\nlocal port instead of showing them (default %d)' % DEFAULT_PORT)
+    parser.add_argument('--crop', choices=['frame','clip'], help='only dump the valid rows of the unwrapped frames\n(frame = per frame, clip = one size for the whole clip)')
     args = parser.parse_args()
 
     # Create optional args from those parsed
@@ -185,6 +637,58 @@ if __name__ == "__main__":
         opts['start_frame'] = args.start
     if args.stop:
         opts['stop_frame'] = args.stop
+    if args.stride:
+        opts['stride'] = args.stride
+    if args.ranges:
+        opts['ranges'] = args.ranges
+    if args.crop:
+        opts['crop'] = args.crop
+    if args.dedup is not None:
+        opts['repeat_threshold'] = args.dedup
+    if args.no_sidecar:
+        opts['use_sidecar'] = False
+    if args.codec:
+        opts['codec'] = args.codec
+    if args.color:
+        opts['color'] = args.color
+    if args.raw_size:
+        try:
+            opts['raw_size'] = tuple(map(int, args.raw_size.split('x')))
+        except ValueError:
+            parser.error('--raw-size must look like 1280x720')
+    if args.raw_format:
+        opts['raw_format'] = args.raw_format
+    if args.parse_draft:
+        opts['parse_draft'] = args.parse_draft
+    if args.target_fps:
+        opts['target_fps'] = args.target_fps
+    if args.preview:
+        opts['preview_port'] = args.preview
+    if args.store:
+        if args.out:
+            parser.error('--store and --out cannot be used together')
+        opts['store_path'] = args.store
+    if args.resume:
+        if not args.out and not args.store:
+            parser.error('--resume needs the --out directory or --store file of the dump')
+        opts['resume'] = True
+
+    # Create the metrics if they are wanted.
+    if args.metrics or args.profile:
+        opts['metrics'] = Metrics()
+    if args.metrics:
+        if args.metrics.endswith('.bin'):
+            opts['metrics'].add_hook(BinaryLog(args.metrics, STAGES))
+        else:
+            opts['metrics'].add_hook(JsonLinesLog(args.metrics))
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler()
+        profiler.start()
 
     # Unwrap video
     unwrap_video(args.video, **opts)
+
+    if profiler:
+        profiler.stop()
+        print profiler.report()